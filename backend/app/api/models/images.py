@@ -1,5 +1,6 @@
-from typing import Annotated, Optional
-from pydantic import BaseModel, BeforeValidator, ConfigDict, Field
+from typing import Annotated, Literal, Optional
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, computed_field
+from ..utils import derivatives
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
@@ -36,5 +37,23 @@ class ImageModel(BaseModel):
         },
     )
 
+#Fields that listings can be projected on
+ImageField = Literal['author', 'born_died', 'title', 'date', 'technique', 'location', 'form', 'type', 'school', 'timeline', 'url']
+
+class PartialImageModel(ImageModel):
+    """An image with only some of its fields, from a projected listing. Meant to be dumped with exclude_unset"""
+    title: str | None = Field(None)
+
 class RetrievedImageModel(ImageModel):
-    score: float = Field(...)
\ No newline at end of file
+    score: float = Field(...)
+
+    #Resized copies, for grids and detail views. Generated on ingestion, or on their first request
+    @computed_field
+    @property
+    def thumbnail_url(self) -> str | None:
+        return derivatives.derivative_url(self.url, 'thumbnail')
+
+    @computed_field
+    @property
+    def preview_url(self) -> str | None:
+        return derivatives.derivative_url(self.url, 'preview')
\ No newline at end of file
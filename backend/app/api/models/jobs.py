@@ -0,0 +1,31 @@
+from typing import Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from .images import PyObjectId
+
+class IngestErrorModel(BaseModel):
+    filename: str = Field(...)
+    detail: str = Field(...)
+
+class IngestJobModel(BaseModel):
+    id: Optional[PyObjectId] = Field(alias="_id", default=None)
+    status: Literal['running', 'completed', 'failed'] = Field('running')
+    total: int = Field(...)
+    processed: int = Field(0) #Images fully ingested
+    failed: int = Field(0)
+    errors: list[IngestErrorModel] = Field([])
+
+    model_config = ConfigDict(
+        populate_by_name=True,
+        json_schema_extra={
+            "example": {
+                "_id": "6717a3f2c1d4e5f6a7b8c9d0",
+                "status": "running",
+                "total": 250,
+                "processed": 128,
+                "failed": 1,
+                "errors": [
+                    {"filename": "scan_042.jpg", "detail": "Invalid MIME type: image/png. Only image/jpeg is supported"}
+                ]
+            }
+        },
+    )
@@ -0,0 +1,48 @@
+import os
+from typing import Literal
+from pydantic import BaseModel, ConfigDict, Field
+
+BATCH_SEARCH_MAX_QUERIES = int(os.environ.get('BATCH_SEARCH_MAX_QUERIES', 32))
+#Largest `n` of a page of search or related results
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', 100))
+
+class FacetFilterModel(BaseModel):
+    """Metadata facets to filter on. Each facet matches any of its values, and all given facets must match"""
+    author: list[str] | None = Field(None)
+    school: list[str] | None = Field(None)
+    form: list[str] | None = Field(None)
+    #Aliased, as 'type' is already the search type in the search endpoints
+    type: list[str] | None = Field(None, alias='image_type')
+    timeline: list[str] | None = Field(None)
+    technique: list[str] | None = Field(None)
+
+    model_config = ConfigDict(populate_by_name=True)
+
+#Payload fields of each image in qdrant that can be filtered and counted on. All are keyword indexed
+FACET_FIELDS = list(FacetFilterModel.model_fields)
+
+class FacetCountModel(BaseModel):
+    value: str = Field(...)
+    count: int = Field(...)
+
+class SearchQueryModel(BaseModel):
+    query: str = Field(...)
+    type: Literal['semantic', 'keyword', 'hybrid'] = Field('semantic')
+    n: int = Field(20, ge=1, le=SEARCH_MAX_PAGE_SIZE) #Number of results to display
+    page: int = Field(1, ge=1) #1-indexed
+    filters: FacetFilterModel | None = Field(None)
+
+class BatchSearchModel(BaseModel):
+    queries: list[SearchQueryModel] = Field(..., min_length=1, max_length=BATCH_SEARCH_MAX_QUERIES)
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "queries": [
+                    {"query": "a portrait of a woman", "type": "semantic", "n": 20, "page": 1},
+                    {"query": "a portrait of a woman", "type": "hybrid", "n": 20, "page": 1, "filters": {"school": ["italian"]}},
+                    {"query": "rembrandt", "type": "keyword", "n": 5},
+                ]
+            }
+        },
+    }
@@ -1,11 +1,18 @@
-from typing import Annotated
-from fastapi import APIRouter, Depends, File, Form, Query, UploadFile
+from __future__ import annotations
+from typing import Annotated, Literal, TYPE_CHECKING
+from fastapi import APIRouter, Depends, File, Form, Query, Response, UploadFile
+from fastapi.responses import StreamingResponse
 import logging
-from fastembed import SparseTextEmbedding
-from transformers import SiglipModel, SiglipProcessor
 from ... import dependencies
-from ..models.images import ImageModel, RetrievedImageModel
-from ..services import image_service
+from ..models.images import ImageField, ImageModel, PartialImageModel, RetrievedImageModel
+from ..models.jobs import IngestJobModel
+from ..models.search import SEARCH_MAX_PAGE_SIZE
+from ..services import image_service, ingest_service
+from ..utils import admission, pagination
+
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from ...inference.engine import InferenceEngine
 
 logging.basicConfig(level=logging.INFO)
 
@@ -17,14 +24,28 @@ router = APIRouter(
 
 @router.get(
     '/',
-    response_description="Lists the first 1000 images in the database",
-    response_model=list[ImageModel]
+    response_description="A page of images, in insertion order",
+    response_model=list[PartialImageModel],
+    response_model_exclude_unset=True
 )
-async def read_all():
+async def read_all(
+    response: Response,
+    limit: Annotated[int | None, Query(ge=1, description="Number of images. Defaults to 1000, at most 1000 for JSON. NDJSON streams every image when unset")] = None,
+    cursor: Annotated[str | None, Query(description="Cursor from the X-Next-Cursor header of the previous page, or the _id of the last image received")] = None,
+    fields: Annotated[list[ImageField] | None, Query(description="Only return these fields, each repeated, e.g. `?fields=title&fields=url`. `_id` is always included")] = None,
+    format: Literal['json', 'ndjson'] = 'json',
+):
     """
-    Lists the first 1000 images in the database
+    Lists the images in the database, a page at a time. Pass the X-Next-Cursor header of a page as `cursor` to get
+    the next one. With `format=ndjson`, images are streamed one per line, e.g. for exports. Images have every field,
+    null when missing, unless only some `fields` are requested
     """
-    return await image_service.get_first_k(1000)
+    if format == 'ndjson':
+        return StreamingResponse(image_service.stream_images(limit, cursor, fields), media_type='application/x-ndjson')
+
+    images, next_cursor = await image_service.list_images(limit, cursor, fields)
+    pagination.set_next_cursor(response, next_cursor)
+    return images
 
 @router.get(
     "/{image_id}",
@@ -37,19 +58,47 @@ async def read_single(image_id: str):
 @router.post(
     '/',
     response_description="Creates an image",
-    response_model=ImageModel
+    response_model=ImageModel,
+    dependencies=[Depends(admission.admit_ingest)]
 )
 async def create_single(
     image_data: str = Form(..., description="JSON that can be parsed into an ImageModel"), 
     file: UploadFile = File(..., description=".jpg image"),
-    model: SiglipModel = Depends(dependencies.get_sglip_model),
-    processor: SiglipProcessor = Depends(dependencies.get_sglip_processor),
+    engine: InferenceEngine = Depends(dependencies.get_inference_engine),
     bm25_model: SparseTextEmbedding = Depends(dependencies.get_bm25_model)
 ):
     """
     Creates an image in the database along with relevant metadata.
     """
-    return await image_service.handle_image_creation(image_data, file, model, processor, bm25_model)
+    return await image_service.handle_image_creation(image_data, file, engine, bm25_model)
+
+@router.post(
+    '/bulk',
+    response_description="Starts a bulk ingestion job",
+    response_model=IngestJobModel,
+    status_code=202,
+    dependencies=[Depends(admission.admit_ingest)]
+)
+async def create_bulk(
+    image_data: str = Form(..., description="JSON object mapping each file name to metadata that can be parsed into an ImageModel"),
+    files: list[UploadFile] = File([], description=".jpg images"),
+    archive: UploadFile | None = File(None, description=".zip archive of .jpg images"),
+    engine: InferenceEngine = Depends(dependencies.get_inference_engine),
+    bm25_model: SparseTextEmbedding = Depends(dependencies.get_bm25_model)
+):
+    """
+    Creates many images at once, from uploaded files and/or a zip archive. Images are indexed in the background,
+    check the progress of the returned job on `/images/bulk/{job_id}`
+    """
+    return await ingest_service.start_bulk_ingestion(image_data, files, archive, engine, bm25_model)
+
+@router.get(
+    '/bulk/{job_id}',
+    response_description="Status of a bulk ingestion job",
+    response_model=IngestJobModel
+)
+async def read_bulk_job(job_id: str):
+    return await ingest_service.get_job(job_id)
 
 @router.get(
     '/related/{image_id}',
@@ -58,11 +107,15 @@ async def create_single(
 )
 async def get_related(
     image_id: str,
-    n: Annotated[int, Query(description="Number of results to display")] = 5,
-    page: Annotated[int, Query(description="Current page to display. 1-indexed")] = 1,
+    response: Response,
+    n: Annotated[int, Query(description="Number of results to display", ge=1, le=SEARCH_MAX_PAGE_SIZE)] = 5,
+    page: Annotated[int, Query(description="Current page to display. 1-indexed", ge=1)] = 1,
+    cursor: Annotated[str | None, Query(description="Cursor from the X-Next-Cursor header of the previous page. Takes precedence over page")] = None,
 ):
     """
     Gets semantically related image, starting from an image in the database
     """
 
-    return await image_service.get_related(image_id, n, page)
\ No newline at end of file
+    results, next_cursor = await image_service.get_related(image_id, n, page, cursor)
+    pagination.set_next_cursor(response, next_cursor)
+    return results
\ No newline at end of file
@@ -1,11 +1,16 @@
-from typing import Annotated, Literal
-from fastapi import APIRouter, Depends, File, Query, UploadFile
+from __future__ import annotations
+from typing import Annotated, Literal, TYPE_CHECKING
+from fastapi import APIRouter, Depends, File, Query, Response, UploadFile
 import logging
-from fastembed import SparseTextEmbedding
 from ... import dependencies
-from transformers import SiglipModel, SiglipProcessor, SiglipTokenizer
-from ..models.images import ImageModel, RetrievedImageModel
+from ..models.images import RetrievedImageModel
+from ..models.search import SEARCH_MAX_PAGE_SIZE, BatchSearchModel, FacetCountModel, FacetFilterModel
 from ..services import search_service
+from ..utils import admission, pagination
+
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from ...inference.engine import InferenceEngine
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,45 +20,102 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+def facet_filters(
+    author: Annotated[list[str] | None, Query()] = None,
+    school: Annotated[list[str] | None, Query()] = None,
+    form: Annotated[list[str] | None, Query()] = None,
+    image_type: Annotated[list[str] | None, Query(description="Filters on the image type. Named so it doesn't clash with the search type")] = None,
+    timeline: Annotated[list[str] | None, Query()] = None,
+    technique: Annotated[list[str] | None, Query()] = None,
+) -> FacetFilterModel:
+    """Facet filters from the query string"""
+    return FacetFilterModel(author=author, school=school, form=form, type=image_type, timeline=timeline, technique=technique)
+
 @router.get(
     '/',
     response_description="Searches",
-    response_model=list[RetrievedImageModel]
+    response_model=list[RetrievedImageModel],
+    dependencies=[Depends(admission.admit_search)]
 )
 async def text_search(
     query: str,
+    response: Response,
     type: Literal['semantic', 'keyword', 'hybrid'] = 'semantic',
-    n: Annotated[int, Query(description="Number of results to display")] = 20,
-    page: Annotated[int, Query(description="Current page to display. 1-indexed")] = 1,
-    model: SiglipModel = Depends(dependencies.get_sglip_model),
-    tokenizer: SiglipTokenizer = Depends(dependencies.get_sglip_tokenizer),
+    n: Annotated[int, Query(description="Number of results to display", ge=1, le=SEARCH_MAX_PAGE_SIZE)] = 20,
+    page: Annotated[int, Query(description="Current page to display. 1-indexed", ge=1)] = 1,
+    cursor: Annotated[str | None, Query(description="Cursor from the X-Next-Cursor header of the previous page. Takes precedence over page")] = None,
+    facets: FacetFilterModel = Depends(facet_filters),
+    engine: InferenceEngine = Depends(dependencies.get_inference_engine),
     bm25_model: SparseTextEmbedding = Depends(dependencies.get_bm25_model)
 ):
     """
-    Perform a search on the indexed database, from a text query. Defaults to semantic search, but hybrid and keyword searches are also available
+    Perform a search on the indexed database, from a text query. Defaults to semantic search, but hybrid and keyword searches are also available.
+    Results can be filtered on metadata facets, each repeated for several values, e.g. `?school=italian&school=venetian&image_type=portrait`
     """
 
     if type == 'semantic':
-        return await search_service.semantic_search(query, n, page, model, tokenizer)
+        results, next_cursor = await search_service.semantic_search(query, n, page, engine, cursor, facets)
     if type == 'keyword':
-        return await search_service.keyword_search(query, n, page, bm25_model)
+        results, next_cursor = await search_service.keyword_search(query, n, page, bm25_model, cursor, facets)
     if type == 'hybrid':
-        return await search_service.hybrid_search(query, n, page, model, tokenizer, bm25_model)
+        results, next_cursor = await search_service.hybrid_search(query, n, page, engine, bm25_model, cursor, facets)
+
+    pagination.set_next_cursor(response, next_cursor)
+    return results
+
+@router.get(
+    '/facets/{field}',
+    response_description="Most common values of the facet, with their image counts",
+    response_model=list[FacetCountModel]
+)
+async def facet_counts(
+    field: Literal['author', 'school', 'form', 'type', 'timeline', 'technique'],
+    limit: Annotated[int, Query(description="Number of values to return", ge=1)] = 20,
+    exact: Annotated[bool, Query(description="Count exactly instead of estimating. Slower on large collections")] = False,
+    facets: FacetFilterModel = Depends(facet_filters),
+):
+    """
+    Count the images of each value of a facet, among the images matching the other facet filters
+    """
+
+    return await search_service.facet_counts(field, limit, facets, exact)
+
+@router.post(
+    '/batch',
+    response_description="Results of each query, in order",
+    response_model=list[list[RetrievedImageModel]],
+    dependencies=[Depends(admission.admit_search)]
+)
+async def batch_search(
+    batch: BatchSearchModel,
+    engine: InferenceEngine = Depends(dependencies.get_inference_engine),
+    bm25_model: SparseTextEmbedding = Depends(dependencies.get_bm25_model)
+):
+    """
+    Perform many text searches in one request. Texts are encoded together, and searched with a single batch query
+    """
+
+    return await search_service.batch_search(batch.queries, engine, bm25_model)
 
 @router.post(
     '/by-image',
     response_description="",
-    response_model=list[RetrievedImageModel]
+    response_model=list[RetrievedImageModel],
+    dependencies=[Depends(admission.admit_search)]
 )
 async def image_semantic_search(
+    response: Response,
     file: UploadFile = File(..., description=".jpg image"),
-    n: Annotated[int, Query(description="Number of results to display")] = 20,
-    page: Annotated[int, Query(description="Current page to display. 1-indexed")] = 1,
-    model: SiglipModel = Depends(dependencies.get_sglip_model),
-    processor: SiglipProcessor = Depends(dependencies.get_sglip_processor),
+    n: Annotated[int, Query(description="Number of results to display", ge=1, le=SEARCH_MAX_PAGE_SIZE)] = 20,
+    page: Annotated[int, Query(description="Current page to display. 1-indexed", ge=1)] = 1,
+    cursor: Annotated[str | None, Query(description="Cursor from the X-Next-Cursor header of the previous page. Takes precedence over page")] = None,
+    facets: FacetFilterModel = Depends(facet_filters),
+    engine: InferenceEngine = Depends(dependencies.get_inference_engine),
 ):
     """
-    Perform semantic search on the indexed database, from an image query
+    Perform semantic search on the indexed database, from an image query. Takes the same facet filters as text search
     """
-    
-    return await search_service.semantic_search_from_image(file, n, page, model, processor)
+
+    results, next_cursor = await search_service.semantic_search_from_image(file, n, page, engine, cursor, facets)
+    pagination.set_next_cursor(response, next_cursor)
+    return results
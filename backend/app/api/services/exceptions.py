@@ -16,4 +16,30 @@ class InvalidMediaType(ServiceError):
 
 class DatabaseError(ServiceError):
     """Raised when an unrecoverable database error occurs"""
-    pass
\ No newline at end of file
+    pass
+
+class InvalidCursorError(ServiceError):
+    """Raised when a pagination cursor is malformed or belongs to another query"""
+    pass
+
+class PageOutOfRangeError(ServiceError):
+    """Raised when a page or cursor points past the deepest result that can be paged to"""
+    pass
+
+class InvalidMetadataError(ServiceError):
+    """Raised when image metadata can't be parsed"""
+    pass
+
+class FileTooLargeError(ServiceError):
+    """Raised when an uploaded file exceeds the maximum upload size"""
+    pass
+
+class OverloadedError(ServiceError):
+    """Raised when admission control turns a request away. `retry_after` is in seconds"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class QueueFullError(OverloadedError):
+    """Raised when too many requests are already waiting for a slot"""
+    pass
@@ -1,42 +1,85 @@
+from __future__ import annotations
+import json
 import pathlib
 import uuid
 from bson import ObjectId
 from fastapi import HTTPException, UploadFile
-from fastembed import SparseTextEmbedding
-from transformers import SiglipModel, SiglipProcessor
-from ..models.images import ImageModel
+from typing import AsyncIterator, TYPE_CHECKING
+from ..models.images import ImageField, ImageModel, PartialImageModel
 from ...db import db, vector_db
 import logging
 import os
-import magic
-from . import exceptions
-import torch
-from transformers.image_utils import load_image
+from . import exceptions, search_service
+from ... import metrics
 from qdrant_client.http.models import (PointStruct, Filter, FieldCondition, MatchValue, HasIdCondition)
 from qdrant_client import models
-from ..utils import database
+from ..utils import database, derivatives, neighbors, pagination, uploads
+from ..utils.cache import coalesce, search_flights
+from ...config import COLLECTION_NAME, DENSE_VECTOR_NAME, SPARSE_VECTOR_NAME
+from ...inference import preprocess
+
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from ...inference.engine import InferenceEngine
 
 IMAGES_DIR = os.environ.get('IMAGES_DIR')
 IMAGES_URL_PATH = os.environ.get('IMAGES_URL_PATH')
 UPLOAD_DIR = pathlib.Path(IMAGES_DIR)
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-IMAGE_COLLECTION_NAME = 'image_hub'
 
-DENSE_VECTOR_NAME="image_embedding"
-SPARSE_VECTOR_NAME="text_bm25"
+#Page size of listings. Pages can't go above IMAGES_LIST_MAX_LIMIT, except for NDJSON exports. The default is the
+#size of the listing before it was paginated, so clients that don't page still get as many images
+IMAGES_LIST_DEFAULT_LIMIT = int(os.environ.get('IMAGES_LIST_DEFAULT_LIMIT', 1_000))
+IMAGES_LIST_MAX_LIMIT = int(os.environ.get('IMAGES_LIST_MAX_LIMIT', 1_000))
 
-async def get_first_k(k = 1_000):
-    col = database.get_images_collection()
+def find_images(after: str | None, limit: int | None, fields: list[ImageField] | None):
+    """Mongo cursor over the images following the `after` id, in `_id` order, with only `fields` if given"""
+    query = {}
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            raise exceptions.InvalidCursorError(f"Malformed cursor: {after}")
+        #Keyset pagination: seeks on the _id index, however deep the page is
+        query['_id'] = {'$gt': ObjectId(after)}
 
-    return await col.find().to_list(k)
+    projection = {field: 1 for field in fields} if fields else None
+    cursor = database.get_images_collection().find(query, projection).sort('_id', 1)
 
-async def get_from_id(id: str):
-    col = database.get_images_collection()
+    return cursor.limit(limit) if limit else cursor
+
+def listed_image(image: dict, fields: list[ImageField] | None) -> dict:
+    """An image as listed: with every field like ImageModel (None when missing in mongo), or only `fields` if given"""
+    return PartialImageModel.model_validate(image).model_dump(mode='json', by_alias=True, exclude_unset=bool(fields))
+
+async def list_images(limit: int | None, cursor: str | None = None, fields: list[ImageField] | None = None) -> tuple[list[dict], str | None]:
+    """A page of images, and the cursor of the next one, or None if this was the last"""
+    metrics.set_operation('list_images')
+    limit = min(limit or IMAGES_LIST_DEFAULT_LIMIT, IMAGES_LIST_MAX_LIMIT)
+
+    with metrics.stage('mongo'):
+        images = await find_images(cursor, limit, fields).to_list(limit)
 
+    next_cursor = str(images[-1]['_id']) if len(images) == limit else None
+    return [listed_image(image, fields) for image in images], next_cursor
+
+def stream_images(limit: int | None, cursor: str | None = None, fields: list[ImageField] | None = None) -> AsyncIterator[bytes]:
+    """
+    Images as NDJSON lines, read from mongo as they are sent. Without a limit, every image after the cursor is
+    streamed. The cursor is validated before the response starts
+    """
+    metrics.set_operation('export_images')
+    images = find_images(cursor, limit, fields)
+
+    async def lines():
+        async for image in images:
+            yield json.dumps(listed_image(image, fields)).encode() + b'\n'
+
+    return lines()
+
+async def get_from_id(id: str):
     if not ObjectId.is_valid(id):
         raise exceptions.InvalidIDError(f"Invalid image ID format: {id}")
 
-    item = await col.find_one({'_id': ObjectId(id)})
+    item = (await database.get_documents([id])).get(id)
 
     if item is None:
         raise exceptions.ItemNotFoundError(f"Image with id {id} not found.")
@@ -45,24 +88,24 @@ async def get_from_id(id: str):
 
 async def save_image_to_disk(file: UploadFile):
     """Saves an image file to disk, generating an unique uuid for it. Returns the image url to be returned, and the actual path on disk"""
-    file_extension = pathlib.Path(file.filename).suffix
+    return await save_image_stream_to_disk(file.filename, file.read)
+
+async def save_image_stream_to_disk(filename: str, read: uploads.ChunkReader):
+    """
+    Streams an image file to disk in chunks, generating an unique uuid for it. The file only appears under its
+    final name once completely written. Returns the image url to be returned, and the actual path on disk
+    """
+    file_extension = pathlib.Path(filename).suffix
 
     if file_extension != '.jpg':
         raise exceptions.InvalidMediaType(f"Invalid file extension: {file_extension}. Only .jpeg is supported")
-    
 
     uuid_val = uuid.uuid4()
     unique_filename = f"{uuid_val}{file_extension}"
     save_path = UPLOAD_DIR / unique_filename
-    contents = await file.read()
 
-    #Check the mimetype before saving!
-    mime = magic.from_buffer(contents, mime=True)
-    if mime != 'image/jpeg':
-        raise exceptions.InvalidMediaType(f"Invalid MIME type: {mime}. Only image/jpeg is supported")
-    
-    with open(save_path, "wb") as f:
-        f.write(contents)
+    tmp_path, _ = await uploads.stream_to_temp_file(read, UPLOAD_DIR)
+    os.replace(tmp_path, save_path)
 
     return f'{IMAGES_URL_PATH}/{unique_filename}', save_path
 
@@ -79,87 +122,108 @@ async def save_metadata_to_db(image: ImageModel):
 
     if created_image is None:
         raise exceptions.DatabaseError("An error ocurred while creating the image in the database")
-    
+
+    await database.invalidate_document(str(created_image['_id']))
     return created_image
 
+def get_image_text(image: ImageModel) -> str:
+    """Text indexed by BM25 for an image, made of all its metadata"""
+    non_text = set(['id', 'url'])
+    return ' '.join([str(v) for k,v in image.model_dump().items() if k not in non_text and v is not None])
+
+def point_id(path: pathlib.Path) -> str | int:
+    """Images are stored as {point id}.jpg. Uploads are named by uuid, seeded images by their integer dataset id"""
+    return int(path.stem) if path.stem.isdigit() else path.stem
+
+def build_point(
+    path: pathlib.Path,
+    image_vector: list[float],
+    sparse_vector,
+    id: str,
+    metadata: dict,
+) -> PointStruct:
+    return PointStruct(
+        id=point_id(path),
+        vector={
+            DENSE_VECTOR_NAME: image_vector,
+            SPARSE_VECTOR_NAME: models.SparseVector(
+                indices=sparse_vector.indices.tolist(),
+                values=sparse_vector.values.tolist()
+            )
+        },
+        payload=database.build_payload(id, metadata)
+    )
+
 async def save_image_to_vector_db(
     path: pathlib.Path,
     text: str,
-    model: SiglipModel,
-    processor: SiglipProcessor,
+    engine: InferenceEngine,
     bm25_model: SparseTextEmbedding,
     id: str | int,
+    metadata: dict,
 ):
-    image = load_image(str(path))
-    inputs = processor(images=image, return_tensors="pt")
+    #Decode and preprocess off the event loop
+    with metrics.stage('preprocess'):
+        pixels = await preprocess.load_pixels_async(path)
 
     #Get dense vector
-    with torch.no_grad():
-        image_vector = model.get_image_features(**inputs).squeeze().tolist()
+    with metrics.stage('embed_image'):
+        image_vector = (await engine.encode_pixels([pixels]))[0]
 
     #Get sparse vector
-    sparse_vector = list(bm25_model.query_embed(text))[0]
-    sparse_vector_data = models.SparseVector(
-        indices=sparse_vector.indices.tolist(),
-        values=sparse_vector.values.tolist()
-    )
+    with metrics.stage('bm25'):
+        sparse_vector = list(bm25_model.query_embed(text))[0]
 
-    point = PointStruct(
-        id=path.stem,
-        vector={
-            DENSE_VECTOR_NAME: image_vector,
-            SPARSE_VECTOR_NAME: sparse_vector_data
-        },
-        payload={
-            "mongo_id": id,
-        }
-    )
+    point = build_point(path, image_vector, sparse_vector, id, metadata)
     
-    #In traffic-heavy application, upload this in batches
-    return vector_db.client.upsert(
-        collection_name=IMAGE_COLLECTION_NAME,
-        points=[point],
-        wait=False
-    )
+    #Bulk ingestion goes through ingest_service, which upserts in batches
+    with metrics.stage('qdrant'):
+        return await vector_db.client.upsert(
+            collection_name=COLLECTION_NAME,
+            points=[point],
+            wait=False
+        )
 
 async def handle_image_creation(
     image_data: str,
     file: UploadFile,
-    model: SiglipModel,
-    processor: SiglipProcessor,
+    engine: InferenceEngine,
     bm25_model: SparseTextEmbedding
 ):
+    metrics.set_operation('ingest')
     image = ImageModel.model_validate_json(image_data)
     
     #Save file to disk
-    image.url, disk_path = await save_image_to_disk(file)
+    with metrics.stage('upload'):
+        image.url, disk_path = await save_image_to_disk(file)
 
     #Save metadata to mongoDB
     try:
-        created_image = await save_metadata_to_db(image)
+        with metrics.stage('mongo'):
+            created_image = await save_metadata_to_db(image)
     except Exception as e: #rollback
         os.unlink(str(disk_path))
         raise e
 
     #Save to vector database
     try:
-        non_text = set(['url'])
-        text = ' '.join([str(v) for k,v in image.model_dump().items() if k not in non_text and v is not None])
-        await save_image_to_vector_db(disk_path, text, model, processor, bm25_model, str(created_image['_id']))
+        text = get_image_text(image)
+        await save_image_to_vector_db(disk_path, text, engine, bm25_model, str(created_image['_id']), created_image)
     except Exception as e: #rollback
         col = database.get_images_collection()
-        col.delete_one({'_id': created_image['_id']})
+        await col.delete_one({'_id': created_image['_id']})
+        await database.invalidate_document(str(created_image['_id']))
         os.unlink(str(disk_path))
 
         raise e
 
+    with metrics.stage('derivatives'):
+        await derivatives.generate_many([disk_path])
+
     return created_image
 
-async def get_related(image_id: str, n: int, page: int):    
-    #First check if this is id is valid in mongoDB
-    await get_from_id(image_id)
-    
-    #Search for the image in the qdrant database
+async def get_point_id(image_id: str):
+    """Get the qdrant point id of an image, from its mongo id"""
     scroll_filter = Filter(
         must=[
             FieldCondition(
@@ -171,34 +235,78 @@ async def get_related(image_id: str, n: int, page: int):
         ]
     )
 
-    records, _ = vector_db.client.scroll(
-        collection_name=IMAGE_COLLECTION_NAME,
-        scroll_filter=scroll_filter,
-        limit=1,
-        with_payload=True,
-        with_vectors=[DENSE_VECTOR_NAME]
-    )
+    #Only the id is needed, so neither payload nor vector go over the wire
+    with metrics.stage('qdrant_lookup'):
+        records, _ = await vector_db.client.scroll(
+            collection_name=COLLECTION_NAME,
+            scroll_filter=scroll_filter,
+            limit=1,
+            with_payload=False,
+            with_vectors=False
+        )
 
     if not records:
-        raise exceptions.ItemNotFoundError(f"The image id ${image_id} was found in the metadata database, but not in the vector database. Please contact an administrator")
-    
-    vector_data = records[0]
-    
-    #To exclude the vector we just retrieved
-    exclude_filter = Filter(
-        must_not=[
-            HasIdCondition(
-                has_id=[vector_data.id]
+        raise exceptions.ItemNotFoundError(f"Image with id {image_id} not found.")
+
+    return records[0].id
+
+async def get_related(image_id: str, n: int, page: int, cursor: str | None = None, params: models.SearchParams | None = None):
+    if not ObjectId.is_valid(image_id):
+        raise exceptions.InvalidIDError(f"Invalid image ID format: {image_id}")
+
+    metrics.set_operation('related')
+
+    #Each image is served by a single source, so paging never mixes the precomputed neighbors with a live ranking
+    store = neighbors.get_neighbor_store()
+    if store is not None and store.has(image_id):
+        key = await pagination.result_key('related', 'neighbors', store.k, image_id)
+
+        async def run():
+            offset = pagination.get_offset(key, n, page, cursor)
+            hits = store.get(image_id, offset, n)
+            #The store only holds the top k neighbors
+            has_more = len(hits) == n and offset + n < min(store.k, pagination.SEARCH_MAX_OFFSET)
+            next_cursor = pagination.encode_cursor(key, offset + n) if has_more else None
+            return await database.hydrate_from_qdrant(hits), next_cursor
+
+        return await coalesce(search_flights, pagination.page_key(key, n, page, cursor), run)
+
+    params = params or search_service.search_params()
+    key = await pagination.result_key('related', image_id, search_service.params_key(params))
+
+    async def run():
+        point_id = None
+
+        async def fetch(limit: int, offset: int):
+            #Looked up on the first window this request fetches, and reused for the next ones
+            nonlocal point_id
+            if point_id is None:
+                point_id = await get_point_id(image_id)
+
+            #To exclude the image we are querying from
+            exclude_filter = Filter(
+                must_not=[
+                    HasIdCondition(
+                        has_id=[point_id]
+                    )
+                ]
             )
-        ]
-    )
 
-    hits = vector_db.client.search(
-        collection_name=IMAGE_COLLECTION_NAME,
-        query_vector=(DENSE_VECTOR_NAME, vector_data.vector[DENSE_VECTOR_NAME]),
-        query_filter=exclude_filter,
-        limit=n,
-        offset=(page - 1)*n,
-    )
+            #Querying by point id lets qdrant look up the vector itself
+            with metrics.stage('qdrant'):
+                hits = await vector_db.client.query_points(
+                    collection_name=COLLECTION_NAME,
+                    query=point_id,
+                    using=DENSE_VECTOR_NAME,
+                    query_filter=exclude_filter,
+                    search_params=params,
+                    limit=limit,
+                    offset=offset,
+                    with_payload=True,
+                )
+            return hits.points
+
+        hits, next_cursor = await pagination.fetch_page(key, fetch, n, page, cursor)
+        return await database.hydrate_from_qdrant(hits), next_cursor
 
-    return await database.hydrate_from_qdrant(hits)
\ No newline at end of file
+    return await coalesce(search_flights, pagination.page_key(key, n, page, cursor), run)
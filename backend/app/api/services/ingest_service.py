@@ -0,0 +1,353 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import zipfile
+from bson import ObjectId
+from fastapi import UploadFile
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from qdrant_client.http.models import PointStruct
+from ..models.images import ImageModel
+from ...db import vector_db
+from ...config import COLLECTION_NAME
+from ...inference import preprocess
+from . import exceptions, image_service
+from ..utils import admission, database, derivatives
+from ... import metrics
+
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from ...inference.engine import InferenceEngine
+
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 32))
+INGEST_UPSERT_BATCH_SIZE = int(os.environ.get('INGEST_UPSERT_BATCH_SIZE', 256))
+INGEST_UPSERT_INTERVAL = float(os.environ.get('INGEST_UPSERT_INTERVAL', 1.0))
+
+#An image waiting to be ingested: (original filename, metadata, path on disk)
+PendingImage = tuple[str, ImageModel, pathlib.Path]
+
+class VectorWriteQueue:
+    """
+    Write-behind buffer for qdrant. Points are upserted in batches of `batch_size`, or every `interval`
+    seconds if fewer are waiting. `put` returns a future that resolves once the point is written.
+    """
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending: list[tuple[PointStruct, asyncio.Future]] = []
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+        self._closing = False
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    def put(self, point: PointStruct) -> asyncio.Future:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((point, future))
+        metrics.VECTOR_WRITE_QUEUE_DEPTH.set(len(self._pending))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+        return future
+
+    async def flush(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            metrics.VECTOR_WRITE_QUEUE_DEPTH.set(len(self._pending))
+            try:
+                with metrics.stage('qdrant'):
+                    await vector_db.client.upsert(
+                        collection_name=COLLECTION_NAME,
+                        points=[point for point, _ in batch],
+                        wait=True
+                    )
+            except Exception as e:
+                logging.error(f"Failed to upsert a batch of {len(batch)} points: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(True)
+
+    async def _run(self):
+        #The worker outlives the request that started it, so its writes are timed on their own
+        metrics.start('vector_writes')
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        """Stops the background worker once its current write is done, then writes whatever is still buffered"""
+        if self._worker is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._worker
+            self._worker = None
+            self._closing = False
+        await self.flush()
+
+vector_write_queue = VectorWriteQueue(INGEST_UPSERT_BATCH_SIZE, INGEST_UPSERT_INTERVAL)
+
+#Keep references to running jobs, so they are not garbage collected mid-way
+_running_jobs: set[asyncio.Task] = set()
+
+async def get_job(job_id: str):
+    if not ObjectId.is_valid(job_id):
+        raise exceptions.InvalidIDError(f"Invalid job ID format: {job_id}")
+
+    job = await database.get_jobs_collection().find_one({'_id': ObjectId(job_id)})
+    if job is None:
+        raise exceptions.ItemNotFoundError(f"Ingestion job with id {job_id} not found.")
+
+    return job
+
+async def fail_image(job_id: ObjectId, item: PendingImage, detail: str, mongo_id: ObjectId | None = None):
+    """Rolls back everything that was saved for an image, and records the error in the job"""
+    filename, _, path = item
+    if mongo_id is not None:
+        await database.get_images_collection().delete_one({'_id': mongo_id})
+        await database.invalidate_document(str(mongo_id))
+    path.unlink(missing_ok=True)
+
+    await database.get_jobs_collection().update_one(
+        {'_id': job_id},
+        {'$inc': {'failed': 1}, '$push': {'errors': {'filename': filename, 'detail': detail}}}
+    )
+
+async def finalize_batch(job_id: ObjectId, written: list[tuple[PendingImage, ObjectId, asyncio.Future]]):
+    """Waits for the vectors of a batch to be written, rolling back the images that failed, and writes the derivatives of the rest"""
+    results = await asyncio.gather(*[future for _, _, future in written], return_exceptions=True)
+
+    indexed = []
+    for (item, mongo_id, _), result in zip(written, results):
+        if isinstance(result, Exception):
+            await fail_image(job_id, item, f"Failed to index image: {result}", mongo_id)
+        else:
+            indexed.append(item[2])
+
+    with metrics.stage('derivatives'):
+        await derivatives.generate_many(indexed)
+    await database.get_jobs_collection().update_one({'_id': job_id}, {'$inc': {'processed': len(indexed)}})
+
+async def ingest_batch(
+    job_id: ObjectId,
+    batch: list[PendingImage],
+    engine: InferenceEngine,
+    bm25_model: SparseTextEmbedding,
+) -> asyncio.Task | None:
+    """
+    Decodes, embeds and saves the metadata of a batch of images, then queues their vectors.
+    Returns the task that finalizes the batch once its vectors are written.
+    """
+    #Decode and preprocess in parallel, off the event loop
+    with metrics.stage('preprocess'):
+        decoded = await asyncio.gather(
+            *[preprocess.load_pixels_async(path) for _, _, path in batch],
+            return_exceptions=True
+        )
+
+    items = []
+    for item, pixels in zip(batch, decoded):
+        if isinstance(pixels, Exception):
+            await fail_image(job_id, item, f"Failed to decode image: {pixels}")
+        else:
+            items.append((item, pixels))
+
+    if not items:
+        return None
+
+    try:
+        with metrics.stage('embed_image'):
+            vectors = await engine.encode_pixels([pixels for _, pixels in items])
+        texts = [image_service.get_image_text(image_model) for (_, image_model, _), _ in items]
+        with metrics.stage('bm25'):
+            sparse_vectors = await asyncio.to_thread(lambda: list(bm25_model.query_embed(texts)))
+    except Exception as e:
+        for item, _ in items:
+            await fail_image(job_id, item, f"Failed to embed image: {e}")
+        return None
+
+    #Save metadata to mongoDB. insert_many sets the _id of each document in place
+    col = database.get_images_collection()
+    docs = [image_model.model_dump(exclude=['id'], by_alias=True) for (_, image_model, _), _ in items]
+    try:
+        with metrics.stage('mongo'):
+            await col.insert_many(docs, ordered=False)
+        write_errors = {}
+    except BulkWriteError as e:
+        write_errors = {error['index']: error['errmsg'] for error in e.details['writeErrors']}
+    except Exception as e:
+        await col.delete_many({'_id': {'$in': [doc['_id'] for doc in docs if '_id' in doc]}})
+        for item, _ in items:
+            await fail_image(job_id, item, f"Failed to save metadata: {e}")
+        return None
+
+    written = []
+    for i, ((item, _), vector, sparse_vector, doc) in enumerate(zip(items, vectors, sparse_vectors, docs)):
+        if i in write_errors:
+            await fail_image(job_id, item, f"Failed to save metadata: {write_errors[i]}")
+            continue
+
+        point = image_service.build_point(item[2], vector, sparse_vector, str(doc['_id']), doc)
+        written.append((item, doc['_id'], vector_write_queue.put(point)))
+
+    return asyncio.create_task(finalize_batch(job_id, written))
+
+async def wait_for_batches(batches: list[asyncio.Task]):
+    """
+    Waits for every batch, and for its vectors to be written or rolled back. Unlike gather, being cancelled
+    doesn't cancel the batches, so they can still be waited for afterwards
+    """
+    if batches:
+        await asyncio.wait(batches)
+    finalizers = [batch.result() for batch in batches if batch.result() is not None]
+    if finalizers:
+        await asyncio.wait(finalizers)
+    for finalizer in finalizers:
+        finalizer.result()
+
+async def run_ingestion(
+    job_id: ObjectId,
+    items: list[PendingImage],
+    engine: InferenceEngine,
+    bm25_model: SparseTextEmbedding,
+):
+    #A job of its own, its stages are not part of the request that started it
+    metrics.start('ingest_bulk')
+    jobs = database.get_jobs_collection()
+    batches = []
+    #Items from here on were not handed to a batch yet
+    next_start = 0
+    try:
+        for start in range(0, len(items), INGEST_BATCH_SIZE):
+            #Batches share the ingest budget with uploads, waiting for a slot instead of being rejected
+            async with admission.ingest_budget.slot(bounded=False):
+                #Shielded, so that a shutdown can't stop a batch between its mongo and qdrant writes
+                batch = asyncio.create_task(ingest_batch(job_id, items[start:start + INGEST_BATCH_SIZE], engine, bm25_model))
+                batches.append(batch)
+                next_start = start + INGEST_BATCH_SIZE
+                await asyncio.shield(batch)
+
+        await wait_for_batches(batches)
+        await jobs.update_one({'_id': job_id}, {'$set': {'status': 'completed'}})
+    except asyncio.CancelledError:
+        #Shutting down: let the started batches finish, keeping the images whose vectors get written and rolling
+        #back the others, and give up on the images not started yet
+        logging.warning(f"Ingestion job {job_id} interrupted, {len(items) - next_start} images were not indexed")
+        await vector_write_queue.flush()
+        await wait_for_batches(batches)
+
+        abandoned = items[next_start:]
+        for _, _, path in abandoned:
+            path.unlink(missing_ok=True)
+        detail = "Interrupted by a shutdown before being indexed"
+        await jobs.update_one(
+            {'_id': job_id},
+            {
+                '$set': {'status': 'failed'},
+                '$inc': {'failed': len(abandoned)},
+                '$push': {'errors': {'$each': [{'filename': filename, 'detail': detail} for filename, _, _ in abandoned]}},
+            }
+        )
+        raise
+    except Exception as e:
+        logging.exception(f"Ingestion job {job_id} failed")
+        await jobs.update_one({'_id': job_id}, {'$set': {'status': 'failed'}, '$push': {'errors': {'filename': '', 'detail': str(e)}}})
+
+def parse_metadata(image_data: str) -> dict:
+    try:
+        metadata = json.loads(image_data)
+    except ValueError as e:
+        raise exceptions.InvalidMetadataError(f"image_data is not valid JSON: {e}")
+
+    if not isinstance(metadata, dict):
+        raise exceptions.InvalidMetadataError("image_data must be a JSON object mapping file names to image metadata")
+
+    return metadata
+
+async def iter_uploads(files: list[UploadFile], archive: UploadFile | None):
+    """Yields (filename, chunk reader) for each uploaded file, and for each file inside the archive"""
+    for file in files:
+        yield file.filename, file.read
+
+    if archive is not None:
+        try:
+            zf = zipfile.ZipFile(archive.file)
+        except zipfile.BadZipFile as e:
+            raise exceptions.InvalidMediaType(f"Invalid archive: {e}")
+
+        with zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as entry:
+                    yield info.filename, lambda n, entry=entry: asyncio.to_thread(entry.read, n)
+
+async def start_bulk_ingestion(
+    image_data: str,
+    files: list[UploadFile],
+    archive: UploadFile | None,
+    engine: InferenceEngine,
+    bm25_model: SparseTextEmbedding,
+):
+    """
+    Saves every uploaded image to disk and starts a background job that indexes them.
+    Images are validated one by one, so a bad image only fails itself. Returns the job.
+    """
+    metrics.set_operation('ingest_bulk_upload')
+    metadata = parse_metadata(image_data)
+
+    items: list[PendingImage] = []
+    errors = []
+    async for filename, read in iter_uploads(files, archive):
+        if filename not in metadata:
+            errors.append({'filename': filename, 'detail': "No metadata provided for this file"})
+            continue
+
+        try:
+            image = ImageModel.model_validate(metadata[filename])
+            image.url, disk_path = await image_service.save_image_stream_to_disk(filename, read)
+        except (ValidationError, exceptions.InvalidMediaType, exceptions.FileTooLargeError) as e:
+            errors.append({'filename': filename, 'detail': str(e)})
+            continue
+
+        items.append((filename, image, disk_path))
+
+    job = {
+        'status': 'running',
+        'total': len(items) + len(errors),
+        'processed': 0,
+        'failed': len(errors),
+        'errors': errors,
+    }
+    result = await database.get_jobs_collection().insert_one(job)
+
+    task = asyncio.create_task(run_ingestion(result.inserted_id, items, engine, bm25_model))
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+
+    return job
+
+async def shutdown():
+    """Interrupts the running jobs, which roll back what they can't finish, then writes the buffered vectors"""
+    jobs = list(_running_jobs)
+    for task in jobs:
+        task.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+
+    await vector_write_queue.close()
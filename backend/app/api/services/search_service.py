@@ -1,159 +1,407 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
 from fastapi import UploadFile
-from fastembed import SparseTextEmbedding
-from transformers import SiglipModel, SiglipProcessor, SiglipTokenizer
 from qdrant_client import models
-import torch
 from ..models.images import RetrievedImageModel
+from ..models.search import FacetCountModel, FacetFilterModel, SearchQueryModel
 from ...db import vector_db
-import magic
-from . import exceptions
-from transformers.image_utils import load_image
-from PIL import Image
-import io
-from ..utils import database
+from ...inference import backends, preprocess
+import json
+import os
+import pathlib
+from ..utils import database, uploads
+from ..utils.cache import coalesce, embedding_cache, search_flights
+from ..utils import pagination
+from ... import dependencies, metrics
+from ...config import COLLECTION_NAME, DENSE_VECTOR_NAME, SPARSE_VECTOR_NAME
 
-#TODO push these constants up, as they need to match the seeder
-DENSE_VECTOR_NAME="image_embedding"
-SPARSE_VECTOR_NAME="text_bm25"
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from ...inference.engine import InferenceEngine
 
-COLLECTION_NAME = 'image_hub'
 
-def get_text_query_dense_embeddings(
+#Search-time settings of dense searches. Unset values fall back to qdrant's defaults
+SEARCH_HNSW_EF = os.environ.get('SEARCH_HNSW_EF')
+#Only used when the collection is quantized: rescore the candidates with the original vectors, fetching oversampling * limit of them
+SEARCH_RESCORE = os.environ.get('SEARCH_RESCORE', 'true').lower() == 'true'
+SEARCH_OVERSAMPLING = os.environ.get('SEARCH_OVERSAMPLING')
+
+def search_params(
+    hnsw_ef: int | None = int(SEARCH_HNSW_EF) if SEARCH_HNSW_EF else None,
+    rescore: bool = SEARCH_RESCORE,
+    oversampling: float | None = float(SEARCH_OVERSAMPLING) if SEARCH_OVERSAMPLING else None,
+) -> models.SearchParams:
+    """HNSW and quantization parameters of a dense search. Defaults come from SEARCH_HNSW_EF, SEARCH_RESCORE and SEARCH_OVERSAMPLING"""
+    return models.SearchParams(
+        hnsw_ef=hnsw_ef,
+        quantization=models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling),
+    )
+
+def params_key(params: models.SearchParams) -> str:
+    """Search params as part of a cache key, as they change the results"""
+    return params.model_dump_json(exclude_none=True)
+
+def normalize_query(query: str) -> str:
+    """Both SigLIP and BM25 are case insensitive, so queries differing only in case/spacing share a cache entry"""
+    return ' '.join(query.lower().split())
+
+def build_filter(facets: FacetFilterModel | None) -> models.Filter | None:
+    """Qdrant filter matching every given facet, each against any of its values"""
+    if facets is None:
+        return None
+
+    conditions = [
+        models.FieldCondition(key=field, match=models.MatchAny(any=values))
+        for field, values in facets.model_dump(exclude_none=True).items()
+        if values
+    ]
+    return models.Filter(must=conditions) if conditions else None
+
+def filter_key(facets: FacetFilterModel | None) -> str:
+    """Canonical form of the facets, so they can be part of a cache key"""
+    if facets is None:
+        return ''
+
+    facets = {field: sorted(values) for field, values in facets.model_dump(exclude_none=True).items() if values}
+    return json.dumps(facets, sort_keys=True) if facets else ''
+
+def encoder_key(tower: str) -> str:
+    """Everything about the encoder that changes a query's embedding, so it can be part of a cache key"""
+    key = f'{dependencies.MODEL}:{backends.ENCODER_BACKEND}'
+    return f'{key}:{backends.INFERENCE_TEXT_PADDING}' if tower == 'text' else key
+
+async def get_text_query_dense_embeddings(
     query: str,
-    model: SiglipModel,
-    tokenizer: SiglipTokenizer
+    engine: InferenceEngine
 ):
     """
     Get the dense embeddings from a text query
     """
-    inputs = tokenizer(query, padding='max_length', return_tensors='pt')
-    with torch.no_grad():
-        text_features = model.get_text_features(**inputs)[0]
-    
-    return text_features.tolist()
+    return (await get_text_queries_dense_embeddings([query], engine))[0]
+
+async def get_text_queries_dense_embeddings(
+    queries: list[str],
+    engine: InferenceEngine
+):
+    """
+    Get the dense embeddings of many text queries. The ones not cached are encoded in a single batch
+    """
+    queries = [normalize_query(query) for query in queries]
+    keys = [f'dense:text:{encoder_key("text")}:{query}' for query in queries]
+
+    embeddings = [await embedding_cache.get(key) for key in keys]
+    missing = list(dict.fromkeys(query for query, cached in zip(queries, embeddings) if cached is None))
+    if missing:
+        with metrics.stage('embed_text'):
+            encoded = dict(zip(missing, await engine.encode_texts(missing)))
+        for i, (query, key) in enumerate(zip(queries, keys)):
+            if embeddings[i] is None:
+                embeddings[i] = encoded[query]
+                await embedding_cache.set(key, encoded[query])
 
-def get_text_query_sparse_vector(
+    return embeddings
+
+async def get_text_query_sparse_vector(
     query: str,
     bm25_model: SparseTextEmbedding
 ):
     """
     Get the sparse vector from a text query
     """
-    sparse_vector = list(bm25_model.query_embed(query))[0]
+    return (await get_text_queries_sparse_vectors([query], bm25_model))[0]
 
-    return models.SparseVector(
-        indices=sparse_vector.indices.tolist(),
-        values=sparse_vector.values.tolist()
-    )
+async def get_text_queries_sparse_vectors(
+    queries: list[str],
+    bm25_model: SparseTextEmbedding
+):
+    """
+    Get the sparse vectors of many text queries. The ones not cached are embedded in a single call
+    """
+    queries = [normalize_query(query) for query in queries]
+    keys = [f'sparse:{query}' for query in queries]
+
+    vectors = [await embedding_cache.get(key) for key in keys]
+    missing = list(dict.fromkeys(query for query, cached in zip(queries, vectors) if cached is None))
+    if missing:
+        with metrics.stage('bm25'):
+            embedded = {
+                query: {'indices': vector.indices.tolist(), 'values': vector.values.tolist()}
+                for query, vector in zip(missing, bm25_model.query_embed(missing))
+            }
+        for i, (query, key) in enumerate(zip(queries, keys)):
+            if vectors[i] is None:
+                vectors[i] = embedded[query]
+                await embedding_cache.set(key, embedded[query])
+
+    return [models.SparseVector(**vector) for vector in vectors]
+
+async def get_image_query_dense_embeddings(
+    path: pathlib.Path,
+    digest: str,
+    engine: InferenceEngine
+):
+    """
+    Get the dense embeddings from an image file, keyed on the hash of its content
+    """
+    key = f'dense:image:{encoder_key("vision")}:{digest}'
+
+    cached = await embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with metrics.stage('preprocess'):
+        pixels = await preprocess.load_pixels_async(path)
+    with metrics.stage('embed_image'):
+        image_vector = (await engine.encode_pixels([pixels]))[0]
+    await embedding_cache.set(key, image_vector)
+
+    return image_vector
 
 async def semantic_search(
     query: str,
     n: int,
     page: int,
-    model: SiglipModel,
-    tokenizer: SiglipTokenizer
-) -> list[RetrievedImageModel]:
+    engine: InferenceEngine,
+    cursor: str | None = None,
+    facets: FacetFilterModel | None = None,
+    params: models.SearchParams | None = None,
+) -> tuple[list[RetrievedImageModel], str | None]:
     "Applies semantic search over a query"
+    metrics.set_operation('search_semantic')
 
-    text_features = get_text_query_dense_embeddings(query, model, tokenizer)
-    
-    hits = vector_db.client.search(
-        collection_name=COLLECTION_NAME,
-        query_vector = (DENSE_VECTOR_NAME, text_features),
-        limit=n,
-        offset=(page - 1)*n,
-    )
+    query_filter = build_filter(facets)
+    params = params or search_params()
+
+    async def fetch(limit: int, offset: int):
+        text_features = await get_text_query_dense_embeddings(query, engine)
+
+        with metrics.stage('qdrant'):
+            return await vector_db.client.search(
+                collection_name=COLLECTION_NAME,
+                query_vector = (DENSE_VECTOR_NAME, text_features),
+                query_filter=query_filter,
+                search_params=params,
+                limit=limit,
+                offset=offset,
+            )
+
+    key = await pagination.result_key('semantic', encoder_key('text'), normalize_query(query), filter_key(facets), params_key(params))
+    async def run():
+        hits, next_cursor = await pagination.fetch_page(key, fetch, n, page, cursor)
+        return await database.hydrate_from_qdrant(hits), next_cursor
 
-    return await database.hydrate_from_qdrant(hits)
+    #Identical concurrent searches share a single computation
+    return await coalesce(search_flights, pagination.page_key(key, n, page, cursor), run)
 
 async def semantic_search_from_image(
     file: UploadFile,
     n: int,
     page: int,
-    model: SiglipModel,
-    processor: SiglipProcessor,
-) -> list[RetrievedImageModel]:
+    engine: InferenceEngine,
+    cursor: str | None = None,
+    facets: FacetFilterModel | None = None,
+    params: models.SearchParams | None = None,
+) -> tuple[list[RetrievedImageModel], str | None]:
     "Applies semantic search over an image query"
+    metrics.set_operation('search_image')
 
-    contents = await file.read()
+    #Stream the upload to disk instead of holding it in memory. It is only needed until the query is encoded
+    with metrics.stage('upload'):
+        path, digest = await uploads.stream_to_temp_file(file.read)
 
-    mime = magic.from_buffer(contents, mime=True)
-    if mime != 'image/jpeg':
-        raise exceptions.InvalidMediaType(f"Invalid MIME type: {mime}. Only image/jpeg is supported")
-    
-    image = load_image(Image.open(io.BytesIO(contents)))
-    inputs = processor(images=image, return_tensors="pt")
+    query_filter = build_filter(facets)
+    params = params or search_params()
 
-    with torch.no_grad():
-        image_vector = model.get_image_features(**inputs).squeeze().tolist()
+    async def fetch(limit: int, offset: int):
+        image_vector = await get_image_query_dense_embeddings(path, digest, engine)
 
-    hits = vector_db.client.search(
-        collection_name=COLLECTION_NAME,
-        query_vector=(DENSE_VECTOR_NAME, image_vector),
-        limit=n,
-        offset=(page - 1)*n,
-    )
+        with metrics.stage('qdrant'):
+            return await vector_db.client.search(
+                collection_name=COLLECTION_NAME,
+                query_vector=(DENSE_VECTOR_NAME, image_vector),
+                query_filter=query_filter,
+                search_params=params,
+                limit=limit,
+                offset=offset,
+            )
+
+    try:
+        key = await pagination.result_key('image', encoder_key('vision'), digest, filter_key(facets), params_key(params))
+        hits, next_cursor = await pagination.fetch_page(key, fetch, n, page, cursor)
+    finally:
+        path.unlink(missing_ok=True)
 
-    return await database.hydrate_from_qdrant(hits)
+    return await database.hydrate_from_qdrant(hits), next_cursor
 
 async def keyword_search(
     query: str,
     n: int,
     page: int,
     bm25_model: SparseTextEmbedding,
+    cursor: str | None = None,
+    facets: FacetFilterModel | None = None,
 ):
     """
     Perform traditional keyword search on metadata using BM25
     """
+    metrics.set_operation('search_keyword')
 
-    query_sparse_vector = get_text_query_sparse_vector(query, bm25_model)
+    query_filter = build_filter(facets)
 
-    hits = vector_db.client.search(
-        collection_name=COLLECTION_NAME,
-        query_vector=models.NamedSparseVector(name=SPARSE_VECTOR_NAME, vector=query_sparse_vector),
-        limit=n,
-        offset=(page - 1) * n,
-    )
-    
-    return await database.hydrate_from_qdrant(hits)
+    async def fetch(limit: int, offset: int):
+        query_sparse_vector = await get_text_query_sparse_vector(query, bm25_model)
+
+        with metrics.stage('qdrant'):
+            return await vector_db.client.search(
+                collection_name=COLLECTION_NAME,
+                query_vector=models.NamedSparseVector(name=SPARSE_VECTOR_NAME, vector=query_sparse_vector),
+                query_filter=query_filter,
+                limit=limit,
+                offset=offset,
+            )
+
+    key = await pagination.result_key('keyword', normalize_query(query), filter_key(facets))
+    async def run():
+        hits, next_cursor = await pagination.fetch_page(key, fetch, n, page, cursor)
+        return await database.hydrate_from_qdrant(hits), next_cursor
+
+    #Identical concurrent searches share a single computation
+    return await coalesce(search_flights, pagination.page_key(key, n, page, cursor), run)
+
+def hybrid_prefetch(
+    query_dense: list[float],
+    query_sparse: models.SparseVector,
+    limit: int,
+    query_filter: models.Filter | None = None,
+    params: models.SearchParams | None = None,
+) -> list[models.Prefetch]:
+    """The dense and BM25 candidates that hybrid search fuses with RRF. Filtering here keeps RRF from fusing candidates that would be dropped"""
+    return [
+        models.Prefetch(
+            query=query_dense,
+            using=DENSE_VECTOR_NAME,
+            filter=query_filter,
+            params=params,
+            limit=limit
+        ),
+        models.Prefetch(
+            query=query_sparse,
+            using=SPARSE_VECTOR_NAME,
+            filter=query_filter,
+            limit=limit
+        )
+    ]
 
 async def hybrid_search(
     query: str,
     n: int,
     page: int,
-    model: SiglipModel,
-    tokenizer: SiglipTokenizer,
-    bm25_model: SparseTextEmbedding
+    engine: InferenceEngine,
+    bm25_model: SparseTextEmbedding,
+    cursor: str | None = None,
+    facets: FacetFilterModel | None = None,
+    params: models.SearchParams | None = None,
 ):
     """
     Perform hybrid search from a text query. Does BM25 and dense retrieval, combining both with RRF
     """
+    metrics.set_operation('search_hybrid')
+
+    query_filter = build_filter(facets)
+    params = params or search_params()
 
-    query_dense = get_text_query_dense_embeddings(query, model, tokenizer)
-    query_sparse = get_text_query_sparse_vector(query, bm25_model)
-    num_to_fetch = page * n * 2 #Fetch twice as much, to allow RRF to kick in
-
-    hybrid_hits = vector_db.client.query_points(
-        collection_name=COLLECTION_NAME,
-        prefetch=[
-            models.Prefetch(
-                query=query_dense,
-                using=DENSE_VECTOR_NAME,
-                limit=num_to_fetch
-            ),
-            models.Prefetch(
-                query=query_sparse,
-                using=SPARSE_VECTOR_NAME,
-                limit=num_to_fetch
+    async def fetch(limit: int, offset: int):
+        query_dense = await get_text_query_dense_embeddings(query, engine)
+        query_sparse = await get_text_query_sparse_vector(query, bm25_model)
+        num_to_fetch = (offset + limit) * 2 #Fetch twice as much, to allow RRF to kick in
+
+        with metrics.stage('qdrant'):
+            hybrid_hits = await vector_db.client.query_points(
+                collection_name=COLLECTION_NAME,
+                prefetch=hybrid_prefetch(query_dense, query_sparse, num_to_fetch, query_filter, params),
+                query=models.FusionQuery(
+                    fusion=models.Fusion.RRF
+                ),
+                limit=limit,
+                with_payload=True,
+                offset=offset,
             )
-        ],
-        query=models.FusionQuery(
-            fusion=models.Fusion.RRF
-        ),
-        limit=n,
-        with_payload=True,
-        offset=(page - 1) * n,
-    )
+        return hybrid_hits.points
+
+    key = await pagination.result_key('hybrid', encoder_key('text'), normalize_query(query), filter_key(facets), params_key(params))
+    async def run():
+        hits, next_cursor = await pagination.fetch_page(key, fetch, n, page, cursor)
+        return await database.hydrate_from_qdrant(hits), next_cursor
+
+    #Identical concurrent searches share a single computation
+    return await coalesce(search_flights, pagination.page_key(key, n, page, cursor), run)
+
+async def batch_search(
+    queries: list[SearchQueryModel],
+    engine: InferenceEngine,
+    bm25_model: SparseTextEmbedding,
+    params: models.SearchParams | None = None,
+) -> list[list[RetrievedImageModel]]:
+    """
+    Runs many text searches at once: all texts are encoded in one batch, searched with a single qdrant batch query,
+    and hydrated with a single mongo query. Returns the results of each query, in order
+    """
+    metrics.set_operation('search_batch')
+    dense_queries = [q.query for q in queries if q.type in ('semantic', 'hybrid')]
+    sparse_queries = [q.query for q in queries if q.type in ('keyword', 'hybrid')]
+    dense = iter(await get_text_queries_dense_embeddings(dense_queries, engine) if dense_queries else [])
+    sparse = iter(await get_text_queries_sparse_vectors(sparse_queries, bm25_model) if sparse_queries else [])
+    params = params or search_params()
+
+    requests = []
+    for q in queries:
+        offset = (q.page - 1) * q.n
+        query_filter = build_filter(q.filters)
+        if q.type == 'semantic':
+            request = models.QueryRequest(
+                query=next(dense), using=DENSE_VECTOR_NAME, filter=query_filter, params=params, limit=q.n, offset=offset, with_payload=True
+            )
+        if q.type == 'keyword':
+            request = models.QueryRequest(
+                query=next(sparse), using=SPARSE_VECTOR_NAME, filter=query_filter, limit=q.n, offset=offset, with_payload=True
+            )
+        if q.type == 'hybrid':
+            request = models.QueryRequest(
+                prefetch=hybrid_prefetch(next(dense), next(sparse), (offset + q.n) * 2, query_filter, params),
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=q.n,
+                offset=offset,
+                with_payload=True,
+            )
+        requests.append(request)
+
+    with metrics.stage('qdrant'):
+        responses = await vector_db.client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+
+    return await database.hydrate_many_from_qdrant([response.points for response in responses])
+
+async def facet_counts(
+    field: str,
+    limit: int,
+    facets: FacetFilterModel | None = None,
+    exact: bool = False,
+) -> list[FacetCountModel]:
+    """
+    Most common values of a facet, with their number of images, among the images matching the other facets.
+    Counts are approximate unless `exact` is set
+    """
+    metrics.set_operation('facets')
+    #A facet never filters its own counts, so every value stays selectable
+    if facets is not None:
+        facets = facets.model_copy(update={field: None})
 
-    return await database.hydrate_from_qdrant(hybrid_hits.points)
+    with metrics.stage('qdrant'):
+        response = await vector_db.client.facet(
+            collection_name=COLLECTION_NAME,
+            key=field,
+            facet_filter=build_filter(facets),
+            limit=limit,
+            exact=exact,
+        )
 
+    return [{'value': hit.value, 'count': hit.count} for hit in response.hits]
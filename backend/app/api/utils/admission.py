@@ -0,0 +1,144 @@
+"""
+Admission control for the routes that run encodes, so a burst of them can't take every core from cheap reads.
+
+Each budget lets `concurrency` requests run at once and up to `queue_size` more wait, for at most `queue_timeout`
+seconds. Anything beyond is rejected straight away: 429 when the queue is full, 503 when the wait timed out, both
+with a Retry-After estimated from how long requests hold their slot. Search and ingestion have separate budgets, so
+uploads can't starve interactive searches. Budgets are per worker.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from ..services import exceptions
+from ... import metrics
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'true').lower() == 'true'
+
+#Requests with encodes batch together in the inference engine, so the search budget is best kept above INFERENCE_MAX_BATCH_SIZE
+SEARCH_CONCURRENCY = int(os.environ.get('SEARCH_CONCURRENCY', 64))
+SEARCH_QUEUE_SIZE = int(os.environ.get('SEARCH_QUEUE_SIZE', 128))
+SEARCH_QUEUE_TIMEOUT = float(os.environ.get('SEARCH_QUEUE_TIMEOUT', 2))
+
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 4))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 16))
+INGEST_QUEUE_TIMEOUT = float(os.environ.get('INGEST_QUEUE_TIMEOUT', 10))
+
+class Budget:
+    """A concurrency limit with a bounded waiting queue. Freed slots are handed to waiters in arrival order"""
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        #Moving average of how long a slot is held, for Retry-After
+        self._hold_seconds = 1.0
+
+        #Stats
+        self.admitted = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue has likely drained"""
+        return max(1, math.ceil(self._hold_seconds * (len(self._waiters) + 1) / self.concurrency))
+
+    def _reject(self, error: type[exceptions.OverloadedError], reason: str, message: str):
+        self.rejected += 1
+        metrics.ADMISSION_REJECTED.labels(self.name, reason).inc()
+        raise error(message, self.retry_after())
+
+    def _expire(self, waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_exception(exceptions.OverloadedError(
+                f"Waited more than {self.queue_timeout}s for a {self.name} slot", self.retry_after()
+            ))
+
+    async def acquire(self, bounded: bool = True):
+        """
+        Waits for a slot. Unbounded callers (e.g. background jobs) are never rejected and wait as long as needed,
+        but still count towards the queue size of the others
+        """
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        if bounded and len(self._waiters) >= self.queue_size:
+            self._reject(exceptions.QueueFullError, 'queue_full', f"Too many {self.name} requests waiting, try again later")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        metrics.ADMISSION_WAITING.labels(self.name).inc()
+        timer = loop.call_later(self.queue_timeout, self._expire, waiter) if bounded else None
+        try:
+            await waiter
+        except exceptions.OverloadedError:
+            self.rejected += 1
+            metrics.ADMISSION_REJECTED.labels(self.name, 'timeout').inc()
+            raise
+        except asyncio.CancelledError:
+            #The slot was handed over right as the caller went away (e.g. client disconnected)
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            metrics.ADMISSION_WAITING.labels(self.name).dec()
+            if timer is not None:
+                timer.cancel()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self):
+        #Hand the slot over to the first waiter still waiting, so newcomers can't jump the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, bounded: bool = True):
+        if not ADMISSION_CONTROL:
+            yield
+            return
+
+        await self.acquire(bounded)
+        self.admitted += 1
+        metrics.ADMISSION_IN_FLIGHT.labels(self.name).inc()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * (time.perf_counter() - started)
+            metrics.ADMISSION_IN_FLIGHT.labels(self.name).dec()
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_hold_seconds": self._hold_seconds,
+        }
+
+search_budget = Budget('search', SEARCH_CONCURRENCY, SEARCH_QUEUE_SIZE, SEARCH_QUEUE_TIMEOUT)
+ingest_budget = Budget('ingest', INGEST_CONCURRENCY, INGEST_QUEUE_SIZE, INGEST_QUEUE_TIMEOUT)
+
+async def admit_search():
+    """Dependency of the routes that encode queries"""
+    async with search_budget.slot():
+        yield
+
+async def admit_ingest():
+    """Dependency of the routes that ingest images"""
+    async with ingest_budget.slot():
+        yield
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, TypeVar
+from ... import metrics
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 10_000))
+EMBEDDING_CACHE_TTL = float(os.environ.get('EMBEDDING_CACHE_TTL', 3600))
+#When set, the cache is shared between workers through redis instead of living in-process
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+class TTLCache:
+    """In-process LRU cache where every entry also expires after `ttl` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key: str, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+class RedisCache:
+    """
+    Redis-backed cache, shared between every worker. Values must be JSON serializable.
+    Size-based eviction is left to the redis `maxmemory-policy` (e.g. allkeys-lru).
+    """
+
+    def __init__(self, url: str, ttl: float, namespace: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Any | None:
+        try:
+            raw = await self.client.get(f'{self.namespace}:{key}')
+        except Exception as e:
+            #The cache is an optimization, never fail a request because of it
+            logging.warning(f"Cache read failed: {e}")
+            raw = None
+
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key: str, value: Any):
+        try:
+            await self.client.set(f'{self.namespace}:{key}', json.dumps(value), ex=int(self.ttl))
+        except Exception as e:
+            logging.warning(f"Cache write failed: {e}")
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(f'{self.namespace}:{key}')
+        except Exception as e:
+            logging.warning(f"Cache delete failed: {e}")
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+def make_cache(namespace: str, maxsize: int, ttl: float) -> TTLCache | RedisCache:
+    if CACHE_REDIS_URL:
+        return RedisCache(CACHE_REDIS_URL, ttl, namespace)
+    return TTLCache(maxsize, ttl)
+
+#Dense and sparse query vectors, keyed on the normalized query text or the hash of an uploaded image
+embedding_cache = make_cache('embeddings', EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+
+RESULT_WINDOW_CACHE_SIZE = int(os.environ.get('RESULT_WINDOW_CACHE_SIZE', 2_000))
+RESULT_WINDOW_TTL = float(os.environ.get('RESULT_WINDOW_TTL', 600))
+
+#Ranked windows of search hits, so that deep pages don't need to re-run the vector search
+result_window_cache = make_cache('result_windows', RESULT_WINDOW_CACHE_SIZE, RESULT_WINDOW_TTL)
+
+SEARCH_COALESCING = os.environ.get('SEARCH_COALESCING', 'true').lower() == 'true'
+#Finished results are kept this long, to absorb the tail of a burst of identical requests. 0 to only share in-flight ones
+SEARCH_RESULT_TTL = float(os.environ.get('SEARCH_RESULT_TTL', 2))
+SEARCH_RESULT_CACHE_SIZE = int(os.environ.get('SEARCH_RESULT_CACHE_SIZE', 1_000))
+
+T = TypeVar('T')
+
+class SingleFlight:
+    """
+    Deduplicates concurrent identical calls: the first caller of a key runs the computation, and everyone calling
+    with that key while it runs awaits the same result. Results are then served from a short-lived cache.
+
+    The computation runs in its own task, so a caller that goes away (e.g. client disconnected) doesn't cancel it
+    for the others. Always in-process: it holds live objects, and bursts land on the same worker anyway.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._results = TTLCache(maxsize, ttl) if ttl > 0 else None
+        self.runs = 0
+        self.joined = 0
+        self.cached = 0
+
+    def _done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        #Retrieving the exception keeps asyncio from logging it when every caller is gone
+        if not task.cancelled():
+            task.exception()
+
+    async def _compute(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        result = await fn()
+        if self._results is not None:
+            await self._results.set(key, result)
+        return result
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        if self._results is not None:
+            cached = await self._results.get(key)
+            if cached is not None:
+                self.cached += 1
+                metrics.COALESCED_REQUESTS.labels(self.name, 'cached').inc()
+                return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.joined += 1
+            metrics.COALESCED_REQUESTS.labels(self.name, 'joined').inc()
+        else:
+            self.runs += 1
+            task = asyncio.ensure_future(self._compute(key, fn))
+            self._inflight[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "joined": self.joined, "cached": self.cached, "in_flight": len(self._inflight)}
+
+async def coalesce(flight: SingleFlight, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+    """Runs `fn` through `flight`, or directly when SEARCH_COALESCING is off"""
+    if not SEARCH_COALESCING:
+        return await fn()
+    return await flight.run(key, fn)
+
+#Whole pages of hydrated search and related results
+search_flights = SingleFlight('search', SEARCH_RESULT_CACHE_SIZE, SEARCH_RESULT_TTL)
@@ -1,9 +1,23 @@
 from fastapi import HTTPException
-from ...db import vector_db, db
+from ...db import db
+from ... import metrics
 from qdrant_client import models
-from ..models.images import RetrievedImageModel
+from ..models.images import ImageModel, RetrievedImageModel
+from ..models.search import FACET_FIELDS
+from .cache import TTLCache
 from bson import ObjectId
 import logging
+import os
+
+#Store the fields needed to display an image in the qdrant payload, so searches can skip mongo entirely
+DENORMALIZE_PAYLOAD = os.environ.get('DENORMALIZE_PAYLOAD', 'false').lower() == 'true'
+DISPLAY_FIELDS = [name for name in ImageModel.model_fields if name != 'id']
+
+DOCUMENT_CACHE_SIZE = int(os.environ.get('DOCUMENT_CACHE_SIZE', 10_000))
+DOCUMENT_CACHE_TTL = float(os.environ.get('DOCUMENT_CACHE_TTL', 3600))
+
+#In-process `_id -> document` cache, for payloads that were not denormalized
+document_cache = TTLCache(DOCUMENT_CACHE_SIZE, DOCUMENT_CACHE_TTL)
 
 def get_images_collection():
     try:
@@ -15,23 +29,91 @@ def get_images_collection():
             detail="Database connection is not available."
         )
 
+def get_jobs_collection():
+    try:
+        return db.db.get_collection("ingest_jobs")
+    except RuntimeError as e:
+        logging.error(f"Error getting collection: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Database connection is not available."
+        )
+
+def get_reembed_jobs_collection():
+    try:
+        return db.db.get_collection("reembed_jobs")
+    except RuntimeError as e:
+        logging.error(f"Error getting collection: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Database connection is not available."
+        )
+
+def build_payload(mongo_id: str, metadata: dict) -> dict:
+    """Qdrant payload of an image: its facets, and its display fields if DENORMALIZE_PAYLOAD is set"""
+    payload = {"mongo_id": mongo_id}
+    payload |= {field: metadata[field] for field in FACET_FIELDS if metadata.get(field)}
+    if DENORMALIZE_PAYLOAD:
+        payload |= {field: metadata.get(field) for field in DISPLAY_FIELDS}
+
+    return payload
+
+def is_denormalized(payload: dict) -> bool:
+    #title is required in ImageModel, so it is always present in a denormalized payload
+    return 'title' in payload
+
+async def invalidate_document(mongo_id: str):
+    await document_cache.delete(mongo_id)
+
+async def get_documents(ids: list[str]) -> dict[str, dict]:
+    """Get mongo documents by id, going through the document cache. Returns a map of id -> document"""
+    documents = {}
+    missing = []
+    for mongo_id in ids:
+        cached = await document_cache.get(mongo_id)
+        if cached is None:
+            missing.append(mongo_id)
+        else:
+            documents[mongo_id] = cached
+
+    if missing:
+        col = get_images_collection()
+        with metrics.stage('mongo'):
+            metadata = await col.find({
+                "_id": {
+                    "$in": [ObjectId(x) for x in missing]
+                }
+            }).to_list(None)
+
+        for doc in metadata:
+            documents[str(doc['_id'])] = doc
+            await document_cache.set(str(doc['_id']), doc)
+
+    return documents
+
 async def hydrate_from_qdrant(retrieved: list[models.ScoredPoint]) -> list[RetrievedImageModel]:
     """Get mongo data from qdrant response"""
-    col = get_images_collection()
+    return (await hydrate_many_from_qdrant([retrieved]))[0]
 
-    metadata = await col.find({
-        "_id": {
-            "$in": [ObjectId(x.payload['mongo_id']) for x in retrieved]
-        }
-    }).to_list(None)
+async def hydrate_many_from_qdrant(retrieved_lists: list[list[models.ScoredPoint]]) -> list[list[RetrievedImageModel]]:
+    """Get mongo data from several qdrant responses at once, with a single query for the documents they are missing"""
+    retrieved = [hit for hits in retrieved_lists for hit in hits]
+    metadata_map = {
+        hit.payload['mongo_id']: {'_id': hit.payload['mongo_id']} | {k: hit.payload.get(k) for k in DISPLAY_FIELDS}
+        for hit in retrieved
+        if is_denormalized(hit.payload)
+    }
 
-    metadata_map = {str(doc['_id']): doc for doc in metadata}
+    to_fetch = list(dict.fromkeys(hit.payload['mongo_id'] for hit in retrieved if hit.payload['mongo_id'] not in metadata_map))
+    if to_fetch:
+        metadata_map |= await get_documents(to_fetch)
 
     #Build the Model
-    ordered_metadata = [
-        metadata_map[hit.payload['mongo_id']] | {'score': hit.score} 
-        for hit in retrieved 
-        if hit.payload['mongo_id'] in metadata_map
+    return [
+        [
+            metadata_map[hit.payload['mongo_id']] | {'score': hit.score}
+            for hit in hits
+            if hit.payload['mongo_id'] in metadata_map
+        ]
+        for hits in retrieved_lists
     ]
-
-    return ordered_metadata
\ No newline at end of file
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+import pathlib
+import tempfile
+from PIL import Image, ImageOps
+
+#Resized copies of each image, served instead of the original by search grids and detail views. Stored next to the
+#originals unless set, the directory being created on the first write
+DERIVATIVES_DIR = pathlib.Path(os.environ.get('DERIVATIVES_DIR') or pathlib.Path(os.environ.get('IMAGES_DIR')) / 'derivatives')
+DERIVATIVES_URL_PATH = os.environ.get('DERIVATIVES_URL_PATH', '/static/derivatives')
+DERIVATIVE_FORMAT = os.environ.get('DERIVATIVE_FORMAT', 'webp') #'webp' or 'jpeg'
+DERIVATIVE_QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', 80))
+
+#Name -> width in pixels. Images narrower than a width are not upscaled
+DERIVATIVE_WIDTHS = {
+    'thumbnail': int(os.environ.get('THUMBNAIL_WIDTH', 320)),
+    'preview': int(os.environ.get('PREVIEW_WIDTH', 1280)),
+}
+
+EXTENSION = 'jpg' if DERIVATIVE_FORMAT == 'jpeg' else DERIVATIVE_FORMAT
+
+def derivative_path(name: str, stem: str) -> pathlib.Path:
+    """Derivatives are stored by size, as {DERIVATIVES_DIR}/{name}/{stem of the original}.{format}"""
+    return DERIVATIVES_DIR / name / f'{stem}.{EXTENSION}'
+
+def derivative_url(url: str | None, name: str) -> str | None:
+    """Url of a derivative, from the url of the original image"""
+    if not url:
+        return None
+    return f'{DERIVATIVES_URL_PATH}/{name}/{pathlib.PurePosixPath(url).stem}.{EXTENSION}'
+
+def generate(source: pathlib.Path, names: list[str] | None = None, overwrite: bool = False) -> list[pathlib.Path]:
+    """
+    Writes the derivatives of an image, decoding it only once. Existing derivatives are kept unless `overwrite`.
+    Returns the paths that were written.
+    """
+    names = [name for name in (names or DERIVATIVE_WIDTHS) if overwrite or not derivative_path(name, source.stem).exists()]
+    if not names:
+        return []
+
+    image = Image.open(source)
+    #JPEGs are decoded straight to the smallest DCT scale that is still at least the largest width
+    image.draft('RGB', (max(DERIVATIVE_WIDTHS[name] for name in names), 1))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+
+    written = []
+    #Largest first, so each size is resized from the previous one
+    for name in sorted(names, key=DERIVATIVE_WIDTHS.get, reverse=True):
+        width = DERIVATIVE_WIDTHS[name]
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+
+        path = derivative_path(name, source.stem)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        #Written to a temporary file first, so a derivative is never served half written
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=DERIVATIVE_FORMAT.upper(), quality=DERIVATIVE_QUALITY)
+            os.replace(tmp_name, path)
+        except BaseException:
+            pathlib.Path(tmp_name).unlink(missing_ok=True)
+            raise
+        written.append(path)
+
+    return written
+
+async def generate_async(source: pathlib.Path, names: list[str] | None = None, overwrite: bool = False) -> list[pathlib.Path]:
+    """Writes the derivatives of an image in the preprocessing pool"""
+    from ...inference import preprocess
+
+    return await asyncio.get_running_loop().run_in_executor(preprocess.get_executor(), generate, source, names, overwrite)
+
+async def generate_many(sources: list[pathlib.Path]):
+    """Writes the derivatives of newly ingested images. Failures are only logged, as the originals can still be served"""
+    results = await asyncio.gather(*[generate_async(source) for source in sources], return_exceptions=True)
+    for source, result in zip(sources, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Failed to generate derivatives of {source}: {result}")
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+import pathlib
+from functools import lru_cache
+import numpy as np
+from qdrant_client import models
+
+#Directory written by `python -m app.scripts.precompute_neighbors`. Related images are served from it when set
+RELATED_NEIGHBORS_DIR = os.environ.get('RELATED_NEIGHBORS_DIR')
+
+class NeighborStore:
+    """
+    Precomputed top-K related images, memory mapped from disk.
+
+    Row i of `neighbors.npy` holds the rows of the K nearest images of `ids.json[i]` (-1 when there are
+    fewer than K), and the same row of `scores.npy` holds their similarity scores. `point_ids.json[i]` is the
+    qdrant point id of row i.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        with open(path / 'ids.json') as f:
+            self.ids: list[str] = json.load(f)
+        with open(path / 'point_ids.json') as f:
+            self.point_ids: list[str | int] = json.load(f)
+        self.rows = {mongo_id: row for row, mongo_id in enumerate(self.ids)}
+        self.neighbors = np.load(path / 'neighbors.npy', mmap_mode='r')
+        self.scores = np.load(path / 'scores.npy', mmap_mode='r')
+        self.k = self.neighbors.shape[1]
+
+    def has(self, mongo_id: str) -> bool:
+        return mongo_id in self.rows
+
+    def get(self, mongo_id: str, offset: int, limit: int) -> list[models.ScoredPoint]:
+        """Neighbors of an image as scored points. Fewer than `limit`, or none, past the first K"""
+        row = self.rows[mongo_id]
+        return [
+            models.ScoredPoint(id=self.point_ids[neighbor], version=0, score=float(score), payload={'mongo_id': self.ids[neighbor]})
+            for neighbor, score in zip(self.neighbors[row, offset:offset + limit], self.scores[row, offset:offset + limit])
+            if neighbor >= 0
+        ]
+
+@lru_cache(maxsize=1)
+def get_neighbor_store() -> NeighborStore | None:
+    if not RELATED_NEIGHBORS_DIR:
+        return None
+
+    try:
+        store = NeighborStore(pathlib.Path(RELATED_NEIGHBORS_DIR))
+    except FileNotFoundError as e:
+        logging.warning(f"Related neighbors store not found, falling back to qdrant: {e}")
+        return None
+
+    logging.info(f"Loaded related neighbors for {len(store.ids)} images (k={store.k})")
+    return store
@@ -0,0 +1,108 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+from typing import Awaitable, Callable
+from fastapi import Response
+from qdrant_client import models
+from ..services import exceptions
+from ...db import vector_db
+from .cache import result_window_cache
+
+#Number of ranked hits fetched from qdrant at once. Every page inside a window is served from cache
+SEARCH_WINDOW_SIZE = int(os.environ.get('SEARCH_WINDOW_SIZE', 100))
+#Deepest offset a page can start at. Hybrid search fetches twice the hits up to the end of the page from qdrant
+SEARCH_MAX_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET', 1000))
+
+#Response header carrying the cursor of the next page, so response bodies keep their shape
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+WindowFetcher = Callable[[int, int], Awaitable[list[models.ScoredPoint]]]
+
+def make_key(*parts) -> str:
+    """Stable identifier of a ranked result list, from everything that affects its ordering"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:20]
+
+async def result_key(*parts) -> str:
+    """make_key for results of the collection currently served, so cached windows don't outlive an alias flip"""
+    return make_key(await vector_db.served_collection(), *parts)
+
+def encode_cursor(key: str, offset: int) -> str:
+    raw = json.dumps({'k': key, 'o': offset}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str, key: str) -> int:
+    """Returns the offset stored in the cursor, making sure it was issued for this same query"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        offset = int(state['o'])
+        cursor_key = state['k']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise exceptions.InvalidCursorError(f"Malformed cursor: {cursor}")
+
+    if cursor_key != key or offset < 0:
+        raise exceptions.InvalidCursorError("Cursor does not belong to this query")
+
+    return offset
+
+def get_offset(key: str, n: int, page: int, cursor: str | None = None) -> int:
+    """Offset of the first hit of the requested page. The cursor takes precedence over the page number"""
+    offset = decode_cursor(cursor, key) if cursor else (page - 1) * n
+    if offset >= SEARCH_MAX_OFFSET:
+        raise exceptions.PageOutOfRangeError(f"Only the first {SEARCH_MAX_OFFSET} results can be paged through")
+
+    return offset
+
+def page_key(key: str, n: int, page: int, cursor: str | None = None) -> str:
+    """Identifies one page of a result list, whether it was addressed by page number or by cursor"""
+    return f'{key}:{get_offset(key, n, page, cursor)}:{n}'
+
+async def _get_window(key: str, start: int, fetch: WindowFetcher) -> list[models.ScoredPoint]:
+    cache_key = f'{key}:{start}'
+    cached = await result_window_cache.get(cache_key)
+    if cached is not None:
+        return [models.ScoredPoint(id=id, version=0, score=score, payload=payload) for id, score, payload in cached]
+
+    hits = await fetch(SEARCH_WINDOW_SIZE, start)
+    await result_window_cache.set(cache_key, [[hit.id, hit.score, hit.payload] for hit in hits])
+
+    return hits
+
+async def fetch_page(
+    key: str,
+    fetch: WindowFetcher,
+    n: int,
+    page: int,
+    cursor: str | None = None,
+) -> tuple[list[models.ScoredPoint], str | None]:
+    """
+    Gets a page of hits from the cached result windows of a query, running `fetch(limit, offset)` only for
+    windows that aren't cached yet. Pages are addressed either by `page` or by a `cursor` returned from a
+    previous call, which takes precedence.
+
+    Returns the hits and the cursor of the next page, or None if there are no more results.
+    """
+    start = get_offset(key, n, page, cursor)
+    end = start + n
+
+    first_window = start - start % SEARCH_WINDOW_SIZE
+    window_hits = []
+    exhausted = False
+    for window_start in range(first_window, end, SEARCH_WINDOW_SIZE):
+        window = await _get_window(key, window_start, fetch)
+        window_hits.extend(window)
+        #A short window means qdrant has no more results for this query
+        if len(window) < SEARCH_WINDOW_SIZE:
+            exhausted = True
+            break
+
+    hits = window_hits[start - first_window:end - first_window]
+    has_more = (not exhausted or first_window + len(window_hits) > end) and end < SEARCH_MAX_OFFSET
+    next_cursor = encode_cursor(key, end) if has_more else None
+
+    return hits, next_cursor
+
+def set_next_cursor(response: Response, next_cursor: str | None):
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
@@ -0,0 +1,57 @@
+import os
+import pathlib
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+from . import derivatives
+
+STATIC_CACHE_CONTROL = os.environ.get('STATIC_CACHE_CONTROL', 'public, max-age=86400')
+
+def strong_etag(stat_result: os.stat_result) -> str:
+    """
+    Images and derivatives are only ever replaced through a rename, which gives the file a new inode.
+    Inode, mtime and size therefore identify the content, without hashing it on every request.
+    """
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+class CachedStaticFiles(StaticFiles):
+    """Static files with strong ETags and Cache-Control. Range requests are handled by FileResponse"""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        headers = {'etag': strong_etag(stat_result), 'cache-control': STATIC_CACHE_CONTROL}
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+class DerivativeStaticFiles(CachedStaticFiles):
+    """Serves derivatives, generating the missing ones from the original image on their first request"""
+
+    def __init__(self, images_dir: str | pathlib.Path, **kwargs):
+        super().__init__(**kwargs)
+        self.images_dir = pathlib.Path(images_dir)
+
+    async def check_config(self):
+        #Created on the first request rather than when the app is imported
+        os.makedirs(self.directory, exist_ok=True)
+        await super().check_config()
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            name, _, filename = path.partition('/')
+            if e.status_code != 404 or name not in derivatives.DERIVATIVE_WIDTHS or '/' in filename:
+                raise
+
+        stem = pathlib.PurePosixPath(filename).stem
+        source = self.images_dir / f'{stem}.jpg'
+        if filename != f'{stem}.{derivatives.EXTENSION}' or not source.is_file():
+            raise HTTPException(status_code=404)
+
+        await derivatives.generate_async(source, [name])
+        full_path = derivatives.derivative_path(name, stem)
+        return self.file_response(full_path, os.stat(full_path), scope)
@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+import os
+import pathlib
+import tempfile
+from typing import Awaitable, Callable
+import magic
+from ..services import exceptions
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 50 * 1024 * 1024))
+
+#Reads up to n bytes, returning b'' at the end of the stream. UploadFile.read fits this
+ChunkReader = Callable[[int], Awaitable[bytes]]
+
+async def stream_to_temp_file(
+    read: ChunkReader,
+    directory: str | pathlib.Path | None = None,
+    allowed_mime: str = 'image/jpeg',
+) -> tuple[pathlib.Path, str]:
+    """
+    Streams an upload into a temporary file in `directory`, a chunk at a time, with all disk writes done off the event loop.
+    The MIME type is sniffed from the first chunk only. Returns the path of the temporary file and the sha256 of its contents.
+    The caller owns the temporary file, and should either move it into place or delete it.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.part')
+    path = pathlib.Path(tmp_name)
+    digest = hashlib.sha256()
+    size = 0
+
+    def write_chunk(f, chunk: bytes):
+        digest.update(chunk)
+        f.write(chunk)
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            chunk = await read(UPLOAD_CHUNK_SIZE)
+
+            #Check the mimetype before saving!
+            mime = magic.from_buffer(chunk, mime=True)
+            if mime != allowed_mime:
+                raise exceptions.InvalidMediaType(f"Invalid MIME type: {mime}. Only {allowed_mime} is supported")
+
+            while chunk:
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise exceptions.FileTooLargeError(f"File is larger than the maximum of {MAX_UPLOAD_SIZE} bytes")
+
+                await asyncio.to_thread(write_chunk, f, chunk)
+                chunk = await read(UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+    return path, digest.hexdigest()
@@ -0,0 +1,20 @@
+"""
+Qdrant collection settings shared by the services and scripts. They must match the seeder.
+
+Collections are versioned (`image_hub_v1`, `image_hub_v2`...) behind an alias (`image_hub`), which
+`app.scripts.reembed` flips once a new version is complete. Services use the alias, unless
+QDRANT_COLLECTION_VERSION pins them to a version, e.g. to keep serving with the old encoder during a model swap.
+"""
+import os
+
+COLLECTION_ALIAS = os.environ.get('QDRANT_COLLECTION', 'image_hub')
+COLLECTION_VERSION = os.environ.get('QDRANT_COLLECTION_VERSION')
+
+DENSE_VECTOR_NAME = "image_embedding"
+SPARSE_VECTOR_NAME = "text_bm25"
+
+def versioned_collection_name(version: int | str) -> str:
+    return f'{COLLECTION_ALIAS}_v{version}'
+
+#The collection every read and write goes to
+COLLECTION_NAME = versioned_collection_name(COLLECTION_VERSION) if COLLECTION_VERSION else COLLECTION_ALIAS
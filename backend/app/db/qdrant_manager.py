@@ -1,11 +1,25 @@
 import logging
-from qdrant_client import QdrantClient, models
+import os
+import time
+import httpx
+from qdrant_client import AsyncQdrantClient, models
+from ..api.models.search import FACET_FIELDS
+from ..config import COLLECTION_NAME
 from tenacity import retry, stop_after_attempt, wait_fixed
 
+#Connection pool/transport settings, shared by every request on this worker
+QDRANT_PREFER_GRPC = os.environ.get('QDRANT_PREFER_GRPC', 'false').lower() == 'true'
+QDRANT_GRPC_PORT = int(os.environ.get('QDRANT_GRPC_PORT', 6334))
+QDRANT_POOL_SIZE = int(os.environ.get('QDRANT_POOL_SIZE', 100))
+QDRANT_POOL_KEEPALIVE = int(os.environ.get('QDRANT_POOL_KEEPALIVE', 20))
+QDRANT_TIMEOUT = int(os.environ.get('QDRANT_TIMEOUT', 10))
+#Seconds between lookups of the collection behind the alias, so result caches follow an alias flip
+QDRANT_ALIAS_REFRESH = float(os.environ.get('QDRANT_ALIAS_REFRESH', 30))
+
 @retry(stop=stop_after_attempt(10), wait=wait_fixed(3))
-def _wait_for_qdrant(client):
+async def _wait_for_qdrant(client):
     try:
-        client.info()
+        await client.info()
         logging.info("Qdrant is online.")
     except Exception as e:
         logging.warning(f"Waiting for Qdrant... ({e})")
@@ -13,21 +27,56 @@ def _wait_for_qdrant(client):
 
 
 class QdrantManager:
-    client: QdrantClient = None
+    client: AsyncQdrantClient = None
+    _served_collection: str = COLLECTION_NAME
+    _served_checked_at: float = float('-inf')
 
     async def connect_to_database(self, path: str):
-        logging.info("Connecting to MongoDB.")
-        self.client = QdrantClient(url=path)
-        _wait_for_qdrant(self.client)
+        logging.info("Connecting to Qdrant.")
+        self.client = AsyncQdrantClient(
+            url=path,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            grpc_port=QDRANT_GRPC_PORT,
+            timeout=QDRANT_TIMEOUT,
+            #Only used by the REST transport, gRPC multiplexes over a single channel
+            limits=httpx.Limits(
+                max_connections=QDRANT_POOL_SIZE,
+                max_keepalive_connections=QDRANT_POOL_KEEPALIVE
+            ),
+        )
+        await _wait_for_qdrant(self.client)
         #Idempotent call to create an index in the id field
-        self.client.create_payload_index(
-            collection_name='image_hub',
+        await self.client.create_payload_index(
+            collection_name=COLLECTION_NAME,
             field_name='mongo_id',
             field_schema=models.PayloadSchemaType.KEYWORD
         )
+        #Facet filters and counts
+        for field in FACET_FIELDS:
+            await self.client.create_payload_index(
+                collection_name=COLLECTION_NAME,
+                field_name=field,
+                field_schema=models.PayloadSchemaType.KEYWORD
+            )
         logging.info("✅ Sucessfully connected to Qdrant")
 
+    async def served_collection(self) -> str:
+        """The collection COLLECTION_NAME resolves to, e.g. image_hub_v2 behind the image_hub alias"""
+        if time.monotonic() - self._served_checked_at < QDRANT_ALIAS_REFRESH:
+            return self._served_collection
+
+        self._served_checked_at = time.monotonic()
+        try:
+            aliases = (await self.client.get_aliases()).aliases
+            self._served_collection = next(
+                (alias.collection_name for alias in aliases if alias.alias_name == COLLECTION_NAME), COLLECTION_NAME
+            )
+        except Exception as e:
+            logging.warning(f"Failed to look up the collection behind {COLLECTION_NAME}: {e}")
+
+        return self._served_collection
+
     async def close_database_connection(self):
         logging.info("Closing connection with Qdrant.")
         await self.client.close()
-        logging.info("✅ Closed connection with Qdrant.")
\ No newline at end of file
+        logging.info("✅ Closed connection with Qdrant.")
@@ -1,29 +1,108 @@
+from __future__ import annotations
 from functools import lru_cache
-from transformers import AutoProcessor, AutoModel, AutoTokenizer, SiglipModel, SiglipProcessor, SiglipTokenizer
+from typing import TYPE_CHECKING
+import json
 import os
+import pathlib
 import logging
-from fastembed import SparseTextEmbedding
+from .inference import backends
+from .inference.client import RemoteInferenceEngine
+
+#torch, transformers and fastembed are imported on first use, so web workers using the inference server boot fast
+if TYPE_CHECKING:
+    from fastembed import SparseTextEmbedding
+    from transformers import SiglipImageProcessor, SiglipTextModel, SiglipTokenizer, SiglipVisionModel
+    from .inference.engine import InferenceEngine
 
 MODEL = os.environ.get('ENCODER_MODEL')
+#When set, encodes are sent to the inference server at this address instead of running in this process
+INFERENCE_SERVER_ADDRESS = os.environ.get('INFERENCE_SERVER_ADDRESS')
 
-@lru_cache(maxsize=1)
-def get_sglip_model() -> SiglipModel:
-    logging.info('Loading Model...')
-    model = AutoModel.from_pretrained(MODEL)
+def load_tower_model(tower: str) -> SiglipTextModel | SiglipVisionModel:
+    """A new copy of a tower's transformers model"""
+    from transformers import SiglipTextModel, SiglipVisionModel
+
+    model = (SiglipTextModel if tower == 'text' else SiglipVisionModel).from_pretrained(MODEL)
+    model.eval()
     return model
 
 @lru_cache(maxsize=1)
-def get_sglip_processor() -> SiglipProcessor:
-    logging.info('Loading Processor...')
-    processor = AutoProcessor.from_pretrained(MODEL, use_fast=True)
+def get_text_model() -> SiglipTextModel:
+    logging.info('Loading Text Model...')
+    return load_tower_model('text')
+
+@lru_cache(maxsize=1)
+def get_vision_model() -> SiglipVisionModel:
+    logging.info('Loading Vision Model...')
+    return load_tower_model('vision')
+
+@lru_cache(maxsize=1)
+def get_sglip_image_processor() -> SiglipImageProcessor:
+    from transformers import AutoImageProcessor
+
+    logging.info('Loading Image Processor...')
+    processor = AutoImageProcessor.from_pretrained(MODEL, use_fast=True)
     return processor
 
 @lru_cache(maxsize=1)
 def get_sglip_tokenizer() -> SiglipTokenizer:
+    from transformers import AutoTokenizer
+
     logging.info('Loading Tokenizer...')
     tokenizer = AutoTokenizer.from_pretrained(MODEL, use_fast=True)
     return tokenizer
 
 @lru_cache(maxsize=1)
-def get_bm25_model():
-    return SparseTextEmbedding(model_name="Qdrant/bm25")
\ No newline at end of file
+def get_preprocessor_config() -> dict:
+    """The vision tower's preprocessor_config.json, read without transformers so web workers never import torch"""
+    path = pathlib.Path(MODEL) / 'preprocessor_config.json'
+    if not path.exists():
+        from huggingface_hub import hf_hub_download
+        path = hf_hub_download(MODEL, 'preprocessor_config.json')
+
+    with open(path) as f:
+        return json.load(f)
+
+_TOWER_MODELS = {'text': get_text_model, 'vision': get_vision_model}
+
+@lru_cache
+def get_encoder(tower: str, backend: str = backends.ENCODER_BACKEND) -> backends.Encoder:
+    """The encoder of one tower ('text' or 'vision'). Only that tower's weights are loaded"""
+    logging.info(f'Loading {backend} {tower} encoder...')
+    get_model = _TOWER_MODELS[tower]
+    input_name = backends.TOWER_INPUTS[tower]
+
+    if backend == 'torch':
+        return backends.TorchEncoder(get_model(), input_name)
+    if backend == 'torch-int8':
+        #Quantize a fresh copy, so the fp32 tower stays usable as a baseline
+        return backends.TorchEncoder(backends.quantize_int8(load_tower_model(tower)), input_name)
+    if backend == 'onnx':
+        return backends.OnnxEncoder(pathlib.Path(backends.ENCODER_ONNX_DIR) / f'{tower}.onnx', input_name)
+
+    raise ValueError(f"Unknown encoder backend: {backend}. Expected one of {backends.ENCODER_BACKENDS}")
+
+def load_text_tower() -> tuple[SiglipTokenizer, backends.Encoder]:
+    return get_sglip_tokenizer(), get_encoder('text')
+
+def load_vision_tower() -> tuple[SiglipImageProcessor, backends.Encoder]:
+    return get_sglip_image_processor(), get_encoder('vision')
+
+@lru_cache(maxsize=1)
+def get_local_inference_engine() -> InferenceEngine:
+    from .inference.engine import InferenceEngine
+
+    #Towers are loaded on first use, or by InferenceEngine.prepare
+    return InferenceEngine(load_text_tower, load_vision_tower)
+
+@lru_cache(maxsize=1)
+def get_inference_engine() -> InferenceEngine | RemoteInferenceEngine:
+    if INFERENCE_SERVER_ADDRESS:
+        return RemoteInferenceEngine(INFERENCE_SERVER_ADDRESS)
+    return get_local_inference_engine()
+
+@lru_cache(maxsize=1)
+def get_bm25_model() -> SparseTextEmbedding:
+    from fastembed import SparseTextEmbedding
+
+    return SparseTextEmbedding(model_name="Qdrant/bm25")
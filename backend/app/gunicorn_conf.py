@@ -0,0 +1,27 @@
+"""
+Gunicorn hooks of the prod backend: `gunicorn -c app/gunicorn_conf.py app.main:app`.
+
+With PROMETHEUS_MULTIPROC_DIR, each worker writes its metrics to files in that directory. They are wiped when the
+master starts, and the live gauges of a worker are dropped when it exits, so /metrics never sums dead workers.
+"""
+import os
+import pathlib
+import shutil
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+def on_starting(server):
+    if PROMETHEUS_MULTIPROC_DIR:
+        #Empty it rather than removing it, it may be a mounted volume
+        directory = pathlib.Path(PROMETHEUS_MULTIPROC_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+def child_exit(server, worker):
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
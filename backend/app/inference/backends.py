@@ -0,0 +1,71 @@
+"""
+Encoder backends: what actually runs the SigLIP text and vision towers for the InferenceEngine.
+Each tower is a separate encoder, so a process only loads the towers it uses.
+
+- 'torch': the fp32 transformers towers
+- 'torch-int8': the same towers with their Linear layers dynamically quantized to int8
+- 'onnx': towers exported by `app.scripts.export_onnx`, run with ONNX Runtime
+
+Measure a backend with `app.scripts.encoder_parity` before switching to it. torch is only imported by the torch
+encoders, so processes that only read the settings (e.g. web workers using the inference server) never load it.
+"""
+from __future__ import annotations
+import os
+import pathlib
+from typing import TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    import torch
+    from transformers import SiglipTextModel, SiglipVisionModel
+
+ENCODER_BACKENDS = ['torch', 'torch-int8', 'onnx']
+ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')
+#Directory with the text.onnx and vision.onnx written by app.scripts.export_onnx
+ENCODER_ONNX_DIR = os.environ.get('ENCODER_ONNX_DIR')
+#How the text tower pads its input: 'max_length' (what SigLIP was trained with), 'longest' or 'bucket'
+INFERENCE_TEXT_PADDING = os.environ.get('INFERENCE_TEXT_PADDING', 'max_length')
+INFERENCE_TEXT_BUCKETS = [int(x) for x in os.environ.get('INFERENCE_TEXT_BUCKETS', '8,16,32,64').split(',')]
+#Intra-op threads of the process doing inference. Defaults to the runtime's choice (all physical cores)
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', 0))
+
+#The input each tower takes
+TOWER_INPUTS = {'text': 'input_ids', 'vision': 'pixel_values'}
+
+class TorchEncoder:
+    """Runs a transformers SiglipTextModel or SiglipVisionModel, quantized or not"""
+
+    def __init__(self, model: SiglipTextModel | SiglipVisionModel, input_name: str):
+        self.model = model
+        self.input_name = input_name
+
+    def encode(self, inputs: torch.Tensor) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            return self.model(**{self.input_name: inputs}).pooler_output.numpy()
+
+class OnnxEncoder:
+    """Runs an exported tower with ONNX Runtime"""
+
+    def __init__(self, path: str | pathlib.Path, input_name: str, threads: int = INFERENCE_THREADS):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = input_name
+
+    def encode(self, inputs: torch.Tensor) -> np.ndarray:
+        return self.session.run(None, {self.input_name: inputs.numpy()})[0]
+
+Encoder = TorchEncoder | OnnxEncoder
+
+def quantize_int8(model: SiglipTextModel | SiglipVisionModel):
+    """Dynamic int8 quantization of every Linear layer. Weights are quantized once, activations on the fly"""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable
+from .. import metrics
+
+class MicroBatcher:
+    """
+    Collects concurrent requests over a short window and runs them as a single batch.
+
+    `fn` is a blocking callable that receives a list of items and returns a list of results
+    in the same order. It runs in a worker thread, so the event loop is never blocked.
+    """
+
+    def __init__(self, fn: Callable[[list], list], max_batch_size: int, max_wait_ms: float, name: str):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+
+        #Stats
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+        self.max_seen_batch_size = 0
+
+    def _ensure_worker(self):
+        #The queue is bound to the running loop, so it can only be created lazily
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """Queue a single item and wait for its result"""
+        return (await self.submit_many([item]))[0]
+
+    async def submit_many(self, items: list) -> list:
+        """Queue several items at once, so they are very likely to land in the same batch"""
+        self._ensure_worker()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item in items:
+            future = loop.create_future()
+            self._queue.put_nowait((item, future))
+            futures.append(future)
+        metrics.INFERENCE_QUEUE_DEPTH.labels(self.name).set(self._queue.qsize())
+
+        return await asyncio.gather(*futures)
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            #Drain whatever is already waiting before sleeping on the window
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        #Callers that gave up (e.g. client disconnected) don't need to be computed
+        return [(item, future) for item, future in batch if not future.done()]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            metrics.INFERENCE_QUEUE_DEPTH.labels(self.name).set(self._queue.qsize())
+            if not batch:
+                continue
+
+            try:
+                start = time.perf_counter()
+                results = await asyncio.to_thread(self.fn, [item for item, _ in batch])
+                metrics.INFERENCE_BATCH_SECONDS.labels(self.name, 'batch').observe(time.perf_counter() - start)
+                metrics.INFERENCE_BATCH_SIZE.labels(self.name).observe(len(batch))
+            except Exception as e:
+                logging.exception(f"Inference batch '{self.name}' failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+            self.batches += 1
+            self.items += len(batch)
+            self.last_batch_size = len(batch)
+            self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_seen_batch_size,
+        }
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import numpy as np
+from PIL import Image
+from tenacity import retry, stop_after_attempt, wait_fixed
+from . import preprocess, protocol
+from .. import metrics
+
+#Connections kept open to the inference server. Each carries one request at a time
+INFERENCE_CLIENT_POOL_SIZE = int(os.environ.get('INFERENCE_CLIENT_POOL_SIZE', 16))
+
+class InferenceServerError(Exception):
+    """Raised when the inference server fails to encode a request"""
+    pass
+
+class RemoteInferenceEngine:
+    """
+    Drop-in replacement for InferenceEngine that forwards encodes to the inference server, so web workers
+    don't need to load the model at all. Batching happens on the server, across all workers.
+    """
+
+    def __init__(self, address: str, pool_size: int = INFERENCE_CLIENT_POOL_SIZE):
+        self.address = address
+        self.pool_size = pool_size
+        self._idle: asyncio.LifoQueue | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    async def _connect(self):
+        kind, address = protocol.parse_address(self.address)
+        if kind == 'unix':
+            return await asyncio.open_unix_connection(path=address)
+        return await asyncio.open_connection(host=address[0], port=address[1])
+
+    async def _request(self, header: dict, payload: bytes = b'') -> tuple[dict, bytes]:
+        if self._slots is None:
+            self._idle = asyncio.LifoQueue()
+            self._slots = asyncio.Semaphore(self.pool_size)
+
+        async with self._slots:
+            with metrics.INFERENCE_CONNECTIONS_IN_USE.track_inprogress():
+                reader, writer = self._idle.get_nowait() if not self._idle.empty() else await self._connect()
+                try:
+                    await protocol.write_frame(writer, header, payload)
+                    response, response_payload = await protocol.read_frame(reader)
+                except BaseException:
+                    #The connection is in an unknown state, don't reuse it
+                    writer.close()
+                    raise
+
+                self._idle.put_nowait((reader, writer))
+
+        if not response.get('ok'):
+            raise InferenceServerError(response.get('error'))
+
+        return response, response_payload
+
+    @retry(stop=stop_after_attempt(20), wait=wait_fixed(3))
+    async def wait_until_ready(self):
+        try:
+            await self._request({'op': 'stats'})
+            logging.info("Inference server is online.")
+        except Exception as e:
+            logging.warning(f"Waiting for the inference server... ({e})")
+            raise
+
+    async def encode_text(self, text: str) -> list[float]:
+        return (await self.encode_texts([text]))[0]
+
+    async def encode_texts(self, texts: list[str]) -> list[list[float]]:
+        response, payload = await self._request({'op': 'text', 'texts': texts})
+        return protocol.decode_vectors(response['shape'], payload)
+
+    async def encode_image(self, image: Image.Image) -> list[float]:
+        return (await self.encode_images([image]))[0]
+
+    async def encode_images(self, images: list[Image.Image]) -> list[list[float]]:
+        #Preprocess here, so the inference server only runs the encoder
+        return await self.encode_pixels(await preprocess.to_pixels_async(images))
+
+    async def encode_pixels(self, pixels: list[np.ndarray]) -> list[list[float]]:
+        shape, payload = protocol.encode_array(np.stack(pixels))
+        response, response_payload = await self._request({'op': 'pixels', 'shape': shape}, payload)
+        return protocol.decode_vectors(response['shape'], response_payload)
+
+    async def remote_stats(self) -> dict:
+        response, _ = await self._request({'op': 'stats'})
+        return response['stats']
+
+    def stats(self) -> dict:
+        return {"remote": self.address, "idle_connections": self._idle.qsize() if self._idle is not None else 0}
+
+    async def close(self):
+        while self._idle is not None and not self._idle.empty():
+            _, writer = self._idle.get_nowait()
+            writer.close()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Callable
+import numpy as np
+import torch
+from PIL import Image
+from transformers import BatchEncoding, SiglipImageProcessor, SiglipTokenizer
+from .backends import INFERENCE_TEXT_BUCKETS, INFERENCE_TEXT_PADDING, Encoder
+from .batcher import MicroBatcher
+from . import preprocess
+from .. import metrics
+
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 32))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+#Towers loaded at startup rather than on their first request. A text-search-only deployment can set this to 'text'
+INFERENCE_PRELOAD = [tower for tower in os.environ.get('INFERENCE_PRELOAD', 'text,vision').split(',') if tower]
+INFERENCE_WARMUP = os.environ.get('INFERENCE_WARMUP', 'true').lower() == 'true'
+
+def tokenize_texts(
+    tokenizer: SiglipTokenizer,
+    texts: list[str],
+    padding: str = INFERENCE_TEXT_PADDING,
+    buckets: list[int] = INFERENCE_TEXT_BUCKETS,
+) -> list[tuple[list[int], BatchEncoding]]:
+    """
+    Tokenize a batch of texts with the given padding strategy, as (indices in `texts`, inputs) groups of equal length.
+
+    SigLIP pools the last position of the sequence and its tokenizer returns no attention mask, so a text's embedding
+    depends on how far it is padded. With 'longest' and 'bucket', every text is padded to its own length (or bucket)
+    whatever it is batched with, and the texts padded alike share a group. Anything other than 'max_length' trades a
+    small embedding drift for less compute; use `app.scripts.text_padding_parity` to measure it before enabling it.
+    """
+    max_length = tokenizer.model_max_length
+
+    if padding == 'max_length':
+        return [(list(range(len(texts))), tokenizer(texts, padding='max_length', truncation=True, return_tensors='pt'))]
+
+    if padding not in ('longest', 'bucket'):
+        raise ValueError(f"Unknown text padding strategy: {padding}")
+
+    groups: dict[int, list[int]] = {}
+    for i, ids in enumerate(tokenizer(texts, truncation=True, max_length=max_length)['input_ids']):
+        length = len(ids) if padding == 'longest' else next((b for b in sorted(buckets) if b >= len(ids)), max_length)
+        groups.setdefault(min(length, max_length), []).append(i)
+
+    return [
+        (indices, tokenizer([texts[i] for i in indices], padding='max_length', truncation=True, max_length=length, return_tensors='pt'))
+        for length, indices in groups.items()
+    ]
+
+def encode_texts(encoder: Encoder, tokenizer: SiglipTokenizer, texts: list[str], padding: str = INFERENCE_TEXT_PADDING) -> np.ndarray:
+    """The embeddings of `texts` in order, one forward pass per padding group"""
+    vectors = [None] * len(texts)
+    for indices, inputs in tokenize_texts(tokenizer, texts, padding):
+        for i, vector in zip(indices, encoder.encode(inputs['input_ids'])):
+            vectors[i] = vector
+    return np.stack(vectors)
+
+class InferenceEngine:
+    """
+    Batches concurrent text and image encode requests into single SigLIP forward passes.
+
+    The text and vision towers are loaded separately, by `load_text` and `load_vision`, the first time they are used.
+    `prepare` loads (and warms up) them ahead of time instead.
+    """
+
+    def __init__(
+        self,
+        load_text: Callable[[], tuple[SiglipTokenizer, Encoder]],
+        load_vision: Callable[[], tuple[SiglipImageProcessor, Encoder]],
+        max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+        max_wait_ms: float = INFERENCE_MAX_WAIT_MS,
+        text_padding: str = INFERENCE_TEXT_PADDING,
+    ):
+        self.text_padding = text_padding
+        self._loaders = {'text': load_text, 'vision': load_vision}
+        self._towers = {}
+        self._locks = {'text': threading.Lock(), 'vision': threading.Lock()}
+
+        self.text_batcher = MicroBatcher(self._encode_texts, max_batch_size, max_wait_ms, 'text')
+        self.image_batcher = MicroBatcher(self._encode_pixels, max_batch_size, max_wait_ms, 'image')
+
+    def _tower(self, name: str) -> tuple:
+        #Called from the batcher threads. One lock per tower, so loading one never blocks the other
+        with self._locks[name]:
+            if name not in self._towers:
+                start = time.perf_counter()
+                self._towers[name] = self._loaders[name]()
+                logging.info(f"Loaded the {name} tower in {time.perf_counter() - start:.1f}s")
+
+            return self._towers[name]
+
+    def _encode_texts(self, texts: list[str]) -> list[list[float]]:
+        tokenizer, encoder = self._tower('text')
+        with metrics.INFERENCE_BATCH_SECONDS.labels('text', 'tokenize').time():
+            groups = tokenize_texts(tokenizer, texts, self.text_padding)
+        vectors = [None] * len(texts)
+        with metrics.INFERENCE_BATCH_SECONDS.labels('text', 'forward').time():
+            for indices, inputs in groups:
+                for i, vector in zip(indices, encoder.encode(inputs['input_ids']).tolist()):
+                    vectors[i] = vector
+        return vectors
+
+    def _preprocess(self, images: list[Image.Image]) -> list[np.ndarray]:
+        #The same preprocessing as the web workers sending pixels, so local and remote engines agree
+        return preprocess.to_pixels(images)
+
+    def _encode_pixels(self, pixels: list[np.ndarray]) -> list[list[float]]:
+        _, encoder = self._tower('vision')
+        with metrics.INFERENCE_BATCH_SECONDS.labels('image', 'forward').time():
+            return encoder.encode(torch.from_numpy(np.stack(pixels))).tolist()
+
+    def _warm_up(self, name: str):
+        #A dummy batch, so the first real request doesn't pay for one-off allocations
+        start = time.perf_counter()
+        if name == 'text':
+            self._encode_texts(['warm up'])
+        else:
+            self._encode_pixels(self._preprocess([Image.new('RGB', (224, 224))]))
+        logging.info(f"Warmed up the {name} tower in {time.perf_counter() - start:.2f}s")
+
+    async def prepare(self, towers: list[str] = INFERENCE_PRELOAD, warm_up: bool = INFERENCE_WARMUP):
+        """Loads `towers` ('text', 'vision') now instead of on their first request, optionally warming them up"""
+        for name in towers:
+            await asyncio.to_thread(self._tower, name)
+            if warm_up:
+                await asyncio.to_thread(self._warm_up, name)
+
+    async def encode_text(self, text: str) -> list[float]:
+        """Get the dense embedding of a text"""
+        return await self.text_batcher.submit(text)
+
+    async def encode_texts(self, texts: list[str]) -> list[list[float]]:
+        """Get the dense embeddings of many texts"""
+        return await self.text_batcher.submit_many(texts)
+
+    async def encode_image(self, image: Image.Image) -> list[float]:
+        """Get the dense embedding of an image"""
+        return (await self.encode_images([image]))[0]
+
+    async def encode_images(self, images: list[Image.Image]) -> list[list[float]]:
+        """Get the dense embeddings of many images"""
+        return await self.encode_pixels(await asyncio.to_thread(self._preprocess, images))
+
+    async def encode_pixels(self, pixels: list[np.ndarray]) -> list[list[float]]:
+        """Get the dense embeddings of images already preprocessed by `app.inference.preprocess`"""
+        return await self.image_batcher.submit_many(pixels)
+
+    def stats(self) -> dict:
+        return {
+            "text": self.text_batcher.stats(),
+            "image": self.image_batcher.stats(),
+            "loaded_towers": sorted(self._towers),
+        }
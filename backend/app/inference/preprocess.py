@@ -0,0 +1,89 @@
+"""
+Image decoding and preprocessing off the event loop, in a bounded pool.
+
+JPEGs are decoded in draft mode: libjpeg scales them down by 1/2, 1/4 or 1/8 while decoding, to the smallest size that
+is still at least the encoder's input size. A large art scan then costs a fraction of a full decode and resize. The
+result is the normalized pixel array the vision tower takes, ready to be batched by `InferenceEngine.encode_pixels`.
+Resizing and normalizing follow the model's preprocessor_config.json with PIL and numpy only, so web workers sending
+the pixels to the inference server never import torch or transformers.
+"""
+import asyncio
+import io
+import os
+import pathlib
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
+from .. import metrics
+
+#'thread' or 'process'. Decoding and resizing mostly release the GIL, so threads are usually enough
+PREPROCESS_EXECUTOR = os.environ.get('PREPROCESS_EXECUTOR', 'thread')
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count() or 1))
+PREPROCESS_DRAFT = os.environ.get('PREPROCESS_DRAFT', 'true').lower() == 'true'
+
+ImageSource = str | pathlib.Path | bytes
+
+_executor: Executor | None = None
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if PREPROCESS_EXECUTOR == 'process':
+            _executor = ProcessPoolExecutor(PREPROCESS_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+    return _executor
+
+def decode_image(source: ImageSource, size: tuple[int, int] | None = None) -> Image.Image:
+    """Decodes an image as RGB. For JPEGs, only to the smallest DCT scale that is still at least `size`"""
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if size is not None and PREPROCESS_DRAFT:
+        #No-op for anything other than JPEG
+        image.draft('RGB', size)
+
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+def input_size() -> tuple[int, int]:
+    """The (width, height) the vision tower takes"""
+    from .. import dependencies
+
+    size = dependencies.get_preprocessor_config()['size']
+    return size['width'], size['height']
+
+def to_pixels(images: list[Image.Image]) -> list[np.ndarray]:
+    """Resizes and normalizes images into the (channels, height, width) float32 arrays the vision tower takes"""
+    from .. import dependencies
+
+    config = dependencies.get_preprocessor_config()
+    resample = Image.Resampling(config.get('resample', Image.Resampling.BICUBIC))
+    mean = np.array(config['image_mean'], dtype=np.float32)[:, None, None]
+    std = np.array(config['image_std'], dtype=np.float32)[:, None, None]
+
+    pixels = []
+    for image in images:
+        array = np.asarray(image.convert('RGB').resize(input_size(), resample), dtype=np.float32)
+        array = array.transpose(2, 0, 1) * np.float32(config['rescale_factor'])
+        pixels.append((array - mean) / std)
+
+    return pixels
+
+def load_pixels(source: ImageSource) -> np.ndarray:
+    return to_pixels([decode_image(source, input_size())])[0]
+
+async def load_pixels_async(source: ImageSource) -> np.ndarray:
+    """Decodes and preprocesses an image file (or its bytes) in the preprocessing pool"""
+    with metrics.PREPROCESS_IN_FLIGHT.track_inprogress():
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), load_pixels, source)
+
+async def to_pixels_async(images: list[Image.Image]) -> list[np.ndarray]:
+    """Preprocesses already decoded images in the preprocessing pool"""
+    with metrics.PREPROCESS_IN_FLIGHT.track_inprogress():
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), to_pixels, images)
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,41 @@
+"""
+Wire format between the web workers and the inference server.
+
+Every message is a frame: a 4-byte big-endian header length, a JSON header, then `header['payload']` bytes of
+binary payload. Requests carry preprocessed float32 pixels for images, responses carry float32 embeddings.
+"""
+import asyncio
+import json
+import struct
+import numpy as np
+
+_HEADER_LENGTH = struct.Struct('>I')
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[dict, bytes]:
+    (header_length,) = _HEADER_LENGTH.unpack(await reader.readexactly(_HEADER_LENGTH.size))
+    header = json.loads(await reader.readexactly(header_length))
+    payload = await reader.readexactly(header.get('payload', 0))
+    return header, payload
+
+async def write_frame(writer: asyncio.StreamWriter, header: dict, payload: bytes = b''):
+    raw_header = json.dumps(header | {'payload': len(payload)}).encode()
+    writer.write(_HEADER_LENGTH.pack(len(raw_header)) + raw_header + payload)
+    await writer.drain()
+
+def parse_address(address: str) -> tuple[str, str | tuple[str, int]]:
+    """'unix:/path/to.sock' or 'host:port'"""
+    if address.startswith('unix:'):
+        return 'unix', address.removeprefix('unix:')
+
+    host, port = address.rsplit(':', 1)
+    return 'tcp', (host, int(port))
+
+def encode_array(array) -> tuple[list[int], bytes]:
+    array = np.asarray(array, dtype=np.float32)
+    return list(array.shape), array.tobytes()
+
+def decode_array(shape: list[int], payload: bytes) -> np.ndarray:
+    return np.frombuffer(payload, dtype=np.float32).reshape(shape)
+
+def decode_vectors(shape: list[int], payload: bytes) -> list[list[float]]:
+    return decode_array(shape, payload).tolist()
@@ -0,0 +1,81 @@
+"""
+Inference server: a single process that owns the encoder weights and the micro-batching, shared by every web worker.
+
+Usage: INFERENCE_SERVER_ADDRESS=unix:/run/image-hub/inference.sock python -m app.inference.server
+"""
+import asyncio
+import logging
+import os
+import torch
+from prometheus_client import start_http_server
+from .. import dependencies
+from . import protocol
+from .backends import INFERENCE_THREADS
+from .engine import InferenceEngine
+
+logging.basicConfig(level=logging.INFO)
+
+INFERENCE_SERVER_ADDRESS = os.environ.get('INFERENCE_SERVER_ADDRESS', 'unix:/tmp/image-hub-inference.sock')
+#Serves the batching metrics (queue depth, batch sizes and times) for prometheus when set
+INFERENCE_METRICS_PORT = os.environ.get('INFERENCE_METRICS_PORT')
+
+async def handle_request(engine: InferenceEngine, header: dict, payload: bytes) -> tuple[dict, bytes]:
+    op = header.get('op')
+
+    if op == 'text':
+        shape, vectors = protocol.encode_array(await engine.encode_texts(header['texts']))
+        return {'ok': True, 'shape': shape}, vectors
+
+    if op == 'pixels':
+        pixels = list(protocol.decode_array(header['shape'], payload))
+        shape, vectors = protocol.encode_array(await engine.encode_pixels(pixels))
+        return {'ok': True, 'shape': shape}, vectors
+
+    if op == 'stats':
+        return {'ok': True, 'stats': engine.stats()}, b''
+
+    return {'ok': False, 'error': f"Unknown operation: {op}"}, b''
+
+async def handle_connection(engine: InferenceEngine, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            try:
+                header, payload = await protocol.read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionResetError):
+                return
+
+            try:
+                response, response_payload = await handle_request(engine, header, payload)
+            except Exception as e:
+                logging.exception("Inference request failed")
+                response, response_payload = {'ok': False, 'error': str(e)}, b''
+
+            await protocol.write_frame(writer, response, response_payload)
+    finally:
+        writer.close()
+
+async def main():
+    if INFERENCE_THREADS:
+        torch.set_num_threads(INFERENCE_THREADS)
+
+    engine = dependencies.get_local_inference_engine()
+    await engine.prepare()
+
+    if INFERENCE_METRICS_PORT:
+        start_http_server(int(INFERENCE_METRICS_PORT))
+
+    kind, address = protocol.parse_address(INFERENCE_SERVER_ADDRESS)
+    handler = lambda reader, writer: handle_connection(engine, reader, writer)
+    if kind == 'unix':
+        if os.path.exists(address):
+            os.unlink(address)
+        server = await asyncio.start_unix_server(handler, path=address)
+    else:
+        server = await asyncio.start_server(handler, host=address[0], port=address[1])
+
+    logging.info(f"✅ Inference server listening on {INFERENCE_SERVER_ADDRESS} ({torch.get_num_threads()} threads)")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,14 +1,18 @@
 from typing import Union
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 import os
 from contextlib import asynccontextmanager
 from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
 from app.db import db, vector_db
 import logging
 from .api import api
-from .api.services import exceptions
-from . import dependencies
+from .api.services import exceptions, ingest_service
+from . import dependencies, metrics
+from .inference import preprocess
+from .inference.client import RemoteInferenceEngine
+from .api.utils.cache import embedding_cache, search_flights
+from .api.utils import admission, derivatives, pagination
+from .api.utils.static_files import CachedStaticFiles, DerivativeStaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 logging.basicConfig(level=logging.INFO)
@@ -25,12 +29,19 @@ async def lifespan(app: FastAPI):
     await db.connect_to_database(mongo_uri)
     await vector_db.connect_to_database(qdrant_url)
 
-    #Get model and processor to load the cache
-    dependencies.get_sglip_model()
-    dependencies.get_sglip_processor()
-    dependencies.get_sglip_tokenizer()
+    #Load and warm up the towers in INFERENCE_PRELOAD, or wait for the inference server if it is remote
+    engine = dependencies.get_inference_engine()
+    if isinstance(engine, RemoteInferenceEngine):
+        await engine.wait_until_ready()
+    else:
+        await engine.prepare()
 
     yield
+    #Stop the bulk jobs and write the vectors still waiting in the write-behind queue before closing the connections
+    await ingest_service.shutdown()
+    if isinstance(engine, RemoteInferenceEngine):
+        await engine.close()
+    preprocess.shutdown()
     await db.close_database_connection()
     await vector_db.close_database_connection()
 
@@ -40,10 +51,38 @@ app = FastAPI(lifespan=lifespan)
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/inference/stats")
+async def inference_stats():
+    """Queue depth and batch size statistics of the inference engine, query embedding cache, search coalescing and admission counters"""
+    engine = dependencies.get_inference_engine()
+    stats = engine.stats()
+    if isinstance(engine, RemoteInferenceEngine):
+        #The batches and queues live in the inference server
+        stats['server'] = await engine.remote_stats()
+
+    return stats | {
+        "embedding_cache": embedding_cache.stats(),
+        "search_coalescing": search_flights.stats(),
+        "admission": {"search": admission.search_budget.stats(), "ingest": admission.ingest_budget.stats()},
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Stage and request latency histograms, and inference queue and pool gauges, for prometheus"""
+    content, content_type = metrics.render()
+    return Response(content, media_type=content_type)
+
 app.include_router(api.router)
 
 #Serve the static files TODO move this to nginx static file serving
-app.mount("/static", StaticFiles(directory=static_root), name="static")
+#Derivatives are mounted first, so they take precedence over /static. Missing ones are generated from the originals
+#Their directory is created on the first request
+app.mount(
+    derivatives.DERIVATIVES_URL_PATH,
+    DerivativeStaticFiles(images_dir=os.environ.get("IMAGES_DIR"), directory=derivatives.DERIVATIVES_DIR, check_dir=False),
+    name="derivatives"
+)
+app.mount("/static", CachedStaticFiles(directory=static_root), name="static")
 
 #Handle CORS
 app.add_middleware(
@@ -52,7 +91,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
+#Outermost, so the Server-Timing total covers everything else
+app.add_middleware(metrics.TimingMiddleware)
 
 #Exception handling
 @app.exception_handler(exceptions.ItemNotFoundError)
@@ -83,6 +125,50 @@ async def item_not_found_handler(request: Request, exc: exceptions.InvalidMediaT
         content={"detail": str(exc)}
     )
 
+@app.exception_handler(exceptions.InvalidCursorError)
+async def invalid_cursor_handler(request: Request, exc: exceptions.InvalidCursorError):
+    return JSONResponse(
+        status_code=400,
+        content={"detail": str(exc)}
+    )
+
+@app.exception_handler(exceptions.PageOutOfRangeError)
+async def page_out_of_range_handler(request: Request, exc: exceptions.PageOutOfRangeError):
+    return JSONResponse(
+        status_code=400,
+        content={"detail": str(exc)}
+    )
+
+@app.exception_handler(exceptions.InvalidMetadataError)
+async def invalid_metadata_handler(request: Request, exc: exceptions.InvalidMetadataError):
+    return JSONResponse(
+        status_code=422,
+        content={"detail": str(exc)}
+    )
+
+@app.exception_handler(exceptions.FileTooLargeError)
+async def file_too_large_handler(request: Request, exc: exceptions.FileTooLargeError):
+    return JSONResponse(
+        status_code=413,
+        content={"detail": str(exc)}
+    )
+
+@app.exception_handler(exceptions.QueueFullError)
+async def queue_full_handler(request: Request, exc: exceptions.QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(exceptions.OverloadedError)
+async def overloaded_handler(request: Request, exc: exceptions.OverloadedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 @app.exception_handler(exceptions.DatabaseError)
 async def item_not_found_handler(request: Request, exc: exceptions.DatabaseError):
     return JSONResponse(
@@ -0,0 +1,147 @@
+"""
+Per-stage latency instrumentation.
+
+Every request gets a `Timings` in a context variable. `stage()` blocks record how long each step took (embedding,
+BM25, qdrant, mongo...), both into the request's `Server-Timing` header and into prometheus histograms labelled by
+operation (e.g. `search_hybrid`) and stage. Metrics are served by `/metrics`. With gunicorn, set
+PROMETHEUS_MULTIPROC_DIR so every worker's metrics are aggregated.
+
+Set PROFILE_DIR to also profile a sample of requests (PROFILE_SAMPLE_RATE) with pyinstrument, keeping the profiles
+of those slower than PROFILE_MIN_MS.
+"""
+import contextvars
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+#Must exist before prometheus_client creates its first metric
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_MIN_MS = float(os.environ.get('PROFILE_MIN_MS', 100))
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'html') #'html' or 'speedscope' (flame graphs on speedscope.app)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram('image_hub_request_seconds', "Request latency by operation", ['operation'], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram('image_hub_stage_seconds', "Latency of each stage of an operation", ['operation', 'stage'], buckets=LATENCY_BUCKETS)
+
+INFERENCE_BATCH_SECONDS = Histogram('image_hub_inference_batch_seconds', "Time to run a batch of encodes", ['queue', 'step'], buckets=LATENCY_BUCKETS)
+INFERENCE_BATCH_SIZE = Histogram('image_hub_inference_batch_size', "Items per inference batch", ['queue'], buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+INFERENCE_QUEUE_DEPTH = Gauge('image_hub_inference_queue_depth', "Encodes waiting for a batch", ['queue'], multiprocess_mode='livesum')
+INFERENCE_CONNECTIONS_IN_USE = Gauge('image_hub_inference_connections_in_use', "Connections to the inference server in use", multiprocess_mode='livesum')
+PREPROCESS_IN_FLIGHT = Gauge('image_hub_preprocess_in_flight', "Images being decoded or waiting in the preprocessing pool", multiprocess_mode='livesum')
+VECTOR_WRITE_QUEUE_DEPTH = Gauge('image_hub_vector_write_queue_depth', "Points waiting to be upserted to qdrant", multiprocess_mode='livesum')
+ADMISSION_IN_FLIGHT = Gauge('image_hub_admission_in_flight', "Requests holding a slot of an admission budget", ['budget'], multiprocess_mode='livesum')
+ADMISSION_WAITING = Gauge('image_hub_admission_waiting', "Requests queued for a slot of an admission budget", ['budget'], multiprocess_mode='livesum')
+ADMISSION_REJECTED = Counter('image_hub_admission_rejected', "Requests turned away by admission control", ['budget', 'reason'])
+COALESCED_REQUESTS = Counter('image_hub_coalesced_requests', "Requests answered by an identical one, in flight ('joined') or just finished ('cached')", ['flight', 'outcome'])
+
+class Timings:
+    """Stages timed during one request or background job"""
+
+    def __init__(self, operation: str = 'other', keep_stages: bool = False):
+        self.operation = operation
+        #Only requests keep their stages, for the Server-Timing header. A background job would grow them without bound
+        self.keep_stages = keep_stages
+        self.stages: list[tuple[str, float]] = []
+
+    def header(self, total: float) -> str:
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages]
+        return ', '.join(entries + [f'total;dur={total * 1000:.1f}'])
+
+_timings: contextvars.ContextVar[Timings | None] = contextvars.ContextVar('timings', default=None)
+
+def start(operation: str, keep_stages: bool = False) -> Timings:
+    """Starts timing a new operation in the current context, e.g. a background job"""
+    timings = Timings(operation, keep_stages)
+    _timings.set(timings)
+    return timings
+
+def set_operation(operation: str):
+    """Labels the metrics of the current request, e.g. with the search type"""
+    timings = _timings.get()
+    if timings is None:
+        start(operation)
+    else:
+        timings.operation = operation
+
+@contextmanager
+def stage(name: str):
+    """Times a stage of the current operation"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings = _timings.get()
+        if timings is not None and timings.keep_stages:
+            timings.stages.append((name, elapsed))
+        STAGE_SECONDS.labels(timings.operation if timings is not None else 'other', name).observe(elapsed)
+
+def render() -> tuple[bytes, str]:
+    """Metrics in the prometheus text format, and their content type"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+class TimingMiddleware:
+    """Times every request, adds its stages as a Server-Timing header, and profiles a sample of them"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timings = start('other', keep_stages=True)
+        started = time.perf_counter()
+
+        async def send_with_timing(message: Message):
+            if message['type'] == 'http.response.start' and SERVER_TIMING:
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', timings.header(time.perf_counter() - started).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        profiler = None
+        if PROFILE_DIR and random.random() < PROFILE_SAMPLE_RATE:
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode='enabled')
+            profiler.start()
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            elapsed = time.perf_counter() - started
+            #Static files and other unlabelled routes would drown the operations we care about
+            if timings.operation != 'other':
+                REQUEST_SECONDS.labels(timings.operation).observe(elapsed)
+            if profiler is not None:
+                profiler.stop()
+                if elapsed * 1000 >= PROFILE_MIN_MS:
+                    save_profile(profiler, timings.operation, scope['path'])
+
+def save_profile(profiler, operation: str, path: str):
+    from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+    renderer = SpeedscopeRenderer() if PROFILE_FORMAT == 'speedscope' else HTMLRenderer()
+    extension = 'json' if PROFILE_FORMAT == 'speedscope' else 'html'
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    filename = os.path.join(PROFILE_DIR, f'{int(time.time() * 1000)}-{operation}.{extension}')
+    with open(filename, 'w') as f:
+        f.write(profiler.output(renderer))
+    logging.info(f"Saved the profile of {path} to {filename}")
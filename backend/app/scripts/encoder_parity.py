@@ -0,0 +1,107 @@
+"""
+Recall parity of an encoder backend against the fp32 torch baseline the collection was built with.
+
+Samples images from the collection and uses each one twice: its title as a text query, and the image file itself as
+an image query. Both are encoded with the baseline and with the candidate backend, then searched against the
+collection. Reports the top-k overlap of the results, the cosine similarity of the embeddings, and the encode time.
+
+Usage: python -m app.scripts.encoder_parity --backend torch-int8 [--sample 200] [--k 10] [--min-overlap 0.9]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import pathlib
+import sys
+import time
+import numpy as np
+from qdrant_client import models
+from transformers.image_utils import load_image
+from .. import dependencies
+from ..db import db, vector_db
+from ..config import COLLECTION_NAME, DENSE_VECTOR_NAME
+from ..api.utils import database
+from ..inference.backends import ENCODER_BACKENDS
+from ..inference.engine import encode_texts
+
+logging.basicConfig(level=logging.INFO)
+
+IMAGES_DIR = pathlib.Path(os.environ.get('IMAGES_DIR', '.'))
+ENCODE_BATCH_SIZE = 16
+
+async def sample_documents(n: int) -> list[dict]:
+    """Random images that have both a title and a file on disk"""
+    docs = await database.get_images_collection().aggregate([{'$sample': {'size': n}}]).to_list(n)
+    return [doc for doc in docs if doc.get('title') and (IMAGES_DIR / pathlib.Path(doc['url']).name).exists()]
+
+def encode(backend: str, texts: list[str], images: list) -> tuple[np.ndarray, np.ndarray, float]:
+    tokenizer = dependencies.get_sglip_tokenizer()
+    processor = dependencies.get_sglip_image_processor()
+    text_encoder = dependencies.get_encoder('text', backend)
+    vision_encoder = dependencies.get_encoder('vision', backend)
+
+    start = time.perf_counter()
+    text_vectors, image_vectors = [], []
+    for i in range(0, len(texts), ENCODE_BATCH_SIZE):
+        text_vectors.append(encode_texts(text_encoder, tokenizer, texts[i:i + ENCODE_BATCH_SIZE]))
+        pixel_values = processor(images=images[i:i + ENCODE_BATCH_SIZE], return_tensors='pt')['pixel_values']
+        image_vectors.append(vision_encoder.encode(pixel_values))
+
+    return np.concatenate(text_vectors), np.concatenate(image_vectors), time.perf_counter() - start
+
+async def search(vectors: np.ndarray, k: int) -> list[set]:
+    requests = [
+        models.QueryRequest(query=vector.tolist(), using=DENSE_VECTOR_NAME, limit=k, with_payload=False)
+        for vector in vectors
+    ]
+    responses = await vector_db.client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+    return [{point.id for point in response.points} for response in responses]
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=[b for b in ENCODER_BACKENDS if b != 'torch'], required=True)
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--min-overlap', type=float, default=0.9, help="Fail if the mean top-k overlap falls below this")
+    args = parser.parse_args()
+
+    await db.connect_to_database(os.environ.get('DATABASE_URL'))
+    await vector_db.connect_to_database(os.environ.get('QDRANT_URL'))
+
+    docs = await sample_documents(args.sample)
+    if not docs:
+        print("FAIL: no sampled image has both a title and a file on disk")
+        sys.exit(1)
+
+    texts = [doc['title'] for doc in docs]
+    images = await asyncio.gather(*[asyncio.to_thread(load_image, str(IMAGES_DIR / pathlib.Path(doc['url']).name)) for doc in docs])
+
+    baseline_text, baseline_image, baseline_time = encode('torch', texts, images)
+    candidate_text, candidate_image, candidate_time = encode(args.backend, texts, images)
+
+    failed = False
+    for kind, baseline, candidate in [('text', baseline_text, candidate_text), ('image', baseline_image, candidate_image)]:
+        baseline_hits = await search(baseline, args.k)
+        candidate_hits = await search(candidate, args.k)
+        overlap = np.array([len(b & c) / max(len(b), 1) for b, c in zip(baseline_hits, candidate_hits)])
+        similarity = cosine(baseline, candidate)
+
+        print(f"{kind}: top-{args.k} overlap mean {overlap.mean():.4f} min {overlap.min():.4f}, "
+              f"cosine mean {similarity.mean():.5f} min {similarity.min():.5f}")
+        failed |= overlap.mean() < args.min_overlap
+
+    print(f"{len(docs)} texts and images encoded in {baseline_time:.2f}s with torch, {candidate_time:.2f}s with {args.backend} "
+          f"({baseline_time / candidate_time:.2f}x)")
+
+    await db.close_database_connection()
+    await vector_db.close_database_connection()
+
+    if failed:
+        print(f"FAIL: {args.backend} drops below a mean top-{args.k} overlap of {args.min_overlap}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    asyncio.run(main())
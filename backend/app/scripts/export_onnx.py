@@ -0,0 +1,67 @@
+"""
+Exports the SigLIP text and vision towers of ENCODER_MODEL to ONNX, for ENCODER_BACKEND=onnx.
+
+Usage: python -m app.scripts.export_onnx OUTPUT_DIR [--opset 17] [--int8]
+"""
+import argparse
+import logging
+import pathlib
+import torch
+from PIL import Image
+from transformers import SiglipTextModel, SiglipVisionModel
+from .. import dependencies
+
+logging.basicConfig(level=logging.INFO)
+
+class PooledOutput(torch.nn.Module):
+    """Returns only the embedding of a tower, as a standalone module for export"""
+
+    def __init__(self, model: SiglipTextModel | SiglipVisionModel, input_name: str):
+        super().__init__()
+        self.model = model
+        self.input_name = input_name
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(**{self.input_name: inputs}).pooler_output
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', type=pathlib.Path)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--int8', action='store_true', help="Also quantize the weights of both graphs to int8")
+    args = parser.parse_args()
+
+    tokenizer = dependencies.get_sglip_tokenizer()
+    processor = dependencies.get_sglip_image_processor()
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    input_ids = tokenizer(['a sample query', 'another'], padding='max_length', truncation=True, return_tensors='pt')['input_ids']
+    pixel_values = processor(images=[Image.new('RGB', (224, 224))] * 2, return_tensors='pt')['pixel_values']
+
+    with torch.no_grad():
+        torch.onnx.export(
+            PooledOutput(dependencies.get_text_model(), 'input_ids'), (input_ids,), args.output / 'text.onnx',
+            input_names=['input_ids'], output_names=['embedding'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'embedding': {0: 'batch'}},
+            opset_version=args.opset, dynamo=False,
+        )
+        torch.onnx.export(
+            PooledOutput(dependencies.get_vision_model(), 'pixel_values'), (pixel_values,), args.output / 'vision.onnx',
+            input_names=['pixel_values'], output_names=['embedding'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'embedding': {0: 'batch'}},
+            opset_version=args.opset, dynamo=False,
+        )
+
+    if args.int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        for name in ['text.onnx', 'vision.onnx']:
+            path = args.output / name
+            fp32_path = path.with_suffix('.fp32.onnx')
+            path.rename(fp32_path)
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+
+    logging.info(f"✅ Exported the text and vision towers of {dependencies.MODEL} to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Writes the thumbnail and preview derivatives of every image already in IMAGES_DIR, e.g. after seeding or after
+changing THUMBNAIL_WIDTH, PREVIEW_WIDTH or DERIVATIVE_FORMAT. Images that already have their derivatives are skipped
+unless --overwrite, so an interrupted run can simply be restarted.
+
+Usage: python -m app.scripts.generate_derivatives [--workers N] [--overwrite]
+"""
+import argparse
+import logging
+import os
+import pathlib
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ..api.utils import derivatives
+
+logging.basicConfig(level=logging.INFO)
+
+def generate_chunk(sources: list[pathlib.Path], overwrite: bool) -> tuple[int, int]:
+    """Runs in a worker process. Returns how many images got new derivatives, and how many failed"""
+    generated, failed = 0, 0
+    for source in sources:
+        try:
+            if derivatives.generate(source, overwrite=overwrite):
+                generated += 1
+        except Exception as e:
+            logging.warning(f"Failed to generate derivatives of {source}: {e}")
+            failed += 1
+
+    return generated, failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--overwrite', action='store_true', help="Regenerate existing derivatives")
+    parser.add_argument('--chunk-size', type=int, default=256)
+    args = parser.parse_args()
+
+    sources = sorted(pathlib.Path(os.environ.get('IMAGES_DIR')).glob('*.jpg'))
+    chunks = [sources[i:i + args.chunk_size] for i in range(0, len(sources), args.chunk_size)]
+    logging.info(f"Generating {list(derivatives.DERIVATIVE_WIDTHS)} derivatives of {len(sources)} images into {derivatives.DERIVATIVES_DIR}")
+
+    start = time.perf_counter()
+    done = generated = failed = 0
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = {pool.submit(generate_chunk, chunk, args.overwrite): len(chunk) for chunk in chunks}
+        for future in as_completed(futures):
+            chunk_generated, chunk_failed = future.result()
+            done += futures[future]
+            generated += chunk_generated
+            failed += chunk_failed
+            logging.info(f"{done}/{len(sources)} images ({done / (time.perf_counter() - start):.1f} images/s)")
+
+    logging.info(f"✅ Generated derivatives for {generated} images, {failed} failed, {done - generated - failed} already had them")
+
+if __name__ == '__main__':
+    main()
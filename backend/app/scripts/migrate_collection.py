@@ -0,0 +1,70 @@
+"""
+Changes the storage of the dense vectors of an existing collection in place: quantization, on-disk originals and HNSW
+parameters. Qdrant rebuilds the affected segments in the background, so nothing is re-embedded.
+
+Usage: python -m app.scripts.migrate_collection [--quantization none|scalar|binary] [--always-ram | --no-always-ram]
+                                                [--on-disk | --no-on-disk] [--m 16] [--ef-construct 100] [--wait]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from qdrant_client import models
+from ..db import vector_db
+from ..config import COLLECTION_NAME, DENSE_VECTOR_NAME
+
+logging.basicConfig(level=logging.INFO)
+
+def quantization_config(kind: str, always_ram: bool):
+    if kind == 'scalar':
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=0.99, always_ram=always_ram
+        ))
+    if kind == 'binary':
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=always_ram))
+    return models.Disabled.DISABLED
+
+async def wait_for_optimization(poll_seconds: float = 5):
+    while True:
+        info = await vector_db.client.get_collection(COLLECTION_NAME)
+        if info.status == models.CollectionStatus.GREEN:
+            return
+        logging.info(f"Collection is {info.status.value}, optimizing {info.points_count} points...")
+        await asyncio.sleep(poll_seconds)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quantization', choices=['none', 'scalar', 'binary'])
+    parser.add_argument('--always-ram', action=argparse.BooleanOptionalAction, default=True, help="Keep quantized vectors in RAM")
+    parser.add_argument('--on-disk', action=argparse.BooleanOptionalAction, help="Keep the original vectors on disk")
+    parser.add_argument('--m', type=int)
+    parser.add_argument('--ef-construct', type=int)
+    parser.add_argument('--wait', action='store_true', help="Wait until qdrant is done rebuilding the collection")
+    args = parser.parse_args()
+
+    await vector_db.connect_to_database(os.environ.get('QDRANT_URL'))
+
+    hnsw_config = None
+    if args.m is not None or args.ef_construct is not None:
+        hnsw_config = models.HnswConfigDiff(m=args.m, ef_construct=args.ef_construct)
+
+    await vector_db.client.update_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config={
+            DENSE_VECTOR_NAME: models.VectorParamsDiff(
+                on_disk=args.on_disk,
+                hnsw_config=hnsw_config,
+                quantization_config=quantization_config(args.quantization, args.always_ram) if args.quantization else None,
+            )
+        },
+    )
+    logging.info(f"✅ Updated {COLLECTION_NAME}: quantization={args.quantization}, on_disk={args.on_disk}, m={args.m}, ef_construct={args.ef_construct}")
+
+    if args.wait:
+        await wait_for_optimization()
+        logging.info("✅ Collection is optimized")
+
+    await vector_db.close_database_connection()
+
+if __name__ == '__main__':
+    asyncio.run(main())
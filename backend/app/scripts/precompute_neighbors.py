@@ -0,0 +1,120 @@
+"""
+Precomputes the top-K related images of every image in the collection into a memory-mappable store, which
+the backend serves related images from when RELATED_NEIGHBORS_DIR points to it. Images in the store are only
+served from it, so paging through their related images stops after K; the others are served by qdrant.
+
+Usage: python -m app.scripts.precompute_neighbors OUTPUT_DIR [--k 50] [--batch-size 128] [--concurrency 4]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+import numpy as np
+from qdrant_client import models
+from ..db import vector_db
+from ..api.services.search_service import search_params
+from ..config import COLLECTION_NAME, DENSE_VECTOR_NAME
+
+logging.basicConfig(level=logging.INFO)
+
+SCROLL_BATCH_SIZE = 10_000
+
+async def list_points() -> tuple[list, list[str]]:
+    """All point ids in the collection, along with their mongo ids"""
+    point_ids, mongo_ids = [], []
+    offset = None
+    while True:
+        records, offset = await vector_db.client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=SCROLL_BATCH_SIZE,
+            offset=offset,
+            with_payload=['mongo_id'],
+            with_vectors=False,
+        )
+        for record in records:
+            point_ids.append(record.id)
+            mongo_ids.append(record.payload['mongo_id'])
+
+        if offset is None:
+            return point_ids, mongo_ids
+
+async def query_neighbors(point_ids: list, k: int) -> list[list[models.ScoredPoint]]:
+    requests = [
+        models.QueryRequest(
+            query=point_id,
+            using=DENSE_VECTOR_NAME,
+            filter=models.Filter(must_not=[models.HasIdCondition(has_id=[point_id])]),
+            params=search_params(),
+            limit=k,
+            with_payload=False,
+        )
+        for point_id in point_ids
+    ]
+    responses = await vector_db.client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+    return [response.points for response in responses]
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', type=pathlib.Path)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    await vector_db.connect_to_database(os.environ.get('QDRANT_URL'))
+
+    point_ids, mongo_ids = await list_points()
+    rows = {point_id: row for row, point_id in enumerate(point_ids)}
+    logging.info(f"Computing {args.k} neighbors for {len(point_ids)} images")
+
+    #Write next to the output, and only swap it in once complete
+    tmp = args.output.with_name(args.output.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    neighbors = np.lib.format.open_memmap(tmp / 'neighbors.npy', mode='w+', dtype=np.int32, shape=(len(point_ids), args.k))
+    scores = np.lib.format.open_memmap(tmp / 'scores.npy', mode='w+', dtype=np.float32, shape=(len(point_ids), args.k))
+    neighbors[:] = -1
+    scores[:] = 0
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    done = 0
+    start = time.perf_counter()
+
+    async def process(batch_start: int):
+        nonlocal done
+        batch = point_ids[batch_start:batch_start + args.batch_size]
+        async with semaphore:
+            results = await query_neighbors(batch, args.k)
+
+        for row, points in enumerate(results, start=batch_start):
+            found = [(rows[p.id], p.score) for p in points if p.id in rows]
+            if found:
+                neighbors[row, :len(found)] = [r for r, _ in found]
+                scores[row, :len(found)] = [s for _, s in found]
+
+        done += len(batch)
+        if done % (args.batch_size * 50) < len(batch):
+            logging.info(f"{done}/{len(point_ids)} images ({done / (time.perf_counter() - start):.0f} images/s)")
+
+    await asyncio.gather(*[process(i) for i in range(0, len(point_ids), args.batch_size)])
+
+    neighbors.flush()
+    scores.flush()
+    with open(tmp / 'ids.json', 'w') as f:
+        json.dump(mongo_ids, f)
+    with open(tmp / 'point_ids.json', 'w') as f:
+        json.dump(point_ids, f)
+
+    shutil.rmtree(args.output, ignore_errors=True)
+    os.replace(tmp, args.output)
+    logging.info(f"✅ Wrote neighbors of {len(point_ids)} images to {args.output} in {time.perf_counter() - start:.1f}s")
+
+    await vector_db.close_database_connection()
+
+if __name__ == '__main__':
+    asyncio.run(main())
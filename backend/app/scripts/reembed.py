@@ -0,0 +1,192 @@
+"""
+Re-embeds every image into a new version of the collection with the current ENCODER_MODEL, then flips the collection
+alias to it. The previous version is kept, so flipping back is a single alias change.
+
+Images are read from IMAGES_DIR in `_id` order, in batches. Progress is checkpointed in the `reembed_jobs` mongo
+collection after every batch, so an interrupted run resumes where it stopped. Images added while the job runs
+are picked up by a final catch-up pass after the flip.
+
+For a model swap, pin the running backends with QDRANT_COLLECTION_VERSION to the current version first, and roll
+them out with the new ENCODER_MODEL and version once this is done.
+
+Usage: python -m app.scripts.reembed VERSION [--batch-size 256] [--max-rate 0] [--no-flip]
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import pathlib
+import time
+from PIL import Image
+from qdrant_client import models
+from .. import dependencies
+from ..api.models.images import ImageModel
+from ..api.models.search import FACET_FIELDS
+from ..api.services import image_service
+from ..api.utils import database
+from ..config import COLLECTION_ALIAS, DENSE_VECTOR_NAME, versioned_collection_name
+from ..db import db, vector_db
+from ..inference import preprocess
+from ..inference.engine import InferenceEngine
+
+logging.basicConfig(level=logging.INFO)
+
+async def get_aliases() -> dict[str, str]:
+    """alias -> collection"""
+    response = await vector_db.client.get_aliases()
+    return {alias.alias_name: alias.collection_name for alias in response.aliases}
+
+async def create_target(name: str, vector_size: int):
+    """Creates the new version with the storage settings of the active one, only changing the vector size"""
+    if await vector_db.client.collection_exists(name):
+        return
+
+    source = (await vector_db.client.get_collection(COLLECTION_ALIAS)).config
+    dense = source.params.vectors[DENSE_VECTOR_NAME].model_copy(update={'size': vector_size})
+
+    await vector_db.client.create_collection(
+        collection_name=name,
+        vectors_config={DENSE_VECTOR_NAME: dense},
+        sparse_vectors_config=source.params.sparse_vectors,
+        hnsw_config=models.HnswConfigDiff(**source.hnsw_config.model_dump()),
+        quantization_config=source.quantization_config,
+        on_disk_payload=source.params.on_disk_payload,
+    )
+    for field in ['mongo_id', *FACET_FIELDS]:
+        await vector_db.client.create_payload_index(
+            collection_name=name,
+            field_name=field,
+            field_schema=models.PayloadSchemaType.KEYWORD,
+        )
+    logging.info(f"Created {name} with {vector_size}-d vectors")
+
+async def reembed_pass(job: dict, target: str, engine: InferenceEngine, bm25_model, batch_size: int, max_rate: float):
+    """Re-embeds every image after the job's checkpoint into `target`, advancing the checkpoint as it goes"""
+    images = database.get_images_collection()
+    jobs = database.get_reembed_jobs_collection()
+    start = time.perf_counter()
+    done = 0
+
+    while True:
+        batch_start = time.perf_counter()
+        query = {'_id': {'$gt': job['last_id']}} if job.get('last_id') else {}
+        docs = await images.find(query).sort('_id', 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return
+
+        paths = [image_service.UPLOAD_DIR / pathlib.Path(doc['url']).name for doc in docs]
+        decoded = await asyncio.gather(*[preprocess.load_pixels_async(path) for path in paths], return_exceptions=True)
+
+        items = []
+        for doc, path, pixels in zip(docs, paths, decoded):
+            if isinstance(pixels, Exception):
+                logging.warning(f"Skipping {doc['_id']}: failed to decode {path}: {pixels}")
+            else:
+                items.append((doc, path, pixels))
+
+        if items:
+            vectors = await engine.encode_pixels([pixels for _, _, pixels in items])
+            texts = [image_service.get_image_text(ImageModel.model_validate(doc)) for doc, _, _ in items]
+            sparse_vectors = await asyncio.to_thread(lambda: list(bm25_model.query_embed(texts)))
+
+            await vector_db.client.upsert(
+                collection_name=target,
+                points=[
+                    image_service.build_point(path, vector, sparse_vector, str(doc['_id']), doc)
+                    for (doc, path, _), vector, sparse_vector in zip(items, vectors, sparse_vectors)
+                ],
+                wait=True,
+            )
+
+        job['last_id'] = docs[-1]['_id']
+        await jobs.update_one(
+            {'_id': job['_id']},
+            {
+                '$set': {'last_id': job['last_id'], 'updated_at': datetime.datetime.now(datetime.timezone.utc)},
+                '$inc': {'processed': len(items), 'failed': len(docs) - len(items)},
+            }
+        )
+
+        done += len(docs)
+        logging.info(f"Re-embedded {done} images into {target} ({done / (time.perf_counter() - start):.1f} images/s)")
+
+        #Throttle, to leave CPU for the serving workers
+        if max_rate:
+            await asyncio.sleep(max(0, len(docs) / max_rate - (time.perf_counter() - batch_start)))
+
+async def check_not_legacy(version: int):
+    """Refuses to flip over an unversioned collection from before aliases, which an alias can't share a name with"""
+    if COLLECTION_ALIAS in await get_aliases() or not await vector_db.client.collection_exists(COLLECTION_ALIAS):
+        return
+
+    raise SystemExit(
+        f"{COLLECTION_ALIAS} is an unversioned collection, so no alias can take its name without deleting it first, "
+        f"which would stop serving until the alias exists. Migrate it instead: build the new version with --no-flip, "
+        f"roll the backends out with QDRANT_COLLECTION_VERSION={version} so they use it directly, delete the "
+        f"{COLLECTION_ALIAS} collection, then rerun without --no-flip to create the alias and catch up"
+    )
+
+async def flip_alias(target: str, version: int):
+    """Points the alias to `target` in a single atomic alias update"""
+    await check_not_legacy(version)
+
+    operations = []
+    if COLLECTION_ALIAS in await get_aliases():
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=COLLECTION_ALIAS)))
+
+    operations.append(models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=COLLECTION_ALIAS)))
+    await vector_db.client.update_collection_aliases(change_aliases_operations=operations)
+    logging.info(f"✅ {COLLECTION_ALIAS} now points to {target}")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('version', type=int)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--max-rate', type=float, default=0, help="Maximum images per second. 0 for no limit")
+    parser.add_argument('--no-flip', action='store_true', help="Only build the new version, leaving the alias alone")
+    args = parser.parse_args()
+
+    await db.connect_to_database(os.environ.get('DATABASE_URL'))
+    await vector_db.connect_to_database(os.environ.get('QDRANT_URL'))
+
+    target = versioned_collection_name(args.version)
+    if (await get_aliases()).get(COLLECTION_ALIAS) == target:
+        raise SystemExit(f"{target} is already the active version")
+    if not args.no_flip:
+        #Before re-embedding anything, rather than after hours of it
+        await check_not_legacy(args.version)
+
+    jobs = database.get_reembed_jobs_collection()
+    job = await jobs.find_one({'_id': target})
+    if job is None:
+        job = {'_id': target, 'model': dependencies.MODEL, 'status': 'running', 'last_id': None, 'processed': 0, 'failed': 0}
+        await jobs.insert_one(job)
+    elif job['model'] != dependencies.MODEL:
+        raise SystemExit(f"{target} was started with {job['model']}, but ENCODER_MODEL is {dependencies.MODEL}")
+    else:
+        logging.info(f"Resuming {target} after {job['last_id']} ({job['processed']} images done)")
+
+    engine = dependencies.get_local_inference_engine()
+    await engine.prepare(['vision'], warm_up=False)
+    bm25_model = dependencies.get_bm25_model()
+
+    pixels = await preprocess.to_pixels_async([Image.new('RGB', (224, 224))])
+    await create_target(target, len((await engine.encode_pixels(pixels))[0]))
+
+    await reembed_pass(job, target, engine, bm25_model, args.batch_size, args.max_rate)
+
+    if not args.no_flip:
+        await flip_alias(target, args.version)
+        #Images uploaded to the previous version while the job ran
+        await reembed_pass(job, target, engine, bm25_model, args.batch_size, args.max_rate)
+        await jobs.update_one({'_id': target}, {'$set': {'status': 'completed'}})
+
+    job = await jobs.find_one({'_id': target})
+    logging.info(f"✅ Re-embedded {job['processed']} images into {target} ({job['failed']} failed)")
+
+    await db.close_database_connection()
+    await vector_db.close_database_connection()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Compares text embeddings produced with dynamic padding against the 'max_length' baseline the
+collection was built for, and checks that a query encodes the same alone and in a batch of mixed lengths.
+
+Usage: python -m app.scripts.text_padding_parity [--padding bucket] [--min-cosine 0.99] [query ...]
+"""
+import argparse
+import sys
+import time
+import numpy as np
+import torch
+from .. import dependencies
+from ..inference.engine import encode_texts
+
+DEFAULT_QUERIES = [
+    'portrait', 'landscape', 'madonna', 'still life', 'the last supper',
+    'a portrait of a woman', 'italian renaissance fresco', 'dutch golden age seascape',
+    'a dog sleeping next to a fireplace in a dark room',
+]
+
+#Cosine similarity under which a query is considered to encode differently in a batch
+BATCH_TOLERANCE = 0.9999
+
+def encode(encoder, tokenizer, queries: list[str], padding: str) -> tuple[torch.Tensor, float]:
+    start = time.perf_counter()
+    #One query at a time, which is the worst case for 'max_length'
+    vectors = [encode_texts(encoder, tokenizer, [q], padding)[0] for q in queries]
+    return torch.from_numpy(np.stack(vectors)), time.perf_counter() - start
+
+def encode_batch(encoder, tokenizer, queries: list[str], padding: str) -> torch.Tensor:
+    #All the queries in one batch, like the micro-batcher groups concurrent searches of different lengths
+    return torch.from_numpy(encode_texts(encoder, tokenizer, queries, padding))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+    parser.add_argument('--padding', choices=['longest', 'bucket'], default='bucket')
+    parser.add_argument('--min-cosine', type=float, default=0.99, help="Fail if any query falls below this similarity")
+    args = parser.parse_args()
+
+    encoder = dependencies.get_encoder('text')
+    tokenizer = dependencies.get_sglip_tokenizer()
+
+    baseline, baseline_time = encode(encoder, tokenizer, args.queries, 'max_length')
+    candidate, candidate_time = encode(encoder, tokenizer, args.queries, args.padding)
+    cosine = torch.nn.functional.cosine_similarity(baseline, candidate)
+    batched = torch.nn.functional.cosine_similarity(candidate, encode_batch(encoder, tokenizer, args.queries, args.padding))
+
+    for query, sim in zip(args.queries, cosine.tolist()):
+        print(f"{sim:.5f}  {query}")
+    print(f"min cosine: {cosine.min().item():.5f}, mean cosine: {cosine.mean().item():.5f}")
+    print(f"max_length: {baseline_time:.3f}s, {args.padding}: {candidate_time:.3f}s")
+    print(f"min cosine between alone and batched: {batched.min().item():.5f}")
+
+    failed = False
+    if cosine.min().item() < args.min_cosine:
+        print(f"FAIL: '{args.padding}' padding drifts below {args.min_cosine} from the max_length baseline")
+        failed = True
+    if batched.min().item() < BATCH_TOLERANCE:
+        print(f"FAIL: with '{args.padding}' padding, a query's embedding depends on the queries batched with it")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Compares two benchmark results written by `benchmarks.run`, e.g. of a branch against main. Exits with 1 when any
+scenario got slower (p95) or lost throughput by more than the threshold.
+
+Usage: python -m benchmarks.compare BASELINE.json CANDIDATE.json [--threshold 0.1]
+"""
+import argparse
+import json
+import pathlib
+import sys
+
+def load(path: pathlib.Path) -> tuple[dict, dict]:
+    report = json.loads(path.read_text())
+    return report, {(result['scenario'], result['concurrency']): result for result in report['results']}
+
+def change(before: float | None, after: float | None) -> float | None:
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', type=pathlib.Path)
+    parser.add_argument('candidate', type=pathlib.Path)
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    baseline_report, baseline = load(args.baseline)
+    candidate_report, candidate = load(args.candidate)
+    if baseline_report['config'] != candidate_report['config']:
+        print(f"Warning: the runs used different configs\n  {baseline_report['config']}\n  {candidate_report['config']}")
+
+    print(f"{'scenario':>18} {'c':>4} {'req/s':>17} {'p95 ms':>19}")
+    regressions = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[key], candidate[key]
+        throughput = change(before['throughput'], after['throughput'])
+        p95 = change(before['p95_ms'], after['p95_ms'])
+        regressed = (throughput is not None and throughput < -args.threshold) or (p95 is not None and p95 > args.threshold)
+        if regressed:
+            regressions.append(key)
+
+        throughput_text = f"{after['throughput']:.1f} ({throughput:+.0%})" if throughput is not None else '-'
+        p95_text = f"{after['p95_ms']:.1f} ({p95:+.0%})" if p95 is not None else '-'
+        print(f"{key[0]:>18} {key[1]:>4} {throughput_text:>17} {p95_text:>19}{'  REGRESSION' if regressed else ''}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Hermetic benchmark of the API. Boots the FastAPI app in-process against Qdrant local mode and an in-memory Mongo
+stand-in, seeds a synthetic collection, and measures throughput and latency percentiles of each scenario at each
+concurrency level. Results are written as JSON, to be compared between commits with `benchmarks.compare`.
+
+By default the encoders are hashing stand-ins, so only the backend's own overhead is measured (add model cost with
+--encode-ms). --real-models uses ENCODER_MODEL and BM25 instead, which need to be downloaded. Qdrant local mode and
+the Mongo stand-in run on the event loop and scan instead of using indexes, so absolute numbers are pessimistic,
+especially at high concurrency; they are meant to be compared between commits on the same machine.
+
+Usage: python -m benchmarks.run [--size 5000] [--concurrency 1,8,32] [--requests 200] [--scenarios semantic,keyword,...]
+                                [--qdrant-path DIR] [--real-models] [--encode-ms 0] [--output FILE]
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+import warnings
+
+#The app reads its configuration on import
+_workdir = pathlib.Path(tempfile.mkdtemp(prefix='image-hub-bench-'))
+os.environ.setdefault('STATIC_ROOT', str(_workdir / 'static'))
+os.environ.setdefault('IMAGES_DIR', str(_workdir / 'static' / 'images'))
+os.environ.setdefault('IMAGES_URL_PATH', '/static/images')
+pathlib.Path(os.environ['IMAGES_DIR']).mkdir(parents=True, exist_ok=True)
+
+import httpx
+import numpy as np
+from PIL import Image
+from qdrant_client import AsyncQdrantClient, models
+from app import dependencies
+from app.api.models.images import ImageModel
+from app.api.models.search import FACET_FIELDS
+from app.api.services import image_service
+from app.api.utils import database
+from app.config import COLLECTION_NAME, DENSE_VECTOR_NAME, SPARSE_VECTOR_NAME
+from app.db import db, vector_db
+from app.main import app
+from .standins import AsyncDatabase, HashingBM25, HashingEngine
+
+#Local mode ignores payload indexes, and says so for each one
+warnings.filterwarnings('ignore', message='Payload indexes have no effect')
+
+SCENARIOS = ['semantic', 'semantic_filtered', 'keyword', 'hybrid', 'image', 'related', 'upload', 'hydration']
+SEED_BATCH_SIZE = 512
+
+WORDS = [
+    'portrait', 'landscape', 'madonna', 'child', 'saint', 'river', 'battle', 'still', 'life', 'flowers', 'harbour',
+    'winter', 'self', 'study', 'head', 'woman', 'man', 'horse', 'angel', 'church', 'interior', 'garden', 'sea',
+    'mountain', 'night', 'morning', 'allegory', 'venus', 'christ', 'king', 'queen', 'village', 'market', 'ship',
+]
+FACET_VALUES = {
+    'author': [f'author {i}' for i in range(200)],
+    'school': ['italian', 'dutch', 'flemish', 'french', 'german', 'spanish', 'english', 'venetian'],
+    'form': ['painting', 'sculpture', 'graphics', 'architecture', 'ceramics'],
+    'type': ['religious', 'portrait', 'landscape', 'mythological', 'genre', 'still-life', 'historical'],
+    'timeline': [f'{year + 1}-{year + 50}' for year in range(1200, 1900, 50)],
+    'technique': ['oil on canvas', 'fresco', 'tempera on panel', 'marble', 'engraving', 'watercolour'],
+}
+
+def fake_metadata(rng: np.random.Generator) -> dict:
+    metadata = {field: str(rng.choice(values)) for field, values in FACET_VALUES.items()}
+    return metadata | {
+        'title': ' '.join(rng.choice(WORDS, 3)),
+        'date': str(int(rng.integers(1200, 1900))),
+        'location': 'Museum',
+        'born_died': '',
+    }
+
+def random_query(rng: np.random.Generator) -> str:
+    return ' '.join(rng.choice(WORDS, 3))
+
+def random_jpeg(rng: np.random.Generator, size: tuple[int, int] = (640, 480)) -> bytes:
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+async def seed(size: int, vector_size: int, bm25_model, rng: np.random.Generator) -> list[str]:
+    """Creates the collection and fills it with `size` synthetic images. Returns their mongo ids"""
+    client = vector_db.client
+    await client.create_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config={DENSE_VECTOR_NAME: models.VectorParams(size=vector_size, distance=models.Distance.COSINE)},
+        sparse_vectors_config={SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF)},
+    )
+    for field in ['mongo_id', *FACET_FIELDS]:
+        await client.create_payload_index(COLLECTION_NAME, field_name=field, field_schema=models.PayloadSchemaType.KEYWORD)
+
+    col = database.get_images_collection()
+    mongo_ids = []
+    for start in range(0, size, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, size - start)
+        docs = [
+            fake_metadata(rng) | {'url': f"{os.environ['IMAGES_URL_PATH']}/{start + i}.jpg"}
+            for i in range(count)
+        ]
+        await col.insert_many(docs)
+
+        vectors = rng.standard_normal((count, vector_size)).astype(np.float32)
+        texts = [image_service.get_image_text(ImageModel.model_validate(doc)) for doc in docs]
+        points = [
+            image_service.build_point(pathlib.Path(f'{start + i}.jpg'), vector.tolist(), sparse_vector, str(doc['_id']), doc)
+            for i, (doc, vector, sparse_vector) in enumerate(zip(docs, vectors, bm25_model.query_embed(texts)))
+        ]
+        await client.upsert(COLLECTION_NAME, points=points, wait=True)
+        mongo_ids.extend(str(doc['_id']) for doc in docs)
+
+    return mongo_ids
+
+def make_scenarios(client: httpx.AsyncClient, mongo_ids: list[str], rng: np.random.Generator, images: list[bytes]):
+    """Scenario name -> coroutine function running one operation. Queries vary so result caches rarely hit"""
+    next_image = iter(range(len(images)))
+
+    def search(type: str, filtered: bool = False):
+        async def run():
+            params = {'query': random_query(rng), 'type': type, 'n': 20}
+            if filtered:
+                params['school'] = str(rng.choice(FACET_VALUES['school']))
+            (await client.get('/api/search/', params=params)).raise_for_status()
+        return run
+
+    async def image():
+        files = {'file': ('query.jpg', images[next(next_image) % len(images)], 'image/jpeg')}
+        (await client.post('/api/search/by-image', files=files, params={'n': 20})).raise_for_status()
+
+    async def related():
+        (await client.get(f'/api/images/related/{rng.choice(mongo_ids)}', params={'n': 20})).raise_for_status()
+
+    async def upload():
+        files = {'file': ('upload.jpg', images[next(next_image) % len(images)], 'image/jpeg')}
+        data = {'image_data': json.dumps(fake_metadata(rng))}
+        (await client.post('/api/images/', files=files, data=data)).raise_for_status()
+
+    async def hydration():
+        #Cold: the documents are evicted first, so every call goes to mongo
+        ids = [str(mongo_id) for mongo_id in rng.choice(mongo_ids, 20, replace=False)]
+        for mongo_id in ids:
+            await database.invalidate_document(mongo_id)
+        points = [models.ScoredPoint(id=i, version=0, score=1.0, payload={'mongo_id': mongo_id}) for i, mongo_id in enumerate(ids)]
+        await database.hydrate_from_qdrant(points)
+
+    return {
+        'semantic': search('semantic'),
+        'semantic_filtered': search('semantic', filtered=True),
+        'keyword': search('keyword'),
+        'hybrid': search('hybrid'),
+        'image': image,
+        'related': related,
+        'upload': upload,
+        'hydration': hydration,
+    }
+
+async def measure(operation, requests: int, concurrency: int) -> dict:
+    """Runs `requests` operations with `concurrency` workers. Latencies are in milliseconds"""
+    latencies = []
+    errors = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                await operation()
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (None, None, None)
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': len(errors),
+        'error_sample': errors[:3],
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': float(np.mean(latencies)) if latencies else None,
+        'p50_ms': float(p50) if p50 is not None else None,
+        'p95_ms': float(p95) if p95 is not None else None,
+        'p99_ms': float(p99) if p99 is not None else None,
+    }
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def use_standins(vector_size: int, encode_ms: float) -> tuple[HashingEngine, HashingBM25]:
+    engine, bm25_model = HashingEngine(vector_size, encode_ms), HashingBM25()
+    app.dependency_overrides[dependencies.get_inference_engine] = lambda: engine
+    app.dependency_overrides[dependencies.get_bm25_model] = lambda: bm25_model
+
+    #SigLIP's preprocessing, without downloading its config
+    config = {'size': {'height': 224, 'width': 224}, 'resample': 3, 'rescale_factor': 1 / 255, 'image_mean': [0.5] * 3, 'image_std': [0.5] * 3}
+    dependencies.get_preprocessor_config = lambda: config
+    return engine, bm25_model
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=5000, help="Number of synthetic images")
+    parser.add_argument('--vector-size', type=int, default=768)
+    parser.add_argument('--concurrency', default='1,8,32', help="Comma separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=200, help="Operations per scenario and concurrency level")
+    parser.add_argument('--warmup', type=int, default=5, help="Unmeasured operations before each scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--qdrant-path', help="Run qdrant local mode on disk instead of in memory")
+    parser.add_argument('--real-models', action='store_true', help="Use ENCODER_MODEL and BM25 instead of the hashing stand-ins")
+    parser.add_argument('--encode-ms', type=float, default=0, help="Latency added to every stand-in encoder call")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=pathlib.Path)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {sorted(unknown)}")
+
+    rng = np.random.default_rng(args.seed)
+    db.db = AsyncDatabase()
+    vector_db.client = AsyncQdrantClient(path=args.qdrant_path) if args.qdrant_path else AsyncQdrantClient(location=':memory:')
+
+    if args.real_models:
+        engine = dependencies.get_inference_engine()
+        await engine.prepare()
+        bm25_model = dependencies.get_bm25_model()
+        vector_size = len(await engine.encode_text('warm up'))
+    else:
+        engine, bm25_model = use_standins(args.vector_size, args.encode_ms)
+        vector_size = args.vector_size
+
+    print(f"Seeding {args.size} images into qdrant local mode ({args.qdrant_path or 'in memory'})...")
+    start = time.perf_counter()
+    mongo_ids = await seed(args.size, vector_size, bm25_model, rng)
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+    #Image queries are cached by their contents, so every operation gets its own image
+    images_needed = (args.requests + args.warmup) * len(levels) * len({'image', 'upload'} & set(scenarios))
+    images = await asyncio.to_thread(lambda: [random_jpeg(rng) for _ in range(max(images_needed, 1))])
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+        operations = make_scenarios(client, mongo_ids, rng, images)
+        for name in scenarios:
+            for level in levels:
+                for _ in range(args.warmup):
+                    await operations[name]()
+                result = {'scenario': name} | await measure(operations[name], args.requests, level)
+                results.append(result)
+                p50, p95, p99 = (f"{result[key]:.1f}" if result[key] is not None else '-' for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+                print(f"{name:>18} c={level:<3} {result['throughput']:8.1f} req/s  p50 {p50}ms  p95 {p95}ms  p99 {p99}ms  errors {result['errors']}")
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'size': args.size,
+            'vector_size': vector_size,
+            'qdrant': 'disk' if args.qdrant_path else 'memory',
+            'models': 'real' if args.real_models else 'hashing',
+            'encode_ms': args.encode_ms,
+            'requests': args.requests,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    output = args.output or pathlib.Path('benchmarks/results') / f"{(report['commit'] or 'local')[:12]}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {output}")
+
+    await vector_db.client.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
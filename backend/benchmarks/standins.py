@@ -0,0 +1,123 @@
+"""
+In-process stand-ins for the services the backend depends on, so benchmarks run without Mongo, Qdrant or model
+downloads. Qdrant itself runs in local mode, see `run.py`.
+"""
+import asyncio
+import hashlib
+import re
+import numpy as np
+import mongomock
+
+class AsyncCursor:
+    """A mongomock cursor with the async interface of pymongo's AsyncCursor"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n: int):
+        self._cursor.skip(n)
+        return self
+
+    def limit(self, n: int):
+        self._cursor.limit(n)
+        return self
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        docs = list(self._cursor)
+        return docs if length is None else docs[:length]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class AsyncCollection:
+    """A mongomock collection with the async interface of pymongo's AsyncCollection"""
+
+    def __init__(self, collection: mongomock.Collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs) -> AsyncCursor:
+        return AsyncCursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name: str):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+class AsyncDatabase:
+    def __init__(self):
+        self._db = mongomock.MongoClient().main_db
+
+    def get_collection(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self._db.get_collection(name))
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        return self.get_collection(name)
+
+def hash_vector(data: bytes, size: int) -> np.ndarray:
+    """A deterministic unit vector for a piece of data"""
+    seed = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+    vector = np.random.default_rng(seed).standard_normal(size).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+class HashingEngine:
+    """
+    Stands in for InferenceEngine: vectors are derived from a hash of the input, so equal inputs get equal vectors.
+    `latency_ms` is added to every call, to approximate the cost of the model.
+    """
+
+    def __init__(self, size: int = 768, latency_ms: float = 0):
+        self.size = size
+        self.latency_ms = latency_ms
+        self.calls = 0
+
+    async def _encode(self, items: list[bytes]) -> list[list[float]]:
+        self.calls += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return [hash_vector(item, self.size).tolist() for item in items]
+
+    async def prepare(self, *args, **kwargs):
+        pass
+
+    async def encode_text(self, text: str) -> list[float]:
+        return (await self.encode_texts([text]))[0]
+
+    async def encode_texts(self, texts: list[str]) -> list[list[float]]:
+        return await self._encode([text.encode() for text in texts])
+
+    async def encode_pixels(self, pixels: list[np.ndarray]) -> list[list[float]]:
+        return await self._encode([np.ascontiguousarray(p).tobytes() for p in pixels])
+
+    def stats(self) -> dict:
+        return {"backend": "hashing", "calls": self.calls}
+
+class SparseVector:
+    def __init__(self, indices: np.ndarray, values: np.ndarray):
+        self.indices = indices
+        self.values = values
+
+class HashingBM25:
+    """Stands in for fastembed's BM25: term frequencies of the lowercased words, hashed into indices"""
+
+    def query_embed(self, texts: str | list[str]):
+        for text in [texts] if isinstance(texts, str) else texts:
+            counts: dict[int, float] = {}
+            for word in re.findall(r'\w+', text.lower()):
+                index = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), 'little')
+                counts[index] = counts.get(index, 0) + 1.0
+            yield SparseVector(np.array(list(counts), dtype=np.int64), np.array(list(counts.values()), dtype=np.float32))
+
+    embed = query_embed
@@ -13,7 +13,7 @@ export default defineConfig({
         rewrite: (path) => path,
       },
 
-      '/static/images': {
+      '/static': {
         target: 'http://backend:42069',
         changeOrigin: true,
         rewrite: (path) => path,
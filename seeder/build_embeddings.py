@@ -0,0 +1,179 @@
+"""
+Builds the `vectors.npy` and `ids.json` files seed.py consumes from a directory of images named `{id}.jpg`.
+
+Images are decoded and preprocessed in a pool of processes while the main process encodes batches with the SigLIP
+vision tower. Vectors and ids are appended to `vectors.f32` and `ids.jsonl` in the output directory after every batch,
+so RAM stays flat and a crashed or interrupted run resumes after the last complete batch. Unreadable images are
+listed in `failed.txt` and skipped on resume. Once every image is done, `vectors.npy` and `ids.json` are written
+from the append-only files.
+
+Usage: python build_embeddings.py IMAGES_DIR [OUTPUT_DIR] [--model google/siglip-base-patch16-224] [--batch-size 64]
+                                  [--workers N] [--threads N]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image, ImageOps
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+
+# Configuration --
+DEFAULT_MODEL = os.getenv("ENCODER_MODEL", "google/siglip-base-patch16-224")
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+PROGRESS_EVERY = 20 # Batches between progress logs
+
+VECTORS_PART = "vectors.f32"
+IDS_PART = "ids.jsonl"
+FAILED_FILE = "failed.txt"
+VECTOR_FILE = "vectors.npy"
+ID_FILE = "ids.json"
+
+# Per worker process, set by init_worker
+_processor = None
+
+def init_worker(model: str):
+    global _processor
+    from transformers import AutoImageProcessor
+    _processor = AutoImageProcessor.from_pretrained(model, use_fast=True)
+
+def image_id(path: Path) -> int | str:
+    """The metadata.csv id of an image. Art500k ids are integers"""
+    return int(path.stem) if path.stem.isdigit() else path.stem
+
+def decode(path: Path, size: tuple[int, int]) -> Image.Image:
+    image = Image.open(path)
+    # JPEGs are decoded straight to roughly the input size, a fraction of the cost of a full decode
+    image.draft('RGB', size)
+    return ImageOps.exif_transpose(image).convert('RGB')
+
+def preprocess_batch(paths: list[Path]) -> tuple[list[Path], np.ndarray | None, list[Path]]:
+    """Runs in a worker process. Returns the decoded paths, their pixel values and the paths that failed"""
+    size = (_processor.size['width'], _processor.size['height'])
+    images, decoded, failed = [], [], []
+    for path in paths:
+        try:
+            images.append(decode(path, size))
+            decoded.append(path)
+        except Exception as e:
+            log.warning(f"Failed to decode {path}: {e}")
+            failed.append(path)
+
+    if not images:
+        return decoded, None, failed
+    return decoded, _processor(images=images, return_tensors='pt')['pixel_values'].numpy(), failed
+
+def resume(output_dir: Path, dim: int) -> set[str]:
+    """Truncates the output to the last complete batch and returns the file names already handled"""
+    vectors_path, ids_path, failed_path = output_dir / VECTORS_PART, output_dir / IDS_PART, output_dir / FAILED_FILE
+    if not ids_path.exists():
+        return set()
+
+    lines = []
+    with open(ids_path) as f:
+        for line in f:
+            # A line cut short by a crash ends the complete ones
+            if not line.endswith('\n'):
+                break
+            lines.append(line.rstrip('\n'))
+
+    # Vectors are appended before ids, so a crash leaves at most a partial batch of vectors without ids
+    rows = min(len(lines), os.path.getsize(vectors_path) // (dim * 4) if vectors_path.exists() else 0)
+    with open(vectors_path, 'r+b') as f:
+        f.truncate(rows * dim * 4)
+    with open(ids_path, 'w') as f:
+        f.writelines(line + '\n' for line in lines[:rows])
+
+    done = {json.loads(line)['file'] for line in lines[:rows]}
+    log.info(f"Resuming after {rows} embedded images")
+    if failed_path.exists():
+        done.update(line for line in failed_path.read_text().split('\n') if line)
+    return done
+
+def finalize(output_dir: Path, dim: int):
+    """Writes vectors.npy and ids.json from the append-only files, copying vectors in chunks"""
+    ids_path, vectors_path = output_dir / IDS_PART, output_dir / VECTORS_PART
+    with open(ids_path) as f:
+        ids = [json.loads(line)['id'] for line in f if line.strip()]
+
+    source = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(len(ids), dim))
+    target = np.lib.format.open_memmap(output_dir / VECTOR_FILE, mode='w+', dtype=np.float32, shape=(len(ids), dim))
+    for start in range(0, len(ids), 65536):
+        target[start:start + 65536] = source[start:start + 65536]
+    target.flush()
+    del target
+
+    with open(output_dir / ID_FILE, 'w') as f:
+        json.dump(ids, f)
+    log.info(f"Wrote {len(ids)} vectors of size {dim} to {output_dir / VECTOR_FILE} and {output_dir / ID_FILE}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images_dir', type=Path)
+    parser.add_argument('output_dir', type=Path, nargs='?', default=Path('.'))
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1), help="Decoding processes")
+    parser.add_argument('--threads', type=int, help="Torch threads used to encode")
+    args = parser.parse_args()
+
+    import torch
+    from transformers import SiglipVisionModel
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = SiglipVisionModel.from_pretrained(args.model).eval()
+    dim = model.config.hidden_size
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    done = resume(args.output_dir, dim)
+    paths = sorted(p for p in args.images_dir.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS and p.name not in done)
+    log.info(f"{len(done)} images already done, {len(paths)} to embed with {args.model} ({args.workers} workers)")
+
+    batches = [paths[i:i + args.batch_size] for i in range(0, len(paths), args.batch_size)]
+    start_time = time.perf_counter()
+    embedded = 0
+
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.model,)) as pool, \
+            open(args.output_dir / VECTORS_PART, 'ab') as vectors_file, \
+            open(args.output_dir / IDS_PART, 'a') as ids_file, \
+            open(args.output_dir / FAILED_FILE, 'a') as failed_file:
+        # Only a few batches are decoded ahead of the encoder, so memory doesn't grow with the directory
+        pending: deque[Future] = deque()
+        next_batch = 0
+        for i in range(len(batches)):
+            while next_batch < len(batches) and len(pending) < args.workers * 2:
+                pending.append(pool.submit(preprocess_batch, batches[next_batch]))
+                next_batch += 1
+
+            decoded, pixels, failed = pending.popleft().result()
+            if pixels is not None:
+                with torch.inference_mode():
+                    vectors = model(pixel_values=torch.from_numpy(pixels)).pooler_output.numpy()
+
+                vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                vectors_file.flush()
+                os.fsync(vectors_file.fileno())
+                ids_file.writelines(json.dumps({'id': image_id(p), 'file': p.name}) + '\n' for p in decoded)
+                ids_file.flush()
+
+            if failed:
+                failed_file.writelines(p.name + '\n' for p in failed)
+                failed_file.flush()
+
+            embedded += len(decoded)
+            if (i + 1) % PROGRESS_EVERY == 0 or i + 1 == len(batches):
+                elapsed = time.perf_counter() - start_time
+                log.info(f"Embedded {embedded}/{len(paths)} images ({embedded / elapsed:.1f} images/s)")
+
+    finalize(args.output_dir, dim)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import asyncio
+import time
 import pandas as pd
 import numpy as np
-from qdrant_client import QdrantClient, models
+from fastembed import SparseTextEmbedding
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 from qdrant_client.http.models import PointStruct
 from pathlib import Path
 import os
@@ -9,6 +11,7 @@ import logging
 import json
 from tenacity import retry, stop_after_attempt, wait_fixed
 import pymongo
+from pymongo.errors import BulkWriteError
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
@@ -18,10 +21,18 @@ MONGO_URI = os.getenv("DATABASE_URL")
 MONGO_COLLECTION = "images"
 
 QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_COLLECTION = "image_hub"
-VECTOR_SIZE = 768 #SET THE SAME AS YOUR MODEL -> SigLIP-base-patch16-224 uses 768
+# An alias, pointing to the versioned collection ('image_hub_v1', ...) the backend's reembed script flips between
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "image_hub")
+VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 768)) #SET THE SAME AS YOUR MODEL -> SigLIP-base-patch16-224 uses 768
 QDRANT_UPSERT_BATCH_SIZE = 2048 # Upsert to Qdrant in batches
 
+# 'bulk' seeds in vectorized chunks, 'rows' goes row by row (slow, kept for debugging single rows),
+# 'backfill' only copies the facet fields of already seeded images from mongo into their qdrant payloads
+SEED_MODE = os.getenv("SEED_MODE", "bulk")
+SEED_CHUNK_SIZE = int(os.getenv("SEED_CHUNK_SIZE", 5000)) # Rows per insert_many
+SPARSE_BATCH_SIZE = 256 # Texts per BM25 batch
+MAX_INFLIGHT_UPSERTS = 4 # Qdrant upserts running while the next chunk goes to mongo
+
 DATA_DIR = Path("/seeder/data")
 IMAGES_URL_DIR = os.getenv("IMAGES_URL_PATH")
 METADATA_CSV = DATA_DIR / "metadata.csv"
@@ -31,6 +42,20 @@ ID_FILE = DATA_DIR / "ids.json"
 DENSE_VECTOR_NAME="image_embedding"
 SPARSE_VECTOR_NAME="text_bm25"
 
+# Collection storage, only used when the collection is created. Use the backend's migrate_collection script for existing ones
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none") # 'none', 'scalar' (int8) or 'binary'
+QDRANT_QUANTIZATION_ALWAYS_RAM = os.getenv("QDRANT_QUANTIZATION_ALWAYS_RAM", "true").lower() == "true"
+QDRANT_ON_DISK = os.getenv("QDRANT_ON_DISK", "false").lower() == "true" # Original vectors on disk, only read to rescore
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", 100))
+QDRANT_HNSW_ON_DISK = os.getenv("QDRANT_HNSW_ON_DISK", "false").lower() == "true"
+
+#Store the display fields of each image in the qdrant payload, so the backend can skip mongo on searches
+DENORMALIZE_PAYLOAD = os.getenv("DENORMALIZE_PAYLOAD", "false").lower() == "true"
+DISPLAY_FIELDS = ["author", "born_died", "title", "date", "technique", "location", "form", "type", "school", "timeline", "url"]
+#Keyword indexed payload fields the backend filters and counts on. Must match FACET_FIELDS in the backend
+FACET_FIELDS = ["author", "school", "form", "type", "timeline", "technique"]
+
 #Wait services to start
 @retry(stop=stop_after_attempt(10), wait=wait_fixed(3))
 async def wait_for_mongo(client):
@@ -50,69 +75,8 @@ def wait_for_qdrant(client):
         log.warning(f"Waiting for Qdrant... ({e})")
         raise
 
-async def main():
-    #Check if we should run seeder
-    if os.getenv("RUN_SEEDER", "false").lower() != "true":
-        log.info("RUN_SEEDER is not 'true', skipping database seeding.")
-        return
-        
-    log.info("RUN_SEEDER=true. Seeder script started. Waiting for databases...")
-
-    # setup DBs
-    mongo_client = pymongo.AsyncMongoClient(MONGO_URI)
-    qdrant_client = QdrantClient(url=QDRANT_URL)
-    
-    await wait_for_mongo(mongo_client)
-    wait_for_qdrant(qdrant_client)
-    
-    col = mongo_client.main_db.get_collection(MONGO_COLLECTION)
-    
-    # Setup collection for qdrant
-    try:
-        qdrant_client.recreate_collection(
-            collection_name=QDRANT_COLLECTION,
-            vectors_config={
-                DENSE_VECTOR_NAME: models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE),
-            },
-            sparse_vectors_config= {
-                SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF,)
-            }
-        )
-        qdrant_client.create_payload_index(
-            collection_name=QDRANT_COLLECTION,
-            field_name='mongo_id',
-            field_schema=models.PayloadSchemaType.KEYWORD
-        )
-        log.info(f"Qdrant collection '{QDRANT_COLLECTION}' created.")
-    except Exception as e:
-        log.warning(f"Qdrant collection already exists or error: {e}")
-
-    # Load metadata
-    try:
-        log.info(f"Loading metadata from {METADATA_CSV}...")
-        df = pd.read_csv(METADATA_CSV, sep='\t').fillna("")
-        df.columns = df.columns.str.lower().str.replace('-', '_')
-        if 'id' not in df.columns:
-            raise ValueError("CSV must contain an 'id' column.")
-            
-        log.info(f"Loading vectors from {VECTOR_FILE}...")
-        all_vectors = np.load(VECTOR_FILE)
-        
-        log.info(f"Loading vector IDs from {ID_FILE}...")
-        with open(ID_FILE, 'r') as f:
-            all_ids = json.load(f)
-
-    except FileNotFoundError as e:
-        log.error(f"FATAL: Missing required data file: {e}. Stopping seeder.")
-        return
-    except Exception as e:
-        log.error(f"FATAL: Error loading data: {e}. Stopping seeder.")
-        return
-
-    if len(all_ids) != len(all_vectors):
-        log.error("FATAL: Mismatch between number of IDs and vectors. Check your pre-computation script.")
-        return
-
+async def seed_rows(df, all_vectors, all_ids, col, qdrant_client):
+    """Seeds one row at a time. Simple, but takes hours on large datasets"""
     # Map id -> vector
     log.info("Creating vector lookup map...")
     vector_map = dict(zip(all_ids, all_vectors))
@@ -155,7 +119,9 @@ async def main():
             payload = {
                 "mongo_id": mongo_id,
                 "tags": mongo_doc.get("tags", []), # Example filterable field
-            }
+            } | facet_payload(mongo_doc)
+            if DENORMALIZE_PAYLOAD:
+                payload |= {field: mongo_doc.get(field) for field in DISPLAY_FIELDS}
 
             #Index sparse data
             text = ' '.join(row.drop(['id', 'file', 'url']))
@@ -199,9 +165,311 @@ async def main():
             wait=True
         )
         log.info(f"Upserted final batch of {len(qdrant_points_batch)} points to Qdrant.")
+
+def quantization_config():
+    if QDRANT_QUANTIZATION == "scalar":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=0.99, always_ram=QDRANT_QUANTIZATION_ALWAYS_RAM
+        ))
+    if QDRANT_QUANTIZATION == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=QDRANT_QUANTIZATION_ALWAYS_RAM))
+    return None
+
+def facet_payload(doc: dict) -> dict:
+    # Missing CSV values are read as empty strings, leave them out so they are not counted as a facet value
+    return {field: doc[field] for field in FACET_FIELDS if doc.get(field)}
+
+def build_payloads(mongo_ids: list[str], docs: list[dict]) -> list[dict]:
+    payloads = []
+    for mongo_id, doc in zip(mongo_ids, docs):
+        payload = {
+            "mongo_id": mongo_id,
+            "tags": doc.get("tags", []), # Example filterable field
+        } | facet_payload(doc)
+        if DENORMALIZE_PAYLOAD:
+            payload |= {field: doc.get(field) for field in DISPLAY_FIELDS}
+        payloads.append(payload)
+
+    return payloads
+
+def embed_sparse(bm25_model: SparseTextEmbedding, texts: list[str]) -> list[models.SparseVector]:
+    return [
+        models.SparseVector(indices=embedding.indices.tolist(), values=embedding.values.tolist())
+        for embedding in bm25_model.embed(texts, batch_size=SPARSE_BATCH_SIZE)
+    ]
+
+async def get_existing_urls(col, urls: list[str]) -> set[str]:
+    """URLs already in mongo, queried in chunks through the url index"""
+    existing = set()
+    for start in range(0, len(urls), SEED_CHUNK_SIZE * 10):
+        cursor = col.find({"url": {"$in": urls[start:start + SEED_CHUNK_SIZE * 10]}}, {"url": 1, "_id": 0})
+        existing.update(doc["url"] async for doc in cursor)
+
+    return existing
+
+async def seed_bulk(df, all_vectors, all_ids, col):
+    """
+    Seeds in chunks: vectors are aligned to rows with a vectorized join, existing rows are filtered with set
+    based queries, metadata goes through insert_many, and qdrant upserts of a chunk run while the next chunk
+    is written to mongo.
+    """
+    start_time = time.perf_counter()
+
+    # Align every metadata row with its row in vectors.npy
+    id_to_row = pd.Series(np.arange(len(all_ids)), index=pd.Index([str(x) for x in all_ids]))
+    df = df.assign(_row=df['id'].astype(str).map(id_to_row))
+    missing = df['_row'].isna()
+    if missing.any():
+        log.warning(f"Skipping {missing.sum()} rows: Vector not found in pre-computed files.")
+    df = df[~missing].assign(
+        _row=lambda d: d['_row'].astype(np.int64),
+        url=lambda d: f'{IMAGES_URL_DIR}/' + d['id'].astype(str) + '.jpg',
+    )
+
+    # Check if already seeded to make script idempotent
+    existing = await get_existing_urls(col, df['url'].tolist())
+    if existing:
+        log.info(f"Skipping {len(existing)} rows: Already found in MongoDB.")
+        df = df[~df['url'].isin(existing)]
+
+    text_columns = [c for c in df.columns if c not in ('id', 'file', 'url', '_row')]
+    texts = df[text_columns].astype(str).agg(' '.join, axis=1)
+
+    log.info(f"Starting to seed {len(df)} images in chunks of {SEED_CHUNK_SIZE}...")
+    qdrant_client = AsyncQdrantClient(url=QDRANT_URL)
+    bm25_model = SparseTextEmbedding(model_name="Qdrant/bm25")
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_UPSERTS)
+    upserts = []
+    seeded = 0
+    failed = 0
+    rolled_back = 0
+
+    async def upsert_chunk(ids, rows, chunk_texts, payloads, mongo_ids):
+        try:
+            sparse_vectors = await asyncio.to_thread(embed_sparse, bm25_model, chunk_texts)
+            # Fancy indexing only reads the needed rows from the memory map
+            dense_vectors = np.asarray(all_vectors[rows])
+            for start in range(0, len(ids), QDRANT_UPSERT_BATCH_SIZE):
+                end = start + QDRANT_UPSERT_BATCH_SIZE
+                await qdrant_client.upsert(
+                    collection_name=QDRANT_COLLECTION,
+                    points=models.Batch(
+                        ids=ids[start:end],
+                        vectors={
+                            DENSE_VECTOR_NAME: dense_vectors[start:end].tolist(),
+                            SPARSE_VECTOR_NAME: sparse_vectors[start:end],
+                        },
+                        payloads=payloads[start:end],
+                    ),
+                    wait=True
+                )
+        except Exception:
+            nonlocal rolled_back
+            rolled_back += len(mongo_ids)
+            # Idempotency is decided on mongo, so documents left without vectors would be skipped by every re-run
+            await col.delete_many({"_id": {"$in": mongo_ids}})
+            raise
+        finally:
+            inflight.release()
+
+    for chunk_start in range(0, len(df), SEED_CHUNK_SIZE):
+        chunk = df.iloc[chunk_start:chunk_start + SEED_CHUNK_SIZE]
+        docs = chunk.drop(columns=['_row']).to_dict('records')
+
+        # insert_many sets the _id of each document in place
+        try:
+            await col.insert_many(docs, ordered=False)
+            inserted = [True] * len(docs)
+        except BulkWriteError as e:
+            failed_indexes = {error['index'] for error in e.details['writeErrors']}
+            inserted = [i not in failed_indexes for i in range(len(docs))]
+            log.error(f"Failed to insert {len(failed_indexes)} documents: {e.details['writeErrors'][0]['errmsg']}")
+
+        keep = np.array(inserted)
+        failed += len(docs) - int(keep.sum())
+        docs = [doc for doc, ok in zip(docs, inserted) if ok]
+
+        # Wait for a free slot, so memory stays bounded when qdrant is slower than mongo
+        await inflight.acquire()
+        upserts.append(asyncio.create_task(upsert_chunk(
+            [int(x) for x in chunk['id'][keep]],
+            chunk['_row'].to_numpy()[keep],
+            texts.iloc[chunk_start:chunk_start + SEED_CHUNK_SIZE][keep].tolist(),
+            build_payloads([str(doc['_id']) for doc in docs], docs),
+            [doc['_id'] for doc in docs],
+        )))
+
+        seeded += len(docs)
+        elapsed = time.perf_counter() - start_time
+        log.info(f"Inserted {seeded}/{len(df)} documents ({seeded / elapsed:.0f} docs/s)")
+
+    results = await asyncio.gather(*upserts, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            log.error(f"Failed to upsert a chunk to Qdrant, its documents were removed from mongo: {result}")
+    await qdrant_client.close()
+
+    elapsed = time.perf_counter() - start_time
+    log.info(
+        f"Seeded {seeded - rolled_back} images in {elapsed:.1f}s ({seeded / elapsed if elapsed else 0:.0f} images/s). "
+        f"{failed} failed mongo inserts, {sum(isinstance(r, Exception) for r in results)} failed qdrant chunks "
+        f"(re-run to seed them)."
+    )
+
+async def backfill_facets(col):
+    """
+    Copies the facet fields of every image in mongo into its qdrant payload, in batches of set_payload operations
+    selected through the mongo_id index. Safe to re-run.
+    """
+    start_time = time.perf_counter()
+    qdrant_client = AsyncQdrantClient(url=QDRANT_URL)
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_UPSERTS)
+    updates = []
+    done = 0
+
+    async def update_batch(operations):
+        try:
+            await qdrant_client.batch_update_points(collection_name=QDRANT_COLLECTION, update_operations=operations, wait=True)
+        finally:
+            inflight.release()
+
+    projection = {field: 1 for field in FACET_FIELDS}
+    operations = []
+    async for doc in col.find({}, projection, batch_size=SEED_CHUNK_SIZE):
+        payload = facet_payload(doc)
+        if not payload:
+            continue
+
+        operations.append(models.SetPayloadOperation(set_payload=models.SetPayload(
+            payload=payload,
+            filter=models.Filter(must=[models.FieldCondition(key="mongo_id", match=models.MatchValue(value=str(doc["_id"])))]),
+        )))
+        if len(operations) >= QDRANT_UPSERT_BATCH_SIZE:
+            await inflight.acquire()
+            updates.append(asyncio.create_task(update_batch(operations)))
+            done += len(operations)
+            operations = []
+            log.info(f"Backfilled {done} images ({done / (time.perf_counter() - start_time):.0f} images/s)")
+
+    if operations:
+        await inflight.acquire()
+        updates.append(asyncio.create_task(update_batch(operations)))
+        done += len(operations)
+
+    results = await asyncio.gather(*updates, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            log.error(f"Failed to backfill a batch: {result}")
+    await qdrant_client.close()
+
+    log.info(f"Backfilled the facets of {done} images in {time.perf_counter() - start_time:.1f}s")
+
+def create_facet_indexes(qdrant_client):
+    """Keyword indexes for facet filters. Created after bulk writes, so each is built once over all the points"""
+    for field in FACET_FIELDS:
+        qdrant_client.create_payload_index(
+            collection_name=QDRANT_COLLECTION,
+            field_name=field,
+            field_schema=models.PayloadSchemaType.KEYWORD,
+            wait=True
+        )
+    log.info(f"Created payload indexes for {FACET_FIELDS}")
+
+async def main():
+    #Check if we should run seeder
+    if os.getenv("RUN_SEEDER", "false").lower() != "true":
+        log.info("RUN_SEEDER is not 'true', skipping database seeding.")
+        return
         
+    log.info("RUN_SEEDER=true. Seeder script started. Waiting for databases...")
+
+    # setup DBs
+    mongo_client = pymongo.AsyncMongoClient(MONGO_URI)
+    qdrant_client = QdrantClient(url=QDRANT_URL)
+    
+    await wait_for_mongo(mongo_client)
+    wait_for_qdrant(qdrant_client)
+    
+    col = mongo_client.main_db.get_collection(MONGO_COLLECTION)
+    # Makes the idempotency check an index lookup
+    await col.create_index("url")
+    
+    # Setup collection for qdrant. Never drop it, as the mongo documents are kept between runs
+    try:
+        aliases = [alias.alias_name for alias in qdrant_client.get_aliases().aliases]
+        if QDRANT_COLLECTION in aliases or qdrant_client.collection_exists(QDRANT_COLLECTION):
+            raise ValueError("collection already exists")
+        # The first version, served through the alias
+        collection_name = f"{QDRANT_COLLECTION}_v1"
+        qdrant_client.create_collection(
+            collection_name=collection_name,
+            vectors_config={
+                DENSE_VECTOR_NAME: models.VectorParams(
+                    size=VECTOR_SIZE,
+                    distance=models.Distance.COSINE,
+                    on_disk=QDRANT_ON_DISK,
+                    hnsw_config=models.HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT, on_disk=QDRANT_HNSW_ON_DISK),
+                    quantization_config=quantization_config(),
+                ),
+            },
+            sparse_vectors_config= {
+                SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF,)
+            }
+        )
+        qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name='mongo_id',
+            field_schema=models.PayloadSchemaType.KEYWORD
+        )
+        qdrant_client.update_collection_aliases(change_aliases_operations=[
+            models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=collection_name, alias_name=QDRANT_COLLECTION))
+        ])
+        log.info(f"Qdrant collection '{collection_name}' created behind the '{QDRANT_COLLECTION}' alias (quantization={QDRANT_QUANTIZATION}, on_disk={QDRANT_ON_DISK}).")
+    except Exception as e:
+        log.warning(f"Qdrant collection already exists or error: {e}")
+
+    if SEED_MODE == "backfill":
+        await backfill_facets(col)
+        create_facet_indexes(qdrant_client)
+        log.info("Backfill finished successfully.")
+        await mongo_client.close()
+        return
+
+    # Load metadata
+    try:
+        log.info(f"Loading metadata from {METADATA_CSV}...")
+        df = pd.read_csv(METADATA_CSV, sep='\t').fillna("")
+        df.columns = df.columns.str.lower().str.replace('-', '_')
+        if 'id' not in df.columns:
+            raise ValueError("CSV must contain an 'id' column.")
+            
+        log.info(f"Loading vectors from {VECTOR_FILE}...")
+        # Memory mapped, rows are only read when they are upserted
+        all_vectors = np.load(VECTOR_FILE, mmap_mode='r')
+        
+        log.info(f"Loading vector IDs from {ID_FILE}...")
+        with open(ID_FILE, 'r') as f:
+            all_ids = json.load(f)
+
+    except FileNotFoundError as e:
+        log.error(f"FATAL: Missing required data file: {e}. Stopping seeder.")
+        return
+    except Exception as e:
+        log.error(f"FATAL: Error loading data: {e}. Stopping seeder.")
+        return
+
+    if len(all_ids) != len(all_vectors):
+        log.error("FATAL: Mismatch between number of IDs and vectors. Check your pre-computation script.")
+        return
+
+    if SEED_MODE == "bulk":
+        await seed_bulk(df, all_vectors, all_ids, col)
+    else:
+        await seed_rows(df, all_vectors, all_ids, col, qdrant_client)
+    create_facet_indexes(qdrant_client)
+
     log.info("Seeding finished successfully.")
-    mongo_client.close()
+    await mongo_client.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())